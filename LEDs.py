@@ -2,12 +2,71 @@
 
 # Test DeepSIM status lights.
 
-from multiprocessing import Process, Queue
+from multiprocessing import Process
+from sharedstate import CommandQueue, LatestValue
+from framebuffer import SharedFrameBuffer
+from metrics import STAGE_LATENCY_BUCKETS, Registry
 import opc
 import time
 import copy
+import inspect
+from collections import deque
 import waves
 from math import pi
+import logging
+import numpy
+
+logger = logging.getLogger(__name__)
+
+## Stages from a status reaching the status socket to the first frame of its effect being sent:
+## (name, trace point where it starts, trace point where it ends)
+LATENCY_STAGES = (('ingest', 'received', 'decoded'),
+                  ('fsm', 'decoded', 'enqueued'),
+                  ('ipc', 'enqueued', 'dequeued'),
+                  ('render', 'dequeued', 'rendered'),
+                  ('send', 'rendered', 'sent'),
+                  ('status_to_frame', 'received', 'sent'),
+                  )
+LATENCY_QUANTILES = (.5, .9, .99)
+
+## The frame rate of an effect adapts to its content, between MIN_FRAME_RATE and the frame rate of the LEDs.
+## It is the rate at which no 8 bit channel changes more than SMOOTH_STEP between two frames
+MIN_FRAME_RATE = 5.0
+SMOOTH_STEP = 2.0
+RATE_DECAY = .1  # Fraction of the way to a lower frame rate a continuous effect goes every frame
+EDGE_FRAMES = 4  # Frames in the shortest phase of a square wave, so its edges do not jitter
+
+## The parameters of the effects that can change while they run and the signals holding them.
+## The effects read the signals on every frame, so they pick up a change on their next frame
+LIVE_PARAMETERS = {
+    'color': ('redIntensity', 'greenIntensity', 'blueIntensity'),
+    'chaseColor': ('redIntensity', 'greenIntensity', 'blueIntensity'),
+    'glow': ('redGlow', 'greenGlow', 'blueGlow'),
+    'timerColor': ('redTimerIntensity', 'greenTimerIntensity', 'blueTimerIntensity'),
+    'frequency': ('frequency',),
+    'decay': ('decay',),
+    'duty': ('duty',),
+    'speed': ('speed',),
+}
+## Ranges of the numeric parameters the effects can render: (lowest, highest, lowest included)
+PARAMETER_RANGES = {'frequency': (0, None, False),
+                    't': (0, None, False),
+                    'duty': (0, 1, True),
+                    'decay': (0, None, True),
+                    'speed': (0, None, True),
+                    }
+
+
+def in_range(name, value):
+    """
+    Returns False if value is not a number the effects can render for the parameter name
+    """
+    if name not in PARAMETER_RANGES:
+        return True
+    if not isinstance(value, (int, float)) or isinstance(value, bool):
+        return False
+    lowest, highest, lowestIncluded = PARAMETER_RANGES[name]
+    return (value > lowest or (value == lowest and lowestIncluded)) and (highest is None or value <= highest)
 
 class FrameIntensity(waves.Signal):
     def __init__(self, intensity):
@@ -20,21 +79,6 @@ class FrameIntensity(waves.Signal):
         return self._intensity
 
 
-class FramePhase(waves.Signal):
-    def __init__(self, piBased=False, phase=0.0):
-        self.piBased = piBased
-        self._current_phase = phase
-
-    def update(self, LED, nrOfLEDs):
-        if self.piBased:
-            self._current_phase = (2 * pi * LED) / nrOfLEDs
-        else:
-            self._current_phase = LED / nrOfLEDs
-
-    def __call__(self):
-        return self._current_phase
-
-
 class FrameFrequency(waves.Signal):
     def __init__(self, frequency=1.0):
         self._current_frequency = frequency
@@ -68,12 +112,54 @@ class FrameDuty(waves.Signal):
         return self._current_duty
 
 
+class MonotonicClock:
+    """The time source of the effects. Unlike the wall clock it does not jump when the system time is set"""
+    now = staticmethod(time.monotonic)
+    sleep = staticmethod(time.sleep)
+
+
+class VirtualClock:
+    """A time source that only moves when told to, so the effects render the same frames on every run.
+    Sleeping advances it instead of waiting"""
+    def __init__(self, start=0.0):
+        self._now = start
+
+    def now(self):
+        return self._now
+
+    def advance(self, seconds):
+        self._now += seconds
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+
 class FrameClock(waves.Signal):
-    def __init__(self):
-        self._current_s = time.time()
+    """The time of the waves of an effect, in seconds since it was reset.
+    It accumulates the time elapsed between updates scaled by the speed of the effect, so a change of speed
+    only changes how fast the waves go from then on, not where they are"""
+    def __init__(self, source=None):
+        """
+        :source: the time source, with a now() method. Defaults to the monotonic clock
+        """
+        self.source = source or MonotonicClock()
+        self.reset()
+
+    def reset(self):
+        self._last = self.source.now()
+        self._current_s = 0.0
 
     def update(self, speed=1.0):
-        self._current_s = time.time() * speed
+        now = self.source.now()
+        self._current_s += (now - self._last) * speed
+        self._last = now
+
+    def scale(self, factor):
+        """
+        Scales the time elapsed so far, e.g. by old/new frequency to keep the waves where they are
+        when their frequency changes
+        """
+        self._current_s *= factor
 
     def __call__(self):
         return self._current_s
@@ -91,10 +177,36 @@ class FrameTimer(waves.Signal):
         return self._current_t
 
 
+class RingDecayWave(waves.DecayWave):
+    """A DecayWave evaluated for every LED of a ring at once. Its phase is the array of the phases of the LEDs"""
+    def __call__(self):
+        reminder = (self.time() + self.phase()) % (1 / self.frequency())
+        return self.amplitude() * numpy.exp(-1 * self.decay() * reminder)
+
+
+class RingSquareWave(waves.SquareWave):
+    """A SquareWave evaluated for every LED of a ring at once. Its phase is the array of the phases of the LEDs"""
+    def __call__(self):
+        cycle = 1 / self.frequency()
+        reminder = (self.time() + self.phase()) % cycle
+        return numpy.where(reminder < self.duty() * cycle, self.amplitude(), -1 * self.amplitude())
+
+
+class RingSignal(waves.TransformedSignal):
+    """A TransformedSignal of a ring wave, with a value for every LED of the ring"""
+    def __init__(self, source_signal, y0, y1, discrete=False):
+        super().__init__(source_signal, y0, y1, discrete)
+        self.discrete = discrete
+
+    def __call__(self):
+        values = self.source.transform(self.y0, self.y1)
+        return values.astype(int) if self.discrete else values
+
+
 class StatusLED:
     def __init__(self,
                  effectQueue,
-                 timerQueue,
+                 timerSlot,
                  totalLEDs,
                  ringStart,
                  ringsLEDs,
@@ -104,13 +216,35 @@ class StatusLED:
                  power=(128, 128, 128),  # the max poser we want to drive the leds. int from 0 to 255
                  host = 'localhost',
                  port = '7890',
+                 frameBuffer=None,
+                 regions=('ring', 'cabinet'),
+                 frameRate=60.0,
+                 minFrameRate=MIN_FRAME_RATE,
+                 metrics=None,
+                 effects=None,
+                 controlQueue=None,
+                 timeSource=None,
+                 client=None,
                  ):
         """
+        :CommandQueue effectQueue: the commands of the effects. A running effect stops as soon as one is pending
+        :LatestValue timerSlot: shared slot holding the latest fraction of the timer
         :int totalLEDs: total nr of LEDs
         :tuple ringsLEDs: tuple containing the nr of leds of every concentric ring from center to edge
+        :SharedFrameBuffer frameBuffer: the frame shared with other producers. A private one is created if None
+        :tuple regions: the regions of the frame buffer we draw. The others are left to other producers
+        :float frameRate: max frames per second of the effects. A new effect starts within one frame interval
+        :float minFrameRate: min frames per second of the effects. Slow effects are drawn less often
+        :Registry metrics: where to register our metrics. They are kept private if None
+        :dict effects: the effect shown on every command: command -> (effect, parameters)
+        :CommandQueue controlQueue: messages applied between two frames without stopping the running effect
+        :timeSource: paces the effects and drives their waves, with now() and sleep(seconds) methods.
+        Defaults to the monotonic clock. A VirtualClock makes the effects deterministic
+        :client: where the frames are sent, with put_pixel_bytes and disconnect methods.
+        An opc.Client of host:port if None
         """
         self.effectQueue = effectQueue
-        self.timerQueue = timerQueue
+        self.timerSlot = timerSlot
         self.glow = glow
         self.power = power
         self.ringsLEDs = ringsLEDs
@@ -121,16 +255,63 @@ class StatusLED:
         self.intensity = [(0, 0, 0)] * 512  # make an intensity array for the whole fadecandy addressable pixels.
         self.progress = 0
         self.savedProgress = (0, 0, 0)
-        self.client = opc.Client(server_ip_port=str(host + ':' + port))  #, verbose=True)
+        self.host = host
+        self.port = port
+        if client is None:
+            client = opc.Client(server_ip_port=str(host + ':' + port))  #, verbose=True)
+        self.client = client
+        self.effects = dict(effects or {})
+        self.controlQueue = controlQueue
+        self.timeSource = timeSource or MonotonicClock()
+        self.command = None  # The command whose effect is running
+        self.liveParameters = {}  # The parameters of the running effect changed while it runs
+
+        self.privateFrameBuffer = frameBuffer is None
+        if frameBuffer is None:
+            frameBuffer = SharedFrameBuffer(totalPixels=len(self.intensity),
+                                            regions={'ring': (ringStart, totalLEDs),
+                                                     'cabinet': (cabinetStart, cabinetLEDs)})
+        self.frameBuffer = frameBuffer
+        self.regions = regions
+        self.frameRegions = None  # Claimed by the process drawing, on the first frame
+        self.sentVersion = None
+
+        # Pace of the effects and time for the commands to become visible
+        self.maxFrameRate = frameRate
+        self.minFrameRate = min(minFrameRate, frameRate)
+        self.neededRate = frameRate  # The frame rate the running effect needs at its fastest
+        self.effectRate = frameRate  # The same, within the bounds
+        self.continuousEffect = False  # Whether the frame rate follows the change between frames
+        self.previousFrame = None
+        self.setFrameRate(frameRate)
+        self.pendingCommand = None
+        self.transitionLatencies = deque(maxlen=1000)
+        self.rateStart = None  # Start and frames of the current measure of the frame rate
+        self.rateFrames = 0
+
+        if metrics is None:
+            metrics = Registry()
+        self.framesSent = metrics.counter('statusled_frames_total', 'Frames sent to the OPC server')
+        self.frameRateGauge = metrics.gauge('statusled_frame_rate', 'Frames per second of the running effect')
+        self.renderTime = metrics.histogram('statusled_frame_render_seconds', 'Time to render the frame of an effect')
+        self.sendTime = metrics.histogram('statusled_opc_send_seconds', 'Time to send a frame to the OPC server')
+        self.sendFailures = metrics.counter('statusled_opc_send_failures_total',
+                                            'Frames the OPC client could not send')
+        self.transitionLatency = metrics.histogram('statusled_transition_latency_seconds',
+                                                   'Time from a command being posted to its first frame being sent')
+        self.stageLatency = {stage: metrics.histogram(f'statusled_{stage}_latency_seconds',
+                                                      f'Latency of the {start} to {end} stage of a status change',
+                                                      buckets=STAGE_LATENCY_BUCKETS, quantiles=LATENCY_QUANTILES)
+                             for stage, start, end in LATENCY_STAGES}
 
         # Some frames
-        self.clock = FrameClock()
+        self.clock = FrameClock(self.timeSource)
         self.frequency = FrameFrequency()
         self.decay = FrameDecay()
         self.duty = FrameDuty()
+        self.speed = FrameFrequency()  # How many times faster than real time the clock of an effect runs
+        self.updateRingPhases()
         self.timer = FrameTimer()
-        self.piBasedPhase = FramePhase(piBased=True)
-        self.noPiBasedPhase = FramePhase(piBased=False)
         self.redGlow = FrameIntensity(self.glow[0])
         self.greenGlow = FrameIntensity(self.glow[1])
         self.blueGlow = FrameIntensity(self.glow[2])
@@ -142,36 +323,9 @@ class StatusLED:
         self.blueTimerIntensity = FrameIntensity(self.power[2])
 
         # Some basic waves
-        self.red_decayWave = waves.TransformedSignal(waves.DecayWave(time=self.clock,
-                                                                     frequency=self.frequency,
-                                                                     phase=self.noPiBasedPhase,
-                                                                     decay=self.decay,
-                                                                     ),
-                                                     y0=self.redGlow,
-                                                     y1=self.redIntensity,
-                                                     discrete=True)
-
-        self.green_decayWave = waves.TransformedSignal(waves.DecayWave(time=self.clock,
-                                                                       frequency=self.frequency,
-                                                                       phase=self.noPiBasedPhase,
-                                                                       decay=self.decay
-                                                                       ),
-                                                       y0=self.greenGlow,
-                                                       y1=self.greenIntensity,
-                                                       discrete=True)
-
-        self.blue_decayWave = waves.TransformedSignal(waves.DecayWave(time=self.clock,
-                                                                      frequency=self.frequency,
-                                                                      phase=self.noPiBasedPhase,
-                                                                      decay=self.decay
-                                                                      ),
-                                                      y0=self.blueGlow,
-                                                      y1=self.blueIntensity,
-                                                      discrete=True)
-
         self.red_sineWave = waves.TransformedSignal(waves.SineWave(time=self.clock,
                                                                    frequency=self.frequency,
-                                                                   phase=self.piBasedPhase,
+                                                                   phase=0.0,
                                                                    ),
                                                     y0=self.redGlow,
                                                     y1=self.redIntensity,
@@ -179,7 +333,7 @@ class StatusLED:
 
         self.green_sineWave = waves.TransformedSignal(waves.SineWave(time=self.clock,
                                                                      frequency=self.frequency,
-                                                                     phase=self.piBasedPhase,
+                                                                     phase=0.0,
                                                                      ),
                                                       y0=self.greenGlow,
                                                       y1=self.greenIntensity,
@@ -187,7 +341,7 @@ class StatusLED:
 
         self.blue_sineWave = waves.TransformedSignal(waves.SineWave(time=self.clock,
                                                                     frequency=self.frequency,
-                                                                    phase=self.piBasedPhase,
+                                                                    phase=0.0,
                                                                     ),
                                                      y0=self.blueGlow,
                                                      y1=self.blueIntensity,
@@ -195,7 +349,7 @@ class StatusLED:
 
         self.red_squareWave = waves.TransformedSignal(waves.SquareWave(time=self.clock,
                                                                        frequency=self.frequency,
-                                                                       phase=self.piBasedPhase,
+                                                                       phase=0.0,
                                                                        duty=self.duty
                                                                        ),
                                                       y0=self.redGlow,
@@ -204,7 +358,7 @@ class StatusLED:
 
         self.green_squareWave = waves.TransformedSignal(waves.SquareWave(time=self.clock,
                                                                          frequency=self.frequency,
-                                                                         phase=self.piBasedPhase,
+                                                                         phase=0.0,
                                                                          duty=self.duty
                                                                          ),
                                                         y0=self.greenGlow,
@@ -213,39 +367,51 @@ class StatusLED:
 
         self.blue_squareWave = waves.TransformedSignal(waves.SquareWave(time=self.clock,
                                                                         frequency=self.frequency,
-                                                                        phase=self.piBasedPhase,
+                                                                        phase=0.0,
                                                                         duty=self.duty
                                                                         ),
                                                        y0=self.blueGlow,
                                                        y1=self.blueIntensity,
                                                        discrete=True)
 
-        self.red_timerWave = waves.TransformedSignal(waves.SquareWave(time=self.timer,
-                                                                      frequency=1,
-                                                                      phase=self.noPiBasedPhase,
-                                                                      duty=self.duty
-                                                                      ),
-                                                     y0=self.redGlow,
-                                                     y1=self.redTimerIntensity,
-                                                     discrete=True)
-
-        self.green_timerWave = waves.TransformedSignal(waves.SquareWave(time=self.timer,
-                                                                        frequency=1,
-                                                                        phase=self.noPiBasedPhase,
-                                                                        duty=self.duty
-                                                                        ),
-                                                       y0=self.greenGlow,
-                                                       y1=self.greenTimerIntensity,
-                                                       discrete=True)
+    def updateRingPhases(self):
+        """
+        Computes the phase of every LED of every ring, its position along the ring as a fraction of a turn.
+        Called whenever the layout changes
+        """
+        self.ringPhases = [numpy.arange(leds) / leds for leds in self.ringsLEDs]
 
-        self.blue_timerWave = waves.TransformedSignal(waves.SquareWave(time=self.timer,
-                                                                       frequency=1,
-                                                                       phase=self.noPiBasedPhase,
-                                                                       duty=self.duty
-                                                                       ),
-                                                      y0=self.blueGlow,
-                                                      y1=self.blueTimerIntensity,
-                                                      discrete=True)
+    def decayWaves(self, ring):
+        """
+        Returns the red, green and blue decay waves of the LEDs of a ring, between the glow and the intensity
+        """
+        return tuple(RingSignal(RingDecayWave(time=self.clock,
+                                              frequency=self.frequency,
+                                              phase=self.ringPhases[ring],
+                                              decay=self.decay,
+                                              ),
+                                y0=glow,
+                                y1=intensity,
+                                discrete=True)
+                     for glow, intensity in ((self.redGlow, self.redIntensity),
+                                             (self.greenGlow, self.greenIntensity),
+                                             (self.blueGlow, self.blueIntensity)))
+
+    def timerWaves(self, ring):
+        """
+        Returns the red, green and blue waves of the LEDs of a ring showing the progress of the timer
+        """
+        return tuple(RingSignal(RingSquareWave(time=self.timer,
+                                               frequency=1,
+                                               phase=self.ringPhases[ring],
+                                               duty=self.duty
+                                               ),
+                                y0=glow,
+                                y1=intensity,
+                                discrete=True)
+                     for glow, intensity in ((self.redGlow, self.redTimerIntensity),
+                                             (self.greenGlow, self.greenTimerIntensity),
+                                             (self.blueGlow, self.blueTimerIntensity)))
 
     def setWhite(self):
         for i in range(self.totalLEDs):
@@ -265,23 +431,265 @@ class StatusLED:
         a list containing the color to pulse and the second is the pulse duration
         :return: None
         """
+        self.runEffect(self.multiplePulseRenderer(pattern, t, ring))
+
+    def multiplePulseRenderer(self, pattern=None, t=0.2, ring=-1):
+        """
+        Sets up multiplePulse. The pulses start when this is called
+        :return: the renderFrame of the effect. It returns None once the pattern is over
+        """
         if pattern is None:
             pattern = [[[self.redIntensity(),
                          self.greenIntensity(),
                          self.blueIntensity()],
                         t]]
-        pulseColor = copy.copy(self.intensity)
-        for p in pattern:
+
+        # Work out when every pulse ends and its colors
+        pulses = []
+        pulseEnd = 0.0
+        for color, duration in pattern:
+            pulseColor = copy.copy(self.intensity)
             for i in range(self.ringsLEDs[ring]):
-                pulseColor[self.ringStart + i] = p[0]
-            self.singlePulse(pulseColor=pulseColor, t=p[1])
+                pulseColor[self.ringStart + i] = color
+            pulseEnd += float(duration)
+            pulses.append((pulseEnd, pulseColor))
+        # Frames only have to change when a pulse ends
+        self.setEffectRate(1 / min(float(duration) for _, duration in pattern))
+
+        start = self.timeSource.now()
+
+        def renderFrame():
+            elapsed = self.timeSource.now() - start
+            for end, pulseColor in pulses:
+                if elapsed < end:
+                    return pulseColor
+            return None
+
+        return renderFrame
 
     def singlePulse(self, pulseColor, t=0.2):
+        self.setEffectRate(1 / float(t))
+        start = self.timeSource.now()
+        self.runEffect(lambda: pulseColor if self.timeSource.now() - start < float(t) else None)
+
+    def runEffect(self, renderFrame):
+        """
+        Sends the frames returned by renderFrame until it returns None or a new command is pending.
+        Frames are paced to frameInterval, set by the effect. The wait between two frames is cut in
+        slices of at most one frame at maxFrameRate, so a new command or control message is noticed
+        within one of those plus the rendering of one frame after it is posted, however slow the effect.
+        :param renderFrame: a callable returning the intensity of the next frame
+        :return: None
+        """
+        while not self.effectQueue.pending():
+            if self.controlQueue is not None and self.controlQueue.pending():
+                message = self.controlQueue.get()
+                try:
+                    renderFrame = self.applyControl(message) or renderFrame
+                except Exception:
+                    logger.exception('Failed to apply %s. The effect goes on', message[0])
+            frameStart = self.timeSource.now()
+            if not self.stepEffect(renderFrame):
+                break
+            nextFrame = frameStart + self.frameInterval
+            while not self.effectQueue.pending() and not (self.controlQueue is not None and
+                                                          self.controlQueue.pending()):
+                remaining = nextFrame - self.timeSource.now()
+                if remaining <= 0:
+                    break
+                self.timeSource.sleep(min(remaining, 1.0 / self.maxFrameRate))
+
+        self.stopEffect()
+
+    def effectRenderer(self, command):
+        """
+        Sets up the effect of a command
+        :return: the renderFrame of the effect, or None if the command has no effect
+        """
+        if command not in self.effects:
+            return None
+        effect, parameters = self.effects[command]
+        return getattr(self, effect + 'Renderer')(**parameters)
+
+    def applyControl(self, message):
+        """
+        Applies a message of the control queue: [method, args]
+        :return: the renderFrame to go on with if the running effect has to change, None otherwise
+        """
+        method, args = message
+        return getattr(self, method)(*args)
+
+    def reconfigure(self, rig, effects, frameRate, minFrameRate=MIN_FRAME_RATE):
+        """
+        Swaps in a new configuration without stopping the running effect.
+        :RigConfig rig: the layout of the LEDs and the OPC server
+        :dict effects: the effect shown on every command
+        :float frameRate: max frames per second of the effects
+        :float minFrameRate: min frames per second of the effects
+        :return: the renderFrame that goes on with the running effect under the new configuration,
+        or None if the running effect did not change
+        """
+        self.maxFrameRate = frameRate
+        self.minFrameRate = min(minFrameRate, frameRate)
+        self.effectRate = min(self.maxFrameRate, max(self.minFrameRate, self.neededRate))
+        self.setFrameRate(min(self.effectRate, max(self.minFrameRate, self.frameRate)))
+        runningEffect = self.effects.get(self.command)
+        self.effects = dict(effects)
+
+        if (rig.opcHost, rig.opcPort) != (self.host, self.port):
+            self.client.disconnect()
+            self.host = rig.opcHost
+            self.port = rig.opcPort
+            self.client = opc.Client(server_ip_port=str(self.host + ':' + self.port))
+
+        layout = (rig.ringStart, tuple(rig.ringLEDs), rig.cabinetStart, rig.cabinetLEDs)
+        relayout = layout != (self.ringStart, tuple(self.ringsLEDs), self.cabinetStart, self.cabinetLEDs)
+        if relayout:
+            # Blank what we drew with the old layout before drawing the new one
+            for region in self.frameRegions or ():
+                region.writeBytes(bytes(3 * region.length))
+            self.ringStart, self.ringsLEDs, self.cabinetStart, self.cabinetLEDs = layout
+            self.totalLEDs = sum(self.ringsLEDs)
+            self.updateRingPhases()
+            self.intensity = [(0, 0, 0)] * len(self.intensity)
+            self.frameBuffer.setRegion('ring', self.ringStart, self.totalLEDs)
+            self.frameBuffer.setRegion('cabinet', self.cabinetStart, self.cabinetLEDs)
+            self.claimRegions()
+
+        if self.command is None or (not relayout and self.effects.get(self.command) == runningEffect):
+            if relayout:
+                self.setLEDs(None)
+            return None
+        # The effects set up their renderer for the layout they were started with
+        return self.effectRenderer(self.command) or (lambda: None)
+
+    def setEffectRate(self, rate, continuous=False):
+        """
+        Sets the frame rate an effect needs at its fastest. It is kept within the frame rate bounds.
+        The frame rate of a continuous effect then follows how much its frames change, up to that rate
+        :param rate: the frame rate, or a callable estimating it from the signals of the effect,
+        so it follows the parameters changed while the effect runs
+        """
+        self.rateEstimate = rate if callable(rate) else (lambda: rate)
+        self.continuousEffect = continuous
+        self.previousFrame = None
+        self.updateEffectRate()
+
+    def updateEffectRate(self):
+        self.neededRate = self.rateEstimate()
+        self.effectRate = min(self.maxFrameRate, max(self.minFrameRate, self.neededRate))
+        self.setFrameRate(self.effectRate)
+
+    def setFrameRate(self, rate):
+        self.frameRate = rate
+        self.frameInterval = 1.0 / rate
+
+    def colorRange(self, color=None):
+        """
+        Returns the largest difference between a channel of color, the intensity by default, and of the glow
+        """
+        if color is None:
+            color = (self.redIntensity(), self.greenIntensity(), self.blueIntensity())
+        glow = (self.redGlow(), self.greenGlow(), self.blueGlow())
+        return max(abs(c - g) for c, g in zip(color, glow))
+
+    def setParameters(self, command, parameters):
+        """
+        Changes parameters of the running effect between two frames.
+        The ones in LIVE_PARAMETERS update the signals the effect reads, so it goes on without restarting.
+        Any other one restarts the effect with it, without going through the static buffer.
+        Parameters the running effect does not take, or with a value it cannot render, are ignored
+        :param command: the command the parameters are meant for. They are dropped if another one is running
+        :param parameters: a dictionary of parameters of the renderer of the running effect
+        :return: the renderFrame to go on with if the effect restarted, None otherwise
+        """
+        if command != self.command or command not in self.effects:
+            return None
+        effect, effectParameters = self.effects[self.command]
+        accepted = inspect.signature(getattr(self, effect + 'Renderer')).parameters
+        ignored = [name for name in parameters if name not in accepted]
+        if ignored:
+            logger.warning('The %s effect takes no %s', effect, ', '.join(ignored))
+        parameters = {name: value for name, value in parameters.items() if name in accepted}
+        rejected = {name: value for name, value in parameters.items() if not in_range(name, value)}
+        if rejected:
+            logger.warning('The %s effect cannot render %s', effect, rejected)
+            parameters = {name: value for name, value in parameters.items() if name not in rejected}
+        self.liveParameters.update(parameters)
+
+        if all(name in LIVE_PARAMETERS for name in parameters):
+            for name, value in parameters.items():
+                if name == 'frequency':
+                    # Keep the waves where they are, only their pace changes
+                    self.clock.scale(self.frequency() / value)
+                signals = LIVE_PARAMETERS[name]
+                for signal, channel in zip(signals, value if len(signals) > 1 else (value,)):
+                    getattr(self, signal).update(channel)
+            self.updateEffectRate()
+            return None
+        return getattr(self, effect + 'Renderer')(**{**effectParameters, **self.liveParameters})
+
+    def adaptFrameRate(self, frame):
+        """
+        Moves the frame rate of a continuous effect towards the one where its channels change SMOOTH_STEP
+        between frames. It goes up at once and down slowly, as the change of a frame shows the change
+        since the last frame, when it may be too late
+        """
+        leds = frame[self.ringStart:self.ringStart + self.totalLEDs]
+        if self.previousFrame is not None:
+            change = max(abs(new - old) for newLED, oldLED in zip(leds, self.previousFrame)
+                         for new, old in zip(newLED, oldLED))
+            # The change between two frames is proportional to the frame interval
+            needed = self.frameRate * change / SMOOTH_STEP
+            if needed < self.frameRate:
+                needed = self.frameRate + RATE_DECAY * (needed - self.frameRate)
+            self.setFrameRate(min(self.effectRate, max(self.minFrameRate, needed)))
+        self.previousFrame = leds
+
+    def stepEffect(self, renderFrame):
+        """
+        Renders and sends a single frame of an effect. Lets a scheduler interleave the effects of several rigs
+        :return: False once the effect is over
+        """
+        frameStart = time.monotonic()
+        frame = renderFrame()
+        if frame is None:
+            return False
+        self.renderTime.observe(time.monotonic() - frameStart)
+        if self.pendingCommand is not None:
+            self.pendingCommand[1]['rendered'] = time.monotonic()
+        self.setLEDs(frame)
+        if self.continuousEffect:
+            self.adaptFrameRate(frame)
+
+        if self.rateStart is None:
+            self.rateStart = frameStart
+        self.rateFrames += 1
+        if frameStart - self.rateStart >= 1.0:
+            self.frameRateGauge.set(self.rateFrames / (frameStart - self.rateStart))
+            self.rateFrames = 0
+            self.rateStart = frameStart
+        return True
+
+    def stopEffect(self):
+        """
+        Leaves the static buffer on the LEDs once an effect is over or replaced
+        """
+        self.rateStart = None
+        self.rateFrames = 0
+        self.frameRateGauge.set(0)
+        self.setEffectRate(self.maxFrameRate)
         self.setLEDs(None)
-        self.setLEDs(pulseColor)
-        time.sleep(float(t))
-        self.setLEDs(pulseColor)
-        self.setLEDs(None)
+
+    def setGlow(self, glow=None):
+        """
+        Sets the background color of the waves. Defaults to the glow of the LEDs
+        """
+        if not glow:
+            glow = self.glow
+        self.redGlow.update(glow[0])
+        self.greenGlow.update(glow[1])
+        self.blueGlow.update(glow[2])
 
     def chaseLEDs(self, color, decay=1.0, ring=-1, frequency=1.0):
         """
@@ -293,26 +701,35 @@ class StatusLED:
         :param frequency: how many turns per second. Defaults to 1
         :return: None
         """
+        self.runEffect(self.chaseLEDsRenderer(color, decay, ring, frequency))
+
+    def chaseLEDsRenderer(self, color, decay=1.0, ring=-1, frequency=1.0):
+        """
+        Sets up chaseLEDs
+        :return: the renderFrame of the effect
+        """
+        self.setGlow()
         self.redIntensity.update(color[0])
         self.greenIntensity.update(color[1])
         self.blueIntensity.update(color[2])
 
         self.frequency.update(frequency)
         self.decay.update(decay)
+        # Fast enough for the steepest part of the decay and for the head to go through every LED
+        self.setEffectRate(lambda: max(self.colorRange() * self.decay() / SMOOTH_STEP,
+                                       self.ringsLEDs[ring] * self.frequency()))
 
         waveIntensity = copy.copy(self.intensity)
+        red, green, blue = self.decayWaves(ring)
+        start = self.ringStart
+        stop = start + self.ringsLEDs[ring]
 
-        while self.effectQueue.empty():
+        def renderFrame():
             self.clock.update()
-            for led in range(self.ringsLEDs[ring]):
-                self.noPiBasedPhase.update(led, self.ringsLEDs[ring])
-                waveIntensity[self.ringStart + led] = (self.red_decayWave(),
-                                                       self.green_decayWave(),
-                                                       self.blue_decayWave())
-            self.setLEDs(waveIntensity)
-            # time.sleep(0.1)
+            waveIntensity[start:stop] = zip(red().tolist(), green().tolist(), blue().tolist())
+            return waveIntensity
 
-        self.setLEDs(None)
+        return renderFrame
 
     def chaseLEDsTimer(self, chaseColor, timerColor, decay=1.0, chaseRing=-1, timerRing=-2, speed=1.0, frequency=1.0):
         """
@@ -324,6 +741,16 @@ class StatusLED:
         :param frequency: how many turns per second. Defaults to 1
         :return: None
         """
+        self.runEffect(self.chaseLEDsTimerRenderer(chaseColor, timerColor, decay, chaseRing, timerRing,
+                                                   speed, frequency))
+
+    def chaseLEDsTimerRenderer(self, chaseColor, timerColor, decay=1.0, chaseRing=-1, timerRing=-2, speed=1.0,
+                               frequency=1.0):
+        """
+        Sets up chaseLEDsTimer
+        :return: the renderFrame of the effect
+        """
+        self.setGlow()
         self.redIntensity.update(chaseColor[0])
         self.greenIntensity.update(chaseColor[1])
         self.blueIntensity.update(chaseColor[2])
@@ -336,35 +763,34 @@ class StatusLED:
         self.decay.update(decay)
         self.timer.update(0.0)
         self.duty.update(1 / self.ringsLEDs[timerRing])
+        self.speed.update(speed)
+
+        # The clock runs speed times faster for this effect
+        self.setEffectRate(lambda: self.speed() * max(self.colorRange() * self.decay() / SMOOTH_STEP,
+                                                      self.ringsLEDs[chaseRing] * self.frequency()))
 
         # TODO: fix rings start point
         chaseStartLED = self.ringStart
         timerStartLED = self.ringStart + self.ringsLEDs[chaseRing]
 
+        chaseStopLED = chaseStartLED + self.ringsLEDs[chaseRing]
+        timerStopLED = timerStartLED + self.ringsLEDs[timerRing]
+
         waveIntensity = copy.copy(self.intensity)
+        chaseRed, chaseGreen, chaseBlue = self.decayWaves(chaseRing)
+        timerRed, timerGreen, timerBlue = self.timerWaves(timerRing)
 
-        while self.effectQueue.empty():
-            self.clock.update(speed)
-            if not self.timerQueue.empty():
-                self.timer.update(float(self.timerQueue.get(block=False)))
-
-            for led in range(self.ringsLEDs[chaseRing]):
-                self.noPiBasedPhase.update(led, self.ringsLEDs[chaseRing])
-                waveIntensity[chaseStartLED + led] = (self.red_decayWave(),
-                                                       self.green_decayWave(),
-                                                       self.blue_decayWave())
-            for led in range(self.ringsLEDs[timerRing]):
-                self.noPiBasedPhase.update(led, self.ringsLEDs[timerRing])
-                waveIntensity[timerStartLED + led] = (self.red_timerWave(),
-                                                      self.green_timerWave(),
-                                                      self.blue_timerWave())
-            self.setLEDs(waveIntensity)
-            # time.sleep(0.1)
-
-        while not self.timerQueue.empty():
-            self.timerQueue.get()
+        def renderFrame():
+            self.clock.update(self.speed())
+            self.timer.update(self.timerSlot.get())
 
-        self.setLEDs(None)
+            waveIntensity[chaseStartLED:chaseStopLED] = zip(chaseRed().tolist(), chaseGreen().tolist(),
+                                                            chaseBlue().tolist())
+            waveIntensity[timerStartLED:timerStopLED] = zip(timerRed().tolist(), timerGreen().tolist(),
+                                                            timerBlue().tolist())
+            return waveIntensity
+
+        return renderFrame
 
     def sineBeat(self, color, glow=None, frequency=1.0):
         """
@@ -374,38 +800,33 @@ class StatusLED:
         :param frequency: how many oscilaitons per second. Defaults to 1
         :return: None
         """
-        curGlow = 0
-
-        if glow:
-            curGlow = self.glow
-            self.redGlow.update(glow[0])
-            self.greenGlow.update(glow[1])
-            self.blueGlow.update(glow[2])
+        self.runEffect(self.sineBeatRenderer(color, glow, frequency))
 
+    def sineBeatRenderer(self, color, glow=None, frequency=1.0):
+        """
+        Sets up sineBeat
+        :return: the renderFrame of the effect
+        """
+        self.setGlow(glow)
         self.redIntensity.update(color[0])
         self.greenIntensity.update(color[1])
         self.blueIntensity.update(color[2])
 
         self.frequency.update(frequency)
-        self.piBasedPhase.update(0, 1)
+        # The steepest slope of a sine between glow and color, in levels per second
+        self.setEffectRate(lambda: pi * self.frequency() * self.colorRange() / SMOOTH_STEP, continuous=True)
 
         waveIntensity = copy.copy(self.intensity)
 
-        while self.effectQueue.empty():
+        def renderFrame():
             self.clock.update()
             for led in range(self.totalLEDs):
                 waveIntensity[self.ringStart + led] = (self.red_sineWave(),
                                                        self.green_sineWave(),
                                                        self.blue_sineWave())
-            self.setLEDs(waveIntensity)
-            # time.sleep(0.1)
-
-        if curGlow:
-            self.redGlow.update(curGlow[0])
-            self.greenGlow.update(curGlow[1])
-            self.blueGlow.update(curGlow[2])
+            return waveIntensity
 
-        self.setLEDs(None)
+        return renderFrame
 
     def squareBeat(self, color, glow=None, frequency=1.0, duty=.5):
         """
@@ -416,46 +837,128 @@ class StatusLED:
         :param duty: duty of the beat. Fraction of on time
         :return: None
         """
-        curGlow = 0
-
-        if glow:
-            curGlow = self.glow
-            self.redGlow.update(glow[0])
-            self.greenGlow.update(glow[1])
-            self.blueGlow.update(glow[2])
+        self.runEffect(self.squareBeatRenderer(color, glow, frequency, duty))
 
+    def squareBeatRenderer(self, color, glow=None, frequency=1.0, duty=.5):
+        """
+        Sets up squareBeat
+        :return: the renderFrame of the effect
+        """
+        self.setGlow(glow)
         self.redIntensity.update(color[0])
         self.greenIntensity.update(color[1])
         self.blueIntensity.update(color[2])
 
         self.frequency.update(frequency)
         self.duty.update(duty)
-        self.piBasedPhase.update(0, 1)
+        # A square wave only changes on its edges, which must not jitter much against its shortest phase
+        def squareRate():
+            shortestPhase = min(self.duty(), 1 - self.duty()) / self.frequency()
+            return EDGE_FRAMES / shortestPhase if shortestPhase > 0 else self.minFrameRate
+        self.setEffectRate(squareRate)
 
         waveIntensity = copy.copy(self.intensity)
 
-        while self.effectQueue.empty():
+        def renderFrame():
             self.clock.update()
             for led in range(self.totalLEDs):
                 waveIntensity[self.ringStart + led] = (self.red_squareWave(),
                                                        self.green_squareWave(),
                                                        self.blue_squareWave())
-            self.setLEDs(waveIntensity)
+            return waveIntensity
 
-        if curGlow:
-            self.redGlow.update(curGlow[0])
-            self.greenGlow.update(curGlow[1])
-            self.blueGlow.update(curGlow[2])
+        return renderFrame
 
-        self.setLEDs(None)
+    def claimRegions(self):
+        self.frameRegions = [self.frameBuffer.claim(region) for region in self.regions]
 
     def setLEDs(self, intensity):
+        """
+        Draws our regions of intensity, or of the static buffer if None, into the frame buffer
+        and sends the composed frame
+        """
         if intensity is None:
-            self.client.put_pixels(self.intensity)
-            self.client.put_pixels(self.intensity)
-        else:
-            self.client.put_pixels(intensity)
-            self.client.put_pixels(intensity)
+            intensity = self.intensity
+        if self.frameRegions is None:
+            self.claimRegions()
+        for region in self.frameRegions:
+            region.write(intensity[region.start:region.stop])
+        self.sendFrame()
+
+    def sendFrame(self):
+        self.sentVersion = self.frameBuffer.version()
+        frame = self.frameBuffer.frame()
+        sendStart = time.monotonic()
+        sent = self.client.put_pixel_bytes(frame)
+        sent = self.client.put_pixel_bytes(frame) and sent
+        self.sendTime.observe(time.monotonic() - sendStart)
+        self.framesSent.inc()
+        if not sent:
+            self.sendFailures.inc()
+
+        # Only a frame the effect of the command rendered counts, not the static buffer sent before it
+        if self.pendingCommand is not None and 'rendered' in self.pendingCommand[1]:
+            self.recordTransition()
+
+    def startCommand(self, command, trace):
+        """
+        Keep track of a command so we can measure the time until its first frame is sent
+        :param command: the name of the command
+        :param trace: a dictionary of time points of the command on the monotonic clock.
+        'enqueued' is when it was posted. 'received' and 'decoded' are there if a status caused it
+        """
+        trace = dict(trace) if trace else {}
+        trace['dequeued'] = time.monotonic()
+        self.pendingCommand = (command, trace)
+        self.command = command
+        self.liveParameters = {}
+        # The waves of a new command start from the beginning. They keep going when its effect restarts
+        self.clock.reset()
+
+    def endCommand(self):
+        # A command that never sent a frame has nothing to measure
+        self.pendingCommand = None
+        self.command = None
+
+    def recordTransition(self):
+        command, trace = self.pendingCommand
+        self.pendingCommand = None
+        trace['sent'] = time.monotonic()
+        if 'enqueued' in trace:
+            latency = trace['sent'] - trace['enqueued']
+            self.transitionLatencies.append((command, latency))
+            self.transitionLatency.observe(latency)
+        for stage, start, end in LATENCY_STAGES:
+            if start in trace and end in trace:
+                self.stageLatency[stage].observe(trace[end] - trace[start])
+
+    def reportLatencies(self):
+        """
+        Log the time it took for the recent commands to show on the LEDs
+        """
+        if not self.transitionLatencies:
+            return
+        latencies = [latency for _, latency in self.transitionLatencies]
+        lines = [f'Command to first frame over {len(latencies)} transitions: '
+                 f'mean {1000 * sum(latencies) / len(latencies):.1f} ms, max {1000 * max(latencies):.1f} ms']
+        for stage, histogram in self.stageLatency.items():
+            if histogram.count:
+                percentiles = ', '.join(f'p{100 * q:g} {1000 * histogram.quantile(q):.3f} ms' for q in LATENCY_QUANTILES)
+                lines.append(f'  {stage}: {percentiles}')
+        # A single record, so the report is not cut by the rate limit
+        logger.info('%s', '\n'.join(lines))
+
+    def refreshFrame(self):
+        """
+        Sends the frame again if another producer changed its regions since we last sent it
+        """
+        if self.sentVersion != self.frameBuffer.version():
+            self.sendFrame()
+
+    def close(self):
+        self.client.disconnect()
+        if self.privateFrameBuffer:
+            self.frameBuffer.close()
 
     def setRing(self, ring, col):
         for i in range(self.ringsLEDs[ring]):
@@ -534,11 +1037,11 @@ if __name__ == '__main__':
     OPC_HOST = '127.0.0.1'
     OPC_PORT = '7890'
 
-    timerQueue = Queue()
-    effectQueue = Queue()
+    timerSlot = LatestValue()
+    effectQueue = CommandQueue()
 
     LEDs = StatusLED(effectQueue=effectQueue,
-                     timerQueue=timerQueue,
+                     timerSlot=timerSlot,
                      totalLEDs=TOTAL_LEDS,
                      ringStart=RING_START,
                      ringsLEDs=RING_LEDS,
@@ -548,11 +1051,15 @@ if __name__ == '__main__':
                      port=OPC_PORT,)
 
     def runEffects():
+        LEDs.claimRegions()
         while True:
-            f, args = effectQueue.get()
+            f, args, trace = effectQueue.get()
             if f != 'kill':
+                LEDs.startCommand(f, trace)
                 getattr(LEDs, f)(*args)
+                LEDs.endCommand()
             else:
+                LEDs.reportLatencies()
                 return
 
     def on_enter_idle():
@@ -560,14 +1067,16 @@ if __name__ == '__main__':
                          ([80, 150, 80],  # color
                           [150, 80, 80],  # glow
                           .2  # frequency
-                          )])
+                          ),
+                         {'enqueued': time.monotonic()}])
 
     def on_snap():
         effectQueue.put(['multiplePulse',
                          ([[[0, 0, 128], 0.3],
                            [[0, 128, 0], 0.8],
                            [[200, 0, 0], 0.1]
-                           ], -1)])
+                           ], -1),
+                         {'enqueued': time.monotonic()}])
 
     def on_error():
         effectQueue.put(['squareBeat',
@@ -575,9 +1084,11 @@ if __name__ == '__main__':
                           [20, 0, 0],  # glow
                           1.5,  # frequency
                           .2  # duty
-                          )])
+                          ),
+                         {'enqueued': time.monotonic()}])
 
     def on_experiment():
+        timerSlot.set(0.0)
         effectQueue.put(['chaseLEDsTimer',
                          ([128, 20, 20],  #chase color
                           [0, 128, 128],  #timer color
@@ -586,10 +1097,8 @@ if __name__ == '__main__':
                           -2, # timer ring
                           2, # speed
                           2 # frequency
-                          )])
-
-        while not timerQueue.empty():  # Clean the timer queue in case things go to quick or we abort
-            timerQueue.get(block=False)
+                          ),
+                         {'enqueued': time.monotonic()}])
 
     def on_start():
         pass
@@ -601,9 +1110,7 @@ if __name__ == '__main__':
         pass
 
     def on_terminate():
-        effectQueue.put(['kill', None])
-        while not timerQueue.empty():  # Clean the timer queue
-            timerQueue.get(block=False)
+        effectQueue.put(['kill', None, None])
 
 
 
@@ -630,7 +1137,7 @@ if __name__ == '__main__':
 
     for t in range(16):
         timer = t / 16
-        timerQueue.put(timer)
+        timerSlot.set(timer)
         time.sleep(.5)
 
     on_error()
@@ -642,5 +1149,6 @@ if __name__ == '__main__':
     print('terminated')
 
     p.join()
+    LEDs.close()
     print('joined and finished')
 
@@ -0,0 +1,129 @@
+"""This module defines the status messages sent by the RT-host and FPGA.
+
+A status can travel in two formats:
+- JSON: an object with the keys in JSON_KEYS and every value encoded as a string.
+  This is what the RT-host has always sent and remains the fallback.
+- Binary: a fixed layout packed with BINARY_STATUS. A version byte, the main and action
+  state codes and the timer as a float. It holds no 'Other Status Elements'.
+
+Both are decoded into a FPGAStatusRecord so the receivers compare plain integers and floats.
+
+The status go to a host and port. When the host is a multicast group, e.g. 239.255.66.66, the RT-host
+sends a single stream that any number of consumers on the LAN or on the same host receive: light
+controllers, loggers, dashboards.
+"""
+from collections import namedtuple
+import ipaddress
+import json
+import socket
+import struct
+
+MainFPGA_to_FSMachine_state = {
+    0: 'default',     # Default
+    1: 'start',       # Start
+    2: 'configure',   # Configuring
+    3: 'idle',        # Idle
+    4: 'error',       # Aborted
+    5: 'action',      # Running Action
+    6: 'shutdown',    # Shutdown
+}
+
+ActionFPGA_to_FSMachine_state = {
+    0: 'default',     # Default
+    1: 'experiment',  # Executing Experiment
+    2: 'prepare',     # Transferring Digitals
+    3: 'prepare',     # Transferring Analogues
+    4: 'prepare',     # Writing Indexes
+    5: 'prepare',     # Writing Digitals
+    6: 'prepare',     # Writing Analogue
+    7: 'snap',        # Taking Snap
+    8: 'prepare',     # Flushing FIFOs
+    9: 'prepare',     # Updating Repetitions
+    10: 'mosaic',     # Running Slow Mosaic
+    11: 'mosaic',     # Running Fast Mosaic
+}
+
+FPGAStatusRecord = namedtuple('FPGAStatusRecord', ['mainState', 'actionState', 'timer', 'other'])
+
+## The keys of the JSON status for every field of the record
+JSON_KEYS = {
+    'mainState': 'FPGA Main State',
+    'actionState': 'Action State',
+    'timer': 'Timer',
+    'other': 'Other Status Elements',
+}
+
+## Multicast status: hops they go through, 1 keeps them on the LAN, and the interface they are sent and
+## received on, the IPv4 address of a local interface. 0.0.0.0 lets the kernel pick it from the routes
+MULTICAST_TTL = 1
+MULTICAST_INTERFACE = '0.0.0.0'
+
+## version, main state, action state, padding, timer
+BINARY_STATUS = struct.Struct('!BBBxf')
+BINARY_VERSION = 1
+
+
+def is_multicast(host):
+    """
+    Returns True if host is an IPv4 multicast group address
+    """
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False  # A host name
+    return address.version == 4 and address.is_multicast
+
+
+def multicast_request(group, interface=MULTICAST_INTERFACE):
+    """
+    Returns the struct ip_mreq to join or leave a multicast group on an interface
+    """
+    return socket.inet_aton(group) + socket.inet_aton(interface)
+
+
+def status_from_dict(status):
+    """
+    Converts a JSON status dictionary into a FPGAStatusRecord
+    Raises ValueError if the dictionary is not a valid status
+    """
+    try:
+        return FPGAStatusRecord(mainState=int(status[JSON_KEYS['mainState']]),
+                                actionState=int(status[JSON_KEYS['actionState']]),
+                                timer=float(status[JSON_KEYS['timer']]),
+                                other=status.get(JSON_KEYS['other']),
+                                )
+    except (KeyError, TypeError, AttributeError) as e:
+        raise ValueError(f'Invalid status: {status}') from e
+
+
+def status_to_dict(record):
+    """
+    Converts a FPGAStatusRecord into a JSON status dictionary with the values encoded as strings
+    """
+    status = {JSON_KEYS['mainState']: str(record.mainState),
+              JSON_KEYS['actionState']: str(record.actionState),
+              JSON_KEYS['timer']: str(record.timer),
+              }
+    if record.other is not None:
+        status[JSON_KEYS['other']] = record.other
+    return status
+
+
+def encode_json(record):
+    return json.dumps(status_to_dict(record)).encode()
+
+
+def encode_binary(record):
+    return BINARY_STATUS.pack(BINARY_VERSION, record.mainState, record.actionState, record.timer)
+
+
+def decode_status(datagram):
+    """
+    Decodes a binary or JSON status datagram into a FPGAStatusRecord
+    Raises ValueError if the datagram is not a valid status
+    """
+    if len(datagram) == BINARY_STATUS.size and datagram[0] == BINARY_VERSION:
+        _, mainState, actionState, timer = BINARY_STATUS.unpack(datagram)
+        return FPGAStatusRecord(mainState, actionState, timer, None)
+
+    return status_from_dict(json.loads(datagram.decode()))
@@ -3,19 +3,49 @@ In this module we create a state machine to follow the state of the executor and
 Raspberry. The current setup wil manage the status lights.
 """
 from multiprocessing import Process, Queue
-from transitions.extensions import HierarchicalMachine as Machine
-from time import sleep
-import json
+from collections import Counter, namedtuple
+from datetime import datetime
+from queue import Empty
+from time import monotonic, time
+import argparse
+import selectors
 import socket
+import struct
 import logging
-
-from LEDs import StatusLED
-
-## TODO: get status led and UDP config from file
+import os
+import threading
+
+from asynclog import setup_logging
+from LEDs import StatusLED, MIN_FRAME_RATE
+from sharedstate import CommandQueue, LatestValue
+from framebuffer import SharedFrameBuffer
+from history import HISTORY_SIZE, StatusHistory, prune_dumps
+from metrics import MetricsServer, Registry
+from query import QUERY_SOCKET, QueryServer
+from config import Config, ConfigWatcher, load_config, validate_effect
+import statemachine
+from StatusMessage import MainFPGA_to_FSMachine_state, ActionFPGA_to_FSMachine_state, JSON_KEYS, FPGAStatusRecord, \
+    MULTICAST_INTERFACE, decode_status, is_multicast, multicast_request
+
+logger = logging.getLogger(__name__)
+
+## The configuration file. Its settings override the defaults below, see config.py for the format.
+## It is reloaded while running whenever it changes
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'statusled.json')
 
 UDP_IP_ADDRESS = "localhost"
 UDP_PORT_NO = 6666
 FPGA_UPDATE_RATE = .1  # At which rate is the FPGA sending update status signals
+STATUS_TIMEOUT = 10 * FPGA_UPDATE_RATE  # Silence after which we consider the link to the FPGA lost
+MAX_DATAGRAM_SIZE = 65535
+COALESCE_STATUS = True  # Only act on the newest status of a burst, keeping the state changes
+## Where the history of the status is dumped when the machine enters the error state, away from the code
+HISTORY_DIR = os.path.join(os.environ.get('XDG_STATE_HOME') or os.path.expanduser('~/.local/state'),
+                           'statusled', 'history')
+
+## Ask the kernel to timestamp the status datagrams when they arrive. Python does not expose the Linux constant
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35)
+TIMESPEC = {8: struct.Struct('ii'), 16: struct.Struct('qq')}  # struct timespec on 32 and 64 bit systems
 
 
 RING_START = (512 - 64)
@@ -28,6 +58,42 @@ CABINET_LEDS = 30
 OPC_HOST = '127.0.0.1'
 OPC_PORT = '7890'
 
+## A rig followed by a StatusService: where its FPGA sends the status, where its OPC server is and its ring layout.
+## host can be a multicast group, joined on the local interface with the address interface
+RigConfig = namedtuple('RigConfig', ['name', 'host', 'port', 'opcHost', 'opcPort',
+                                     'ringStart', 'ringLEDs', 'cabinetStart', 'cabinetLEDs', 'interface'],
+                       defaults=[OPC_HOST, OPC_PORT, RING_START, RING_LEDS, CABINET_START, CABINET_LEDS,
+                                 MULTICAST_INTERFACE])
+
+## The rigs this controller follows by default. A single rig runs as before, more are served by one StatusService
+RIGS = [RigConfig(name='deepsim', host=UDP_IP_ADDRESS, port=UDP_PORT_NO)]
+FRAME_RATE = 60.0  # Max frames per second of the effects. Slower effects are drawn at a lower rate
+
+## The frame sent to the OPC server lives in shared memory. Other producer processes can attach to it by
+## name and draw the regions the status LEDs leave to them
+FRAME_BUFFER_NAME = 'StatusLED_frame'
+FRAME_PIXELS = 512
+FRAME_REGIONS = {'ring': (RING_START, TOTAL_LEDS),
+                 'cabinet': (CABINET_START, CABINET_LEDS)}
+STATUS_LED_REGIONS = ('ring', 'cabinet')  # Remove 'cabinet' to drive the cabinet lighting from another process
+FRAME_REFRESH_PERIOD = .1  # How often an idle LED process checks for frames drawn by other producers
+
+
+def frame_regions(rig):
+    """
+    Returns the regions of the frame buffer of a rig
+    """
+    return {'ring': (rig.ringStart, sum(rig.ringLEDs)),
+            'cabinet': (rig.cabinetStart, rig.cabinetLEDs)}
+
+## The state machine behind FSMachine: 'transitions', the HierarchicalMachine of the transitions library,
+## or 'builtin', the table-driven machine of statemachine.py that starts faster and transitions cheaper
+FSM_BACKEND = 'transitions'
+
+## Where the runtime metrics are served
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9750
+
 STATES = ['default',
           'start',
           'configure',
@@ -42,6 +108,22 @@ STATES = ['default',
           'shutdown',
           ]
 
+
+def state_names(states, parent=None):
+    """
+    Returns the names of all the states, the nested ones named parent_child like the machine does
+    """
+    names = []
+    for state in states:
+        children = []
+        if isinstance(state, dict):
+            state, children = state['name'], state.get('children', [])
+        name = parent + '_' + state if parent else state
+        names.append(name)
+        names.extend(state_names(children, name))
+    return names
+
+
 TRANSITIONS = [
     ['on_default',           '*',            'default'],
     ['on_start',             'shutdown',     'start'],
@@ -55,29 +137,28 @@ TRANSITIONS = [
     ['on_shutdown',          '*',            'shutdown'],
 ]
 
-MainFPGA_to_FSMachine_state = {
-    '0': 'default',     # Default
-    '1': 'start',       # Start
-    '2': 'configure',   # Configuring
-    '3': 'idle',        # Idle
-    '4': 'error',       # Aborted
-    '5': 'action',      # Running Action
-    '6': 'shutdown',    # Shutdown
-}
-
-ActionFPGA_to_FSMachine_state = {
-    '0': 'default',     # Default
-    '1': 'experiment',  # Executing Experiment
-    '2': 'prepare',     # Transferring Digitals
-    '3': 'prepare',     # Transferring Analogues
-    '4': 'prepare',     # Writing Indexes
-    '5': 'prepare',     # Writing Digitals
-    '6': 'prepare',     # Writing Analogue
-    '7': 'snap',        # Taking Snap
-    '8': 'prepare',     # Flushing FIFOs
-    '9': 'prepare',     # Updating Repetitions
-    '10': 'mosaic',     # Running Slow Mosaic
-    '11': 'mosaic',     # Running Fast Mosaic
+## The StatusLED effect shown on every command of the machine and its parameters.
+## Commands left out leave the LEDs on their static buffer
+COMMAND_EFFECTS = {
+    # Idle: a slow white heart beat
+    'on_enter_idle': ('sineBeat', {'color': [50, 50, 50],
+                                   'glow': [20, 20, 20],
+                                   'frequency': 1.0}),
+    # Error: blinks red
+    'on_enter_error': ('squareBeat', {'color': [150, 0, 0],
+                                      'glow': [50, 0, 0],
+                                      'frequency': 2,
+                                      'duty': .3}),
+    # Experiment: a chase on the outer ring and the progress of the timer on the next one
+    'on_enter_action_experiment': ('chaseLEDsTimer', {'chaseColor': [128, 0, 0],
+                                                      'timerColor': [0, 128, 0],
+                                                      'decay': 8.0,
+                                                      'chaseRing': -1,
+                                                      'timerRing': -2,
+                                                      'speed': 2,
+                                                      'frequency': 1}),
+    # Image snap: a blue flash
+    'on_enter_action_snap': ('multiplePulse', {'pattern': [[[0, 0, 255], 0.005]]}),
 }
 
 
@@ -87,22 +168,43 @@ class FSMachine:
     The actions are running as separate processes and 
     there is a main loop getting status from the executor through a UDP socket and triggering the transitions"""
     # Define a State Machine
-    def __init__(self, states, transitions, timerQueue, effectQueue, initialState='start'):
+    def __init__(self, states, transitions, timerSlot, effectQueue, frameBuffer, metrics, initialState='start',
+                 startLEDs=True, controlQueue=None, backend=FSM_BACKEND):
+        if backend == 'builtin':
+            Machine = statemachine.TableMachine
+            self.MachineError = statemachine.MachineError
+        elif backend == 'transitions':
+            # Imported here so the builtin backend does not pay for importing the library
+            from transitions import MachineError
+            from transitions.extensions import HierarchicalMachine as Machine
+            self.MachineError = MachineError
+            # It logs every callback of every transition at the info level
+            logging.getLogger('transitions').setLevel(logging.WARNING)
+        else:
+            raise ValueError(f'Unknown state machine backend {backend}')
         self.machine = Machine(model=self,
                                states=states,
                                transitions=transitions,
                                initial=initialState,
                                auto_transitions=False)
 
-        # Create queues to pass state and time point
-        self.timerQueue = timerQueue
+        # A queue to pass the effects and a shared slot for the time point
+        self.timerSlot = timerSlot
         self.effectQueue = effectQueue
 
-        ## Create separate processes to run stuff and start them
+        # Time points of the status causing the current transition, if any
+        self.trace = None
+
+        self.commandsPosted = metrics.counter('statusled_commands_posted_total', 'Commands posted to the LED process')
+
+        ## Create separate processes to run stuff and start them. The rigs of a StatusService share its scheduler
+        self.statusLEDs = None
+        if not startLEDs:
+            return
 
         # A status LED processor
         self.statusLEDs = StatusLEDProcessor(effectQueue=self.effectQueue,
-                                             timerQueue=self.timerQueue,
+                                             timerSlot=self.timerSlot,
                                              totalLEDs=TOTAL_LEDS,
                                              ringStart=RING_START,
                                              ringLEDs=RING_LEDS,
@@ -110,152 +212,749 @@ class FSMachine:
                                              cabinetLEDs=CABINET_LEDS,
                                              host=OPC_HOST,
                                              port=OPC_PORT,
+                                             frameBuffer=frameBuffer,
+                                             regions=STATUS_LED_REGIONS,
+                                             metrics=metrics,
+                                             controlQueue=controlQueue,
                                              )
         self.statusLEDs.start()
 
+    def post(self, command, *args):
+        """
+        Post a command to the LED process, stamped with the time it was posted
+        and the time points of the status that caused it
+        """
+        trace = dict(self.trace) if self.trace else {}
+        trace['enqueued'] = monotonic()
+        self.effectQueue.put([command, args, trace])
+        self.commandsPosted.inc()
+
     # Configure the callbacks of the machine
     def on_enter_start(self):
-        self.effectQueue.put(['on_enter_start', ()])
+        self.post('on_enter_start')
 
     def on_enter_configure(self):
-        self.effectQueue.put(['on_enter_configure', ()])
+        self.post('on_enter_configure')
 
     def on_enter_idle(self):
-        self.effectQueue.put(['on_enter_idle', ()])
+        self.post('on_enter_idle')
 
     def on_enter_error(self):
-        self.effectQueue.put(['on_enter_error', ()])
+        self.post('on_enter_error')
 
     def on_enter_action_experiment(self):
-        self.effectQueue.put(['on_enter_action_experiment', ()])
+        self.timerSlot.set(0.0)  # Do not show the progress of the previous experiment
+        self.post('on_enter_action_experiment')
 
     def on_enter_action_prepare(self):
-        self.effectQueue.put(['on_enter_action_prepare', ()])
+        self.post('on_enter_action_prepare')
 
     def on_enter_action_snap(self):
-        self.effectQueue.put(['on_enter_action_snap', ()])
+        self.post('on_enter_action_snap')
 
     def on_enter_action_mosaic(self):
-        self.effectQueue.put(['on_enter_action_mosaic', ()])
+        self.post('on_enter_action_mosaic')
 
     def on_enter_shutdown(self):
-        self.effectQueue.put(['on_enter_shutdown', ()])
+        self.post('on_enter_shutdown')
 
     def on_kill(self):
-        self.effectQueue.put(['kill', ()])
-        while not self.timerQueue.empty():  # Clean the timer queue
-            self.timerQueue.get(block=False)
+        self.post('kill')
+
+
+## The commands the machine posts, the ones the configuration can give an effect
+MACHINE_COMMANDS = tuple(name for name in dir(FSMachine) if name.startswith('on_enter_'))
+
+## The configuration when there is no configuration file, and the one the file overrides
+DEFAULT_CONFIG = Config(rigs=tuple(RIGS), effects=COMMAND_EFFECTS, frameRate=FRAME_RATE, minFrameRate=MIN_FRAME_RATE,
+                        coalesce=COALESCE_STATUS)
+
+
+def load_status_config(path=CONFIG_FILE):
+    """
+    Reads the configuration file. Returns the default configuration if there is none.
+    Raises ValueError if the file is not valid
+    """
+    if not os.path.exists(path):
+        return DEFAULT_CONFIG
+    return load_config(path, DEFAULT_CONFIG, commands=MACHINE_COMMANDS, totalPixels=FRAME_PIXELS)
 
 
-class FPGAStatus:
-    def __init__(self, host, port):
-        ## Create a dictionary to store the full FPGA state
-        self.currentFPGAStatus = {}
+class RigCommandQueue:
+    """
+    Posts the commands of the machine of one rig to the queue of the StatusLEDScheduler, tagged with the rig
+    """
+    def __init__(self, queue, rig):
+        self.queue = queue
+        self.rig = rig
 
-        ## Create the queues to communicate with the FSM
-        self.timerQueue = Queue()
-        self.effectQueue = Queue()
+    def put(self, command):
+        self.queue.put((self.rig, command))
 
-        ## Create the FSM
-        self.machine = FSMachine(states=STATES,
-                                 transitions=TRANSITIONS,
-                                 timerQueue=self.timerQueue,
-                                 effectQueue=self.effectQueue,
-                                 )
+    def qsize(self):
+        return self.queue.qsize()
 
-        ## create a socket to listen
-        self.socket = self.createReceiveSocket(host, port)
 
-        ## Create a handle to stop the thread
+class EventLoop:
+    """
+    Waits on sockets with a selector and calls their handler as soon as they are readable, until stop() is called.
+    The wakeup pair lets stop() interrupt a pending select. A StatusService runs the sockets of all its rigs in one
+    """
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self._wakeupReceiver, self._wakeupSender = socket.socketpair()
+        self._wakeupReceiver.setblocking(False)
+        self.selector.register(self._wakeupReceiver, selectors.EVENT_READ, self.handle_wakeup)
         self.shouldRun = True
 
-    def createReceiveSocket(self, host, port):
+    def register(self, sock, handler):
+        """
+        Calls handler() whenever sock is readable
+        """
+        self.selector.register(sock, selectors.EVENT_READ, handler)
+
+    def unregister(self, sock):
+        self.selector.unregister(sock)
+
+    def handle_wakeup(self):
+        """
+        Called by the selector when stop() wants to interrupt the loop
+        """
+        try:
+            while self._wakeupReceiver.recv(64):
+                pass
+        except BlockingIOError:
+            pass
+
+    def run(self, *checks):
+        """
+        Runs the handlers of the sockets until stop() is called.
+        :checks: callables run on every turn of the loop. Each returns the time in seconds until it has to run again
+        """
+        while self.shouldRun:
+            timeout = min((check() for check in checks), default=None)
+            for key, _ in self.selector.select(timeout=timeout):
+                key.data()
+
+    def stop(self):
+        """
+        Ask the loop to return. Can be called from another thread or a signal handler
+        """
+        self.shouldRun = False
+        try:
+            self._wakeupSender.send(b'\0')
+        except socket.error:
+            pass
+
+    def close(self):
+        self.selector.close()
+        self._wakeupReceiver.close()
+        self._wakeupSender.close()
+
+
+class StatusDispatcher:
+    """Acts on the status of the FPGA as it arrives: runs the machine transitions of the changes of state,
+    publishes the timer and calls the subscribers of the fields that changed. It keeps the history of the status
+    and tells when they stop coming. FPGAStatus feeds it from its socket, render_scenario from a scenario"""
+    def __init__(self, machine, timerSlot, metrics, coalesce=COALESCE_STATUS, rig=None, historySize=HISTORY_SIZE,
+                 historyDir=HISTORY_DIR):
+        """
+        :FSMachine machine: the machine whose transitions the changes of state run
+        :LatestValue timerSlot: where the timer of the status is published for the effects
+        :Registry metrics: the registry the metrics of the status go to
+        :bool coalesce: only act on the newest status of a burst, keeping the state changes
+        :str rig: name of the rig, when a StatusService follows several of them
+        :int historySize: number of status kept to look back at
+        :str historyDir: where the history is dumped on entering the error state. Not dumped if None
+        """
+        ## Store the full FPGA state as a FPGAStatusRecord
+        self.currentFPGAStatus = None
+        ## and the last ones with the time they were received
+        self.history = StatusHistory(historySize)
+        self.historyDir = historyDir
+        self._historyWriter = None
+        self.rig = rig
+        self.source = 'the FPGA' if rig is None else f'the FPGA of {rig}'
+        self.machine = machine
+        self.timerSlot = timerSlot
+
+        self.statusProcessed = metrics.counter('statusled_status_processed_total', 'Status acted upon')
+        self.statusCoalesced = metrics.counter('statusled_status_coalesced_total',
+                                               'Status skipped because a newer one was waiting')
+        self.processingTime = metrics.histogram('statusled_status_processing_seconds',
+                                                'Time to process a status, transitions included')
+        self.linkAliveGauge = metrics.gauge('statusled_link_alive', '1 while the FPGA is sending status')
+        self.unmappedCounter = metrics.counter('statusled_unmapped_codes_total',
+                                               'Status with state codes without a transition')
+        self.rejectedCounter = metrics.counter('statusled_rejected_transitions_total',
+                                               'Transitions rejected by the machine')
+
+        ## Resolve the machine transition of every pair of FPGA state codes once and for all
+        self.transitionTable = self.compile_transition_table(self.machine)
+        self.unmappedCodes = Counter()
+        self.rejectedTransitions = Counter()
+
+        ## Callbacks to call when a field of the status changes. Every callback gets (oldStatus, newStatus)
+        self.subscribers = {field: [] for field in FPGAStatusRecord._fields}
+        self.subscribe('mainState', self.on_state_change)
+        self.subscribe('timer', self.on_timer_change)
+
+        ## In coalesce mode we skip the intermediate status of a burst
+        self.coalesce = coalesce
+
+        ## Liveness of the link to the FPGA
+        self.lastStatusTime = monotonic()
+        self.linkAlive = False
+
+    def get_status(self, key=None):
+        """
+        Method to call from outside to get the status.
+        key can be a field of the FPGAStatusRecord or the corresponding JSON key
+        """
+        if key and self.currentFPGAStatus is not None:
+            for field, jsonKey in JSON_KEYS.items():
+                if key == jsonKey:
+                    key = field
+            try:
+                return getattr(self.currentFPGAStatus, key)
+            except AttributeError:
+                logger.warning('Key %s does not exist', key)
+        else:
+            return self.currentFPGAStatus
+
+    def subscribe(self, field, callback):
+        """
+        Call callback(oldStatus, newStatus) whenever field of the status changes.
+        oldStatus is None for the first status received
+        """
+        if field not in self.subscribers:
+            raise ValueError(f'{field} is not a status field')
+        self.subscribers[field].append(callback)
+
+    def unsubscribe(self, field, callback):
+        self.subscribers[field].remove(callback)
+
+    def changed_fields(self, oldStatus, newStatus):
+        """
+        Returns the names of the fields that differ between two status. All of them if oldStatus is None
+        """
+        if oldStatus is None:
+            return list(FPGAStatusRecord._fields)
+        return [field for field, old, new in zip(FPGAStatusRecord._fields, oldStatus, newStatus) if old != new]
+
+    def trigger_event(self, newStatus):
+        """
+        FInd 'interesting' status or state changes in the FPGA and trigger events or
+        the corresponding machine transitions.
+        Only the callbacks subscribed to the fields that changed are called, and each one only once.
+        return the newStatus but with the status reset so not to queue multiple times
+        """
+        oldStatus = self.currentFPGAStatus
+        called = []
+        for field in self.changed_fields(oldStatus, newStatus):
+            for callback in self.subscribers[field]:
+                if callback not in called:
+                    called.append(callback)
+                    callback(oldStatus, newStatus)
+
+        logger.debug('Status from %s: %s', self.source, newStatus)
+        return newStatus
+
+    @staticmethod
+    def compile_transition_table(machine):
+        """
+        Maps the state codes of the FPGA to the bound trigger of the machine transition it has to run.
+        The main states that ignore the action state are keyed on (main state code, None), whatever their
+        action state code. The action state is keyed on every (main state code, action state code) pair.
+        Codes without a matching trigger are left out and will be reported as unmapped.
+        Returns the table as a dictionary
+        """
+        table = {}
+        for mainCode, mainState in MainFPGA_to_FSMachine_state.items():
+            if mainState != 'action':
+                trigger = getattr(machine, 'on_' + mainState, None)
+                if trigger is not None:
+                    table[(mainCode, None)] = trigger
+                continue
+            for actionCode, actionState in ActionFPGA_to_FSMachine_state.items():
+                # The action sub-states are nested in the action state of the machine
+                trigger = getattr(machine, 'on_' + mainState + '_' + actionState, None)
+                if trigger is not None:
+                    table[(mainCode, actionCode)] = trigger
+        return table
+
+    @staticmethod
+    def find_transition(table, codes):
+        """
+        Returns the trigger of a table of compile_transition_table for (main state code, action state code),
+        or None if there is none
+        """
+        return table.get((codes[0], None)) or table.get(codes)
+
+    def on_state_change(self, oldStatus, newStatus):
+        """
+        Trigger the machine transition corresponding to a new main state
+        """
+        codes = (newStatus.mainState, newStatus.actionState)
+        trigger = self.find_transition(self.transitionTable, codes)
+        if trigger is None:
+            self.unmappedCodes[codes] += 1
+            self.unmappedCounter.inc()
+            logger.warning('No transition for FPGA state codes %s. Seen %d times', codes, self.unmappedCodes[codes])
+            return
+
+        state = self.machine.state
+        try:
+            trigger()
+        except self.machine.MachineError as e:
+            self.rejectedTransitions[(self.machine.state, codes)] += 1
+            self.rejectedCounter.inc()
+            logger.warning('Transition rejected: %s', e.value)
+        else:
+            if self.machine.state == 'error' and state != 'error':
+                self.dump_history()
+
+    def dump_history(self):
+        """
+        Writes the history of the status to a file of historyDir. The file is written by a background thread
+        from a copy of the history, so the loop goes on. The oldest dumps of the rig are removed.
+        Returns the path of the file, or None if there is no historyDir
+        """
+        if self.historyDir is None:
+            return None
+        prefix = f'{self.rig or "status"}-error-'
+        path = os.path.join(self.historyDir, prefix + datetime.now().strftime('%Y%m%d-%H%M%S.%f') + '.npy')
+        records = self.history.records()
+
+        def write():
+            try:
+                os.makedirs(self.historyDir, exist_ok=True)
+                self.history.dump(path, records)
+                prune_dumps(self.historyDir, prefix + '*.npy')
+            except OSError as e:
+                logger.error('Failed to dump the status history to %s. Error message: %s', path, e)
+                return
+            logger.info('History of the last %d status from %s dumped to %s', len(records), self.source, path)
+
+        self._historyWriter = threading.Thread(target=write, name='HistoryDump', daemon=True)
+        self._historyWriter.start()
+        return path
+
+    def report_transitions(self):
+        """
+        Print the state codes that could not be mapped and the transitions the machine rejected
+        """
+        for codes, count in self.unmappedCodes.items():
+            logger.info('Unmapped state codes %s from %s: %d times', codes, self.source, count)
+        for (state, codes), count in self.rejectedTransitions.items():
+            logger.info('Rejected transition for state codes %s from %s in state %s: %d times', codes, self.source, state, count)
+
+    def on_timer_change(self, oldStatus, newStatus):
+        """
+        Publish a timer update in the timer slot
+        """
+        self.timerSlot.set(newStatus.timer)
+
+    def process_status(self, newFPGAStatus, trace=None):
+        """
+        Update the current status with a newly received one, triggering events if something changed.
+        The trace of the status goes along with the commands the machine posts because of it
+        """
+        self.lastStatusTime = monotonic()
+        if not self.linkAlive:
+            logger.info('Receiving status from %s', self.source)
+            self.linkAlive = True
+            self.linkAliveGauge.set(1)
+
+        self.statusProcessed.inc()
+        if newFPGAStatus != self.currentFPGAStatus:
+            # Trigger a transition and update current state. The first status we get takes the machine
+            # to the state the FPGA is already in
+            self.machine.trace = trace
+            self.currentFPGAStatus = self.trigger_event(newStatus=newFPGAStatus)
+            self.machine.trace = None
+        self.processingTime.observe(monotonic() - self.lastStatusTime)
+
+    def receive_statuses(self, statuses):
+        """
+        Acts on a burst of status received in one go.
+        In coalesce mode only the ones coalesce_statuses keeps are processed, but all go to the history
+        :param statuses: a list of (status, trace) in the order they arrived
+        """
+        now = monotonic()
+        for newFPGAStatus, trace in statuses:
+            self.history.append(trace['received'] if trace else now, newFPGAStatus)
+        kept = self.coalesce_statuses(statuses) if self.coalesce else statuses
+        self.statusCoalesced.inc(len(statuses) - len(kept))
+        for newFPGAStatus, trace in kept:
+            self.process_status(newFPGAStatus, trace)
+
+    def coalesce_statuses(self, statuses):
+        """
+        Collapses a burst of status into the ones we have to act on:
+        every status carrying a state change, so that no transition is lost,
+        and the newest one, which holds the latest timer and other values.
+        :param statuses: a list of (status, trace) as returned by drain_fpga_status
+        Returns the (status, trace) to act on in the order they arrived
+        """
+        kept = []
+        previous = self.currentFPGAStatus
+        for item in statuses:
+            status = item[0]
+            # The first status ever received is the one the next ones are compared against
+            if previous is None or (status.mainState != previous.mainState or
+                                    status.actionState != previous.actionState):
+                kept.append(item)
+            previous = status
+
+        if statuses and (not kept or kept[-1] is not statuses[-1]):
+            kept.append(statuses[-1])
+        return kept
+
+    def check_liveness(self):
+        """
+        Reports when the FPGA stopped sending status.
+        Returns the time in seconds until the link should be checked again
+        """
+        silence = monotonic() - self.lastStatusTime
+        if silence < STATUS_TIMEOUT:
+            return STATUS_TIMEOUT - silence
+
+        if self.linkAlive:
+            logger.warning('No status received from %s in %.1f s', self.source, silence)
+            self.linkAlive = False
+            self.linkAliveGauge.set(0)
+        return STATUS_TIMEOUT
+
+
+class FPGAStatus(StatusDispatcher):
+    def __init__(self, host, port, coalesce=COALESCE_STATUS, metricsPort=METRICS_PORT,
+                 frameBufferName=FRAME_BUFFER_NAME, rig=None, service=None, config=None, configFile=None,
+                 interface=MULTICAST_INTERFACE, historySize=HISTORY_SIZE, historyDir=HISTORY_DIR,
+                 querySocket=QUERY_SOCKET):
+        """
+        :str host: the address the status are sent to. A multicast group is joined and shared with other consumers
+        :str rig: name of the rig, when a StatusService follows several of them
+        :StatusService service: the service whose event loop and LED scheduler we share. We run on our own if None
+        :Config config: the configuration to apply on top of the defaults, e.g. from load_status_config
+        :str configFile: a configuration file to reload whenever it changes. A service watches the file itself
+        :str interface: the address of the local interface a multicast group is joined on
+        :int historySize: number of status kept to look back at
+        :str historyDir: where the history is dumped on entering the error state. Not dumped if None
+        :str querySocket: the Unix domain socket other tools query the status on. Not served if None.
+                          A service serves the status of all its rigs
+        """
+        self.service = service
+
+        ## Create the metrics before the LED process starts so it shares them. The rigs of a service label theirs
+        if service is None:
+            self.metrics = Registry()
+        else:
+            self.metrics = service.metrics.labelled(rig=rig)
+        self.datagramsReceived = self.metrics.counter('statusled_datagrams_total', 'Status datagrams received')
+        self.datagramErrors = self.metrics.counter('statusled_datagram_errors_total',
+                                                   'Datagrams that could not be received or decoded')
+
+        ## Create the queue and the timer slot to communicate with the FSM
+        timerSlot = LatestValue()
+        if service is None:
+            self.effectQueue = CommandQueue()
+            # Reaches the LED process between two frames, without stopping the running effect
+            self.controlQueue = CommandQueue()
+
+            ## Create the frame buffer shared with other LED producers
+            self.frameBuffer = SharedFrameBuffer(totalPixels=FRAME_PIXELS,
+                                                 regions=FRAME_REGIONS,
+                                                 name=frameBufferName)
+        else:
+            # The scheduler of the service draws the LEDs and owns the frame buffers of all the rigs
+            self.effectQueue = RigCommandQueue(service.commandQueue, rig)
+            self.controlQueue = None
+            self.frameBuffer = None
+
+        ## Create the FSM and act on the status with it
+        machine = FSMachine(states=STATES,
+                            transitions=TRANSITIONS,
+                            timerSlot=timerSlot,
+                            effectQueue=self.effectQueue,
+                            frameBuffer=self.frameBuffer,
+                            metrics=self.metrics,
+                            startLEDs=service is None,
+                            controlQueue=self.controlQueue,
+                            )
+        StatusDispatcher.__init__(self, machine, timerSlot, self.metrics, coalesce=coalesce, rig=rig,
+                                  historySize=historySize, historyDir=historyDir)
+
+        ## The LED process is running. If anything below fails, e.g. a port is taken, it is stopped
+        ## and what was set up is released before the error goes on
+        self.metricsServer = None
+        self.socket = None
+        self.loop = None
+        self.configWatcher = None
+        self.queryServer = None
+        try:
+            if service is None:
+                self.metrics.functionGauge('statusled_effect_queue_depth', 'Commands waiting for the LED process',
+                                           self.effectQueue.qsize)
+            ## Serve the metrics unless metricsPort is None. A service serves the metrics of all its rigs
+            if metricsPort is not None and service is None:
+                self.metricsServer = MetricsServer(self.metrics, host=METRICS_HOST, port=metricsPort)
+                self.metricsServer.start()
+
+            ## Create a socket to listen and wait on it in an event loop. The rigs of a service wait in its loop
+            self.loop = EventLoop() if service is None else service.loop
+            self.address = (host, port)
+            self.interface = interface
+            self.socket = self.createReceiveSocket(host, port, interface)
+            self.loop.register(self.socket, self.handle_datagrams)
+
+            ## Time points of the last status polled
+            self.statusTrace = None
+
+            ## Apply the configuration and follow the changes of its file
+            self.config = DEFAULT_CONFIG
+            if config is not None:
+                self.apply_config(config)
+            if configFile is not None and service is None:
+                self.configWatcher = ConfigWatcher(configFile, load_status_config, self.apply_config)
+
+            ## Serve the status to other tools unless querySocket is None. A rig without a name is the configured one
+            if querySocket is not None and service is None:
+                name = rig if rig is not None else self.config.rigs[0].name
+                self.queryServer = QueryServer({name: self}, state_names(STATES), STATUS_TIMEOUT, querySocket)
+                self.queryServer.start()
+        except BaseException:
+            self.close()
+            raise
+
+    def apply_config(self, config):
+        """
+        Swaps in a new configuration: the status socket, the coalescing and, in the LED process,
+        the layout, effects and frame rate of our rig. The running effect goes on with the new configuration
+        """
+        rigs = {rig.name: rig for rig in config.rigs}
+        rig = rigs.get(self.rig, config.rigs[0])
+
+        # The interface only matters to a multicast group, which is joined on it
+        if (rig.host, rig.port) != self.address or (is_multicast(rig.host) and rig.interface != self.interface):
+            self.rebind(rig.host, rig.port, rig.interface)
+        elif not is_multicast(rig.host):
+            self.interface = rig.interface
+        self.coalesce = config.coalesce
+        self.config = config
+
+        self.post_control('reconfigure', rig, config.effects, config.frameRate, config.minFrameRate)
+
+    def set_effect_parameters(self, **parameters):
+        """
+        Changes parameters of the effect of the current state while it runs, e.g. from a status field callback.
+        Colors, glow, frequency, decay, duty and speed apply from the next frame on, other parameters restart the effect.
+        Raises ValueError if the effect of the current state does not take them
+        """
+        command = 'on_enter_' + self.machine.state
+        if command not in self.config.effects:
+            raise ValueError(f'State {self.machine.state} has no effect')
+        effect, effectParameters = self.config.effects[command]
+        validate_effect(command, effect, {**effectParameters, **parameters}, self.config.rigs)
+        self.post_control('setParameters', command, parameters)
+
+    def post_control(self, method, *args):
+        """
+        Calls a method of the StatusLED of our rig between two frames, without stopping the running effect
+        """
+        if self.service is None:
+            self.controlQueue.put([method, args])
+        else:
+            self.effectQueue.put([method, args, None])
+
+    def rebind(self, host, port, interface=MULTICAST_INTERFACE):
+        """
+        Moves the status socket to a new address. The current socket is kept if the new one cannot be bound
+        """
+        newSocket = self.createReceiveSocket(host, port, interface)
+        if newSocket is None:
+            logger.warning('Still listening to %s on %s:%s', self.source, *self.address)
+            return
+        self.loop.unregister(self.socket)
+        self.closeReceiveSocket()
+        self.socket = newSocket
+        self.address = (host, port)
+        self.interface = interface
+        self.loop.register(self.socket, self.handle_datagrams)
+        logger.info('Listening to %s on %s:%s', self.source, host, port)
+
+    def createReceiveSocket(self, host, port, interface=MULTICAST_INTERFACE):
         """
         Creates a UDP socket meant to receive status information
-        form the RT-host
+        form the RT-host. If host is a multicast group, the socket joins it on interface
+        and other sockets of this host can receive the same status
         returns the bound socket
         """
+        multicast = is_multicast(host)
         try:
             # Create an AF_INET, Datagram socket (UDP)
             s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         except socket.error as e:
-            print(f'Failed to create socket. Error message: {e}')
+            logger.error('Failed to create socket. Error message: %s', e)
             return
 
         try:
+            if multicast:
+                # Every consumer of the group on this host binds the same port. Binding the group address
+                # rather than any address keeps out the datagrams of other groups on that port
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             # Bind Socket to local host and port
             s.bind((host, port))
+            if multicast:
+                s.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, multicast_request(host, interface))
         except socket.error as e:
-            print(f'Failed to bind address. Error message: {e}')
+            logger.error('Failed to bind address %s:%s. Error message: %s', host, port, e)
+            s.close()
             return
 
+        # We never block on the socket. The selector tells us when there is something to read
+        s.setblocking(False)
+
+        try:
+            s.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+        except socket.error as e:
+            logger.warning('No kernel timestamps on the status socket. Using the receive time. Error message: %s', e)
+
         return s
 
-    def get_status(self, key=None):
+    def closeReceiveSocket(self):
         """
-        Method to call from outside to get the status
+        Leaves the multicast group, if we joined one, and closes the status socket
         """
-        if key and self.currentFPGAStatus is not None:
+        host, _ = self.address
+        if is_multicast(host):
             try:
-                return self.currentFPGAStatus[key]
-            except:
-                print('Key does not exist')
-        else:
-            return self.currentFPGAStatus
+                self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_DROP_MEMBERSHIP,
+                                       multicast_request(host, self.interface))
+            except socket.error as e:
+                logger.warning('Failed to leave multicast group %s. Error message: %s', host, e)
+        self.socket.close()
 
     def poll_fpga_status(self):
         """
         This method polls to the UDP socket and gets the status information
-        of the RT-host and FPGA.
-        Returns a json object that we can use to update the status dictionary
+        of the RT-host and FPGA. It never blocks.
+        The RT-host sends a short datagram with the length of a JSON status before it.
+        UDP preserves the datagram boundaries so we simply skip those.
+        Returns a FPGAStatusRecord decoded from either a binary or a JSON status
+        or None if there is no status waiting in the socket.
+        The time points of the status are left in statusTrace: 'received' when the datagram
+        reached the kernel and 'decoded' when we decoded it, both on the monotonic clock
         """
-        try:
-            # Receive Datagram
-            datagramLength = int(self.socket.recvfrom(4)[0])
-            datagram = self.socket.recvfrom(datagramLength)[0]
-        except socket.error as e:
-            print(f'Failed to get Datagram. Error message: {e}')
-            return None
-        return json.loads(datagram.decode())
-
-    def trigger_event(self, newStatus):
+        while True:
+            try:
+                # Receive Datagram
+                datagram, ancillary, _, _ = self.socket.recvmsg(MAX_DATAGRAM_SIZE, socket.CMSG_SPACE(16))
+                receivedAt = self.arrival_time(ancillary)
+            except BlockingIOError:
+                return None
+            except socket.error as e:
+                self.datagramErrors.inc()
+                logger.warning('Failed to get Datagram. Error message: %s', e)
+                return None
+
+            if len(datagram) <= 4 and datagram.strip().isdigit():
+                continue  # A length header
+
+            self.datagramsReceived.inc()
+            try:
+                status = decode_status(datagram)
+            except ValueError as e:
+                self.datagramErrors.inc()
+                logger.warning('Failed to decode Datagram. Error message: %s', e)
+                return None
+            self.statusTrace = {'received': receivedAt, 'decoded': monotonic()}
+            return status
+
+    @staticmethod
+    def arrival_time(ancillary):
         """
-        FInd 'interesting' status or state changes in the FPGA and trigger events or
-        the corresponding machine transitions.
-        return the newStatus but with the status reset so not to queue multiple times
+        Converts the kernel timestamp of a datagram to the monotonic clock, the one used across processes.
+        Returns the current time if the kernel did not timestamp the datagram
         """
-        # Get a state change
-        if self.currentFPGAStatus['FPGA Main State'] != newStatus['FPGA Main State']:
-            new_state = MainFPGA_to_FSMachine_state[newStatus['FPGA Main State']]
-            # TODO: We have to generalize this into the Hierarchical SM. I do not know how to do this best
-            if new_state == 'action':
-                new_state = new_state + '_' + ActionFPGA_to_FSMachine_state[newStatus['Action State']]
-                print(new_state)
-
-            try:
-                getattr(self.machine, 'on_' + new_state)()
-            except:
-                print('Could not get that new state')
+        now = monotonic()
+        for level, kind, data in ancillary:
+            if level == socket.SOL_SOCKET and kind == SO_TIMESTAMPNS and len(data) in TIMESPEC:
+                seconds, nanoseconds = TIMESPEC[len(data)].unpack(data)
+                # The kernel stamps on the wall clock. Take away how long ago that was
+                return now - max(0.0, time() - (seconds + nanoseconds * 1e-9))
+        return now
+
+    def handle_datagrams(self):
+        """
+        Called by the selector when the socket is readable. Processes every status waiting in the socket
+        """
+        if self.coalesce:
+            self.receive_statuses(self.drain_fpga_status())
+            return
 
-        # get a timer update and post it into the timer_queue
-        if self.currentFPGAStatus['Timer'] != newStatus['Timer']:
-            self.timerQueue.put(newStatus['Timer'])
+        newFPGAStatus = self.poll_fpga_status()
+        while newFPGAStatus is not None:
+            self.receive_statuses([(newFPGAStatus, self.statusTrace)])
+            newFPGAStatus = self.poll_fpga_status()
 
-        print(newStatus)
-        return newStatus
+    def drain_fpga_status(self):
+        """
+        Reads all the status waiting in the socket in one go.
+        Returns them as a list of (status, trace) in the order they arrived
+        """
+        statuses = []
+        newFPGAStatus = self.poll_fpga_status()
+        while newFPGAStatus is not None:
+            statuses.append((newFPGAStatus, self.statusTrace))
+            newFPGAStatus = self.poll_fpga_status()
+        return statuses
 
     def run(self):
+        """
+        Main loop. Processes the status as soon as it arrives and returns once stop() is called
+        """
+        self.lastStatusTime = monotonic()
+        checks = [self.check_liveness]
+        if self.configWatcher is not None:
+            checks.append(self.configWatcher.check)
+        try:
+            self.loop.run(*checks)
+        finally:
+            self.close()
 
-        self.currentFPGAStatus = self.poll_fpga_status()
+    def stop(self):
+        """
+        Ask the main loop to return. Can be called from another thread or a signal handler
+        """
+        self.loop.stop()
 
-        while self.shouldRun:
-            newFPGAStatus = self.poll_fpga_status()
-            if newFPGAStatus is not None and newFPGAStatus != self.currentFPGAStatus:
-                # Trigger a transition and update current state
-                self.currentFPGAStatus = self.trigger_event(newStatus=newFPGAStatus)
+    def close(self):
+        """
+        Stop the LEDs and release the sockets
+        """
+        self.report_transitions()
+        if self.queryServer is not None:
+            self.queryServer.stop()
+        if self._historyWriter is not None:
+            self._historyWriter.join()
+        if self.service is not None:
+            # The service stops its scheduler once every rig is killed and releases what the rigs share
+            self.machine.on_kill()
+            if self.socket is not None:
+                self.loop.unregister(self.socket)
+                self.closeReceiveSocket()
+            return
 
-            ## wait for a period of half the broadcasting rate of the FPGA
-            sleep(FPGA_UPDATE_RATE / 2)
+        if self.metricsServer is not None:
+            self.metricsServer.stop()
+        self.machine.on_kill()
+        self.machine.statusLEDs.join()
+        self.frameBuffer.close()
+        if self.loop is not None:
+            self.loop.close()
+        if self.socket is not None:
+            self.closeReceiveSocket()
 
 
 class StatusLEDProcessor(Process):
@@ -265,113 +964,366 @@ class StatusLEDProcessor(Process):
 
     def __init__(self,
                  effectQueue,
-                 timerQueue,
+                 timerSlot,
                  totalLEDs,
                  ringStart,
                  ringLEDs,
                  cabinetStart,
                  cabinetLEDs,
                  host,
-                 port):
+                 port,
+                 frameBuffer,
+                 regions,
+                 metrics,
+                 controlQueue=None):
         Process.__init__(self)
         self.effectQueue = effectQueue
-        self.timerQueue = timerQueue
+        self.timerSlot = timerSlot
 
         self.LEDs = StatusLED(effectQueue=self.effectQueue,
-                              timerQueue=self.timerQueue,
+                              timerSlot=self.timerSlot,
                               totalLEDs=totalLEDs,
                               ringStart=ringStart,
                               ringsLEDs=ringLEDs,
                               cabinetStart=cabinetStart,
                               cabinetLEDs=cabinetLEDs,
                               host=host,
-                              port=port,)
+                              port=port,
+                              frameBuffer=frameBuffer,
+                              regions=regions,
+                              metrics=metrics,
+                              effects=COMMAND_EFFECTS,
+                              controlQueue=controlQueue,)
 
     def run(self):
         self.initializeLEDs()
         while True:
-            f, args = self.effectQueue.get()
+            try:
+                f, args, trace = self.effectQueue.get(timeout=FRAME_REFRESH_PERIOD)
+            except Empty:
+                # No effect running. We still send what other producers draw
+                self.applyControl()
+                self.LEDs.refreshFrame()
+                continue
+            self.applyControl()
             if f != 'kill':
-                getattr(self, f)(*args)
+                self.LEDs.startCommand(f, trace)
+                self.runCommand(f, args)
+                self.LEDs.endCommand()
             else:
+                self.LEDs.reportLatencies()
                 return
 
     def initializeLEDs(self):
+        self.LEDs.claimRegions()
         self.LEDs.setLEDs(intensity=None)
 
-    def on_enter_start(self):
-        pass
+    def applyControl(self):
+        """
+        Applies the control messages that came while no effect was running
+        """
+        controlQueue = self.LEDs.controlQueue
+        while controlQueue is not None and controlQueue.pending():
+            message = controlQueue.get()
+            try:
+                self.LEDs.applyControl(message)
+            except Exception:
+                logger.exception('Failed to apply %s', message[0])
 
-    def on_enter_configure(self):
+    def runCommand(self, command, args):
+        """
+        Runs the effect of a command of the machine until the next command comes.
+        An effect that cannot be set up leaves the LEDs on their static buffer
+        """
+        try:
+            renderFrame = self.LEDs.effectRenderer(command)
+        except Exception:
+            logger.exception('Failed to set up the effect of %s. Showing the static buffer', command)
+            self.LEDs.stopEffect()
+            return
+        if renderFrame is not None:
+            self.LEDs.runEffect(renderFrame)
+        elif hasattr(self, command):
+            getattr(self, command)(*args)
+
+    def on_reset(self):
         pass
 
-    def on_enter_idle(self):
-        """
-        Function to call on idle
+    def on_terminate(self):
+        self.terminate()
 
-        :return: None
-        """
-        self.LEDs.sineBeat(color=[50, 50, 50],
-                           glow=[20, 20, 20],
-                           frequency=1.0)
 
-    def on_enter_error(self):
-        """
-        Method to call on error. It blinks on the defined color, duty and frequency
+class StatusLEDScheduler(Process):
+    """This class runs the status LEDs of all the rigs of a StatusService in a single process.
+    Instead of a blocking loop per effect, it renders the next frame of the effect of each rig
+    when it is due, at the frame rate of that effect, so all the rigs share one process"""
 
-        :return: None
-        """
-        self.LEDs.squareBeat(color=[150, 0, 0],
-                             glow=[50, 0, 0],
-                             frequency=2,
-                             duty=.3)
+    def __init__(self, commandQueue):
+        Process.__init__(self)
+        self.commandQueue = commandQueue
+        self.LEDs = {}  # The StatusLED of every rig
+        self.effects = {}  # The renderFrame of the effect running on every rig, if any
+        self.nextFrames = {}  # When the next frame of the effect of every rig is due
 
-    def on_enter_action_experiment(self):
+    def addRig(self, rig, LEDs):
         """
-        Function to call on experiment start
-
-        :return: None
+        Adds the StatusLED of a rig. Rigs have to be added before the scheduler is started
         """
-        self.LEDs.chaseLEDsTimer(chaseColor=[128, 0, 0],
-                                 timerColor=[0, 128, 0],
-                                 decay=8.0,
-                                 chaseRing=-1,
-                                 timerRing=-2,
-                                 speed=2,
-                                 frequency=1
-                                 )
+        self.LEDs[rig] = LEDs
 
-        while not self.timerQueue.empty():  # Clean the timer queue in case things go to quick or we abort
-            self.timerQueue.get(block=False)
+    def run(self):
+        for LEDs in self.LEDs.values():
+            LEDs.claimRegions()
+            LEDs.setLEDs(intensity=None)
+
+        nextRefresh = monotonic()
+        while self.LEDs:
+            now = monotonic()
+            self.renderFrames(now)
+            if now >= nextRefresh:
+                self.refreshFrames()
+                nextRefresh = now + FRAME_REFRESH_PERIOD
+
+            due = min([nextRefresh] + [self.nextFrames[rig] for rig in self.effects])
+            try:
+                rig, (f, args, trace) = self.commandQueue.get(timeout=max(0.0, due - monotonic()))
+            except Empty:
+                continue
+            self.runCommand(rig, f, args, trace)
 
-    def on_enter_action_prepare(self):
-        pass
+    def renderFrames(self, now):
+        """
+        Sends the next frame of the effects that are due
+        """
+        for rig, renderFrame in list(self.effects.items()):
+            if now < self.nextFrames[rig]:
+                continue
+            LEDs = self.LEDs[rig]
+            if LEDs.stepEffect(renderFrame):
+                # Do not try to catch up on the frames we missed
+                self.nextFrames[rig] = max(self.nextFrames[rig] + LEDs.frameInterval, now)
+            else:
+                del self.effects[rig]
+                LEDs.stopEffect()
+                LEDs.endCommand()
 
-    def on_enter_action_snap(self):
+    def refreshFrames(self):
+        """
+        Sends what other producers drew on the rigs without an effect running
         """
-        Function to call on an image snap
+        for rig, LEDs in self.LEDs.items():
+            if rig not in self.effects:
+                LEDs.refreshFrame()
 
-        :return: None
+    def runCommand(self, rig, command, args, trace):
         """
-        self.LEDs.multiplePulse(pattern=[[[0, 0, 255], 0.005]])
+        Replaces the effect running on a rig with the one of a new command.
+        The first frame is sent right away, the next ones with the frames of the other rigs
+        """
+        LEDs = self.LEDs[rig]
+        if command in ('reconfigure', 'setParameters'):
+            # The running effect goes on under the new configuration or parameters
+            try:
+                renderFrame = getattr(LEDs, command)(*args)
+            except Exception:
+                logger.exception('Failed to apply %s on rig %s. The effect goes on', command, rig)
+                return
+            if renderFrame is not None and rig in self.effects:
+                self.effects[rig] = renderFrame
+                self.nextFrames[rig] = monotonic()
+            return
 
-    def on_enter_action_mosaic(self):
-        pass
+        if self.effects.pop(rig, None) is not None:
+            LEDs.stopEffect()
+            LEDs.endCommand()
 
-    def on_enter_shutdown(self):
-        pass
+        if command == 'kill':
+            LEDs.reportLatencies()
+            LEDs.close()
+            del self.LEDs[rig]
+            return
 
-    def on_reset(self):
-        pass
+        LEDs.startCommand(command, trace)
+        try:
+            renderFrame = LEDs.effectRenderer(command)
+        except Exception:
+            logger.exception('Failed to set up the effect of %s on rig %s. Showing the static buffer', command, rig)
+            LEDs.stopEffect()
+            renderFrame = None
+        if renderFrame is not None:
+            if LEDs.stepEffect(renderFrame):
+                self.effects[rig] = renderFrame
+                self.nextFrames[rig] = monotonic() + LEDs.frameInterval
+                return
+            LEDs.stopEffect()
+        LEDs.endCommand()
 
-    def on_terminate(self):
-        self.terminate()
 
-if __name__ == '__main__':
+class StatusService:
+    """Follows the status of several rigs with a single process pair instead of one per rig.
+    This process receives the status of every rig in one event loop and runs a state machine per rig.
+    A StatusLEDScheduler process draws the LEDs of all of them"""
 
-    Status_controller = FPGAStatus(host=UDP_IP_ADDRESS, port=UDP_PORT_NO)
-    print('Status Controller created')
+    def __init__(self, config=DEFAULT_CONFIG, metricsPort=METRICS_PORT, configFile=None, querySocket=QUERY_SOCKET,
+                 historyDir=HISTORY_DIR, frameBufferName=FRAME_BUFFER_NAME):
+        """
+        :Config config: the rigs to follow and how to show their status
+        :str frameBufferName: the frame buffer of a rig is named after it with the name of the rig appended
+        :str configFile: a configuration file to reload whenever it changes. Rigs cannot be added or removed
+        :str historyDir: where the history of a rig is dumped when it enters the error state. Not dumped if None
+        :str querySocket: the Unix domain socket other tools query the status of the rigs on. Not served if None
+        """
+        ## The metrics of all the rigs, labelled with the rig
+        self.metrics = Registry()
+
+        ## One event loop waits on the sockets of all the rigs
+        self.loop = EventLoop()
+
+        ## The commands of the machines of all the rigs go to the LED scheduler through one queue
+        self.commandQueue = Queue()
+        self.scheduler = StatusLEDScheduler(self.commandQueue)
+
+        ## If anything fails, e.g. a port is taken, what was set up is released before the error goes on
+        self.statuses = {}
+        self.frameBuffers = {}
+        self.metricsServer = None
+        self.configWatcher = None
+        self.queryServer = None
+        try:
+            for rig in config.rigs:
+                if rig.name in self.statuses:
+                    raise ValueError(f'Rig {rig.name} is defined twice')
+                status = FPGAStatus(host=rig.host, port=rig.port, coalesce=config.coalesce, metricsPort=None,
+                                    rig=rig.name, service=self, interface=rig.interface, historyDir=historyDir,
+                                    querySocket=None)
+                status.config = config
+                self.statuses[rig.name] = status
+
+                # Other producers attach to the frame buffer of a rig by its name
+                frameBuffer = SharedFrameBuffer(totalPixels=FRAME_PIXELS,
+                                                regions=frame_regions(rig),
+                                                name=f'{frameBufferName}_{rig.name}')
+                self.frameBuffers[rig.name] = frameBuffer
+                self.scheduler.addRig(rig.name, StatusLED(effectQueue=self.commandQueue,
+                                                          timerSlot=status.timerSlot,
+                                                          totalLEDs=sum(rig.ringLEDs),
+                                                          ringStart=rig.ringStart,
+                                                          ringsLEDs=rig.ringLEDs,
+                                                          cabinetStart=rig.cabinetStart,
+                                                          cabinetLEDs=rig.cabinetLEDs,
+                                                          host=rig.opcHost,
+                                                          port=rig.opcPort,
+                                                          frameBuffer=frameBuffer,
+                                                          regions=STATUS_LED_REGIONS,
+                                                          frameRate=config.frameRate,
+                                                          minFrameRate=config.minFrameRate,
+                                                          metrics=status.metrics,
+                                                          effects=config.effects,
+                                                          ))
+
+            self.metrics.functionGauge('statusled_effect_queue_depth', 'Commands waiting for the LED scheduler',
+                                       self.commandQueue.qsize)
+            self.scheduler.start()
+
+            ## Serve the metrics unless metricsPort is None
+            if metricsPort is not None:
+                self.metricsServer = MetricsServer(self.metrics, host=METRICS_HOST, port=metricsPort)
+                self.metricsServer.start()
+
+            ## Follow the changes of the configuration file
+            if configFile is not None:
+                self.configWatcher = ConfigWatcher(configFile, load_status_config, self.apply_config)
+
+            ## Serve the status of the rigs to other tools unless querySocket is None
+            if querySocket is not None:
+                self.queryServer = QueryServer(self.statuses, state_names(STATES), STATUS_TIMEOUT, querySocket)
+                self.queryServer.start()
+        except BaseException:
+            self.close()
+            raise
+
+    def apply_config(self, config):
+        """
+        Swaps in a new configuration for every rig. It is rejected as a whole if it adds or removes rigs
+        """
+        names = {rig.name for rig in config.rigs}
+        if names != set(self.statuses):
+            logger.error('Configuration rejected. Rigs %s instead of %s. Restart the service to add or remove rigs',
+                         sorted(names), sorted(self.statuses))
+            return
+        for status in self.statuses.values():
+            status.apply_config(config)
 
-    print('Status Controller running')
-    Status_controller.run()
+    def run(self):
+        """
+        Main loop. Processes the status of every rig as soon as it arrives and returns once stop() is called
+        """
+        for status in self.statuses.values():
+            status.lastStatusTime = monotonic()
+        checks = [status.check_liveness for status in self.statuses.values()]
+        if self.configWatcher is not None:
+            checks.append(self.configWatcher.check)
+        try:
+            self.loop.run(*checks)
+        finally:
+            self.close()
+
+    def stop(self):
+        """
+        Ask the main loop to return. Can be called from another thread or a signal handler
+        """
+        self.loop.stop()
+
+    def close(self):
+        """
+        Stop the LEDs of every rig and release the sockets
+        """
+        if self.metricsServer is not None:
+            self.metricsServer.stop()
+        if self.queryServer is not None:
+            self.queryServer.stop()
+        for status in self.statuses.values():
+            status.close()
+        if self.scheduler.pid is not None:
+            self.scheduler.join()
+        for frameBuffer in self.frameBuffers.values():
+            frameBuffer.close()
+        self.loop.close()
+
+if __name__ == '__main__':
+    ## Several controllers can run on the same host, e.g. a second consumer of a multicast status, as long as
+    ## each has its own metrics port, query socket and frame buffer
+    parser = argparse.ArgumentParser(description='Follows the status of the FPGA and shows it on the status LEDs')
+    parser.add_argument('--config', default=CONFIG_FILE, help='the configuration file. Defaults to %(default)s')
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help='port the metrics are served on, 0 to not serve them. Defaults to %(default)s')
+    parser.add_argument('--query-socket', default=QUERY_SOCKET,
+                        help='socket the status is queried on, an empty string to not serve it. '
+                             'Defaults to %(default)s')
+    parser.add_argument('--frame-buffer', default=FRAME_BUFFER_NAME,
+                        help='name of the shared frame buffer other producers attach to. Defaults to %(default)s')
+    args = parser.parse_args()
+    metricsPort = args.metrics_port or None
+    querySocket = args.query_socket or None
+
+    # Before the LED processes are forked, so they log the same way
+    logListener = setup_logging()
+    config = load_status_config(args.config)
+    if len(config.rigs) > 1:
+        Status_controller = StatusService(config, metricsPort=metricsPort, configFile=args.config,
+                                          querySocket=querySocket, frameBufferName=args.frame_buffer)
+    else:
+        rig = config.rigs[0]
+        Status_controller = FPGAStatus(host=rig.host, port=rig.port, rig=rig.name, interface=rig.interface,
+                                       config=config, configFile=args.config, metricsPort=metricsPort,
+                                       querySocket=querySocket, frameBufferName=args.frame_buffer)
+    logger.info('Status Controller created')
+
+    logger.info('Status Controller running')
+    try:
+        Status_controller.run()
+    except KeyboardInterrupt:
+        logger.info('Status Controller stopped')
+    finally:
+        logListener.stop()
 
@@ -1,7 +1,10 @@
 import socket
-import json
 from time import sleep
 
+from StatusMessage import decode_status
+
+MAX_DATAGRAM_SIZE = 65535
+
 class FPGAStatus:
     def __init__(self, host, port):
         ## Create a dictionary to store the full FPGA state
@@ -52,16 +55,21 @@ class FPGAStatus:
         """
         This method polls to the UDP socket and gets the status information
         of the RT-host and FPGA.
-        Returns a json object that we can use to update the status dictionary
+        Returns a FPGAStatusRecord decoded from either a binary or a JSON status
         """
         try:
-            # Receive Datagram
-            datagramLength = int(self.socket.recvfrom(4)[0])
-            datagram = self.socket.recvfrom(datagramLength)[0]
+            # Receive Datagram. Skip the length datagrams sent before a JSON status
+            datagram = self.socket.recvfrom(MAX_DATAGRAM_SIZE)[0]
+            while len(datagram) <= 4 and datagram.strip().isdigit():
+                datagram = self.socket.recvfrom(MAX_DATAGRAM_SIZE)[0]
         except socket.error as msg:
-            print('Failed to get Datagram. Error code: {}. Error message: {}'.format(msg[0], msg[1]))
+            print('Failed to get Datagram. Error message: {}'.format(msg))
+            return None
+        try:
+            return decode_status(datagram)
+        except ValueError as msg:
+            print('Failed to decode Datagram. Error message: {}'.format(msg))
             return None
-        return json.loads(datagram.decode())
 
     def trigger_event(self, newStatus):
         """
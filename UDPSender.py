@@ -1,40 +1,46 @@
 """This module will emulate the UDP broadcasting of the FPGA
 for testing purposes"""
 
-import socket
-from time import sleep, time
+from collections import Counter
+import argparse
 import json
+import logging
+import random
+import socket
+from time import perf_counter, sleep, time
+
+from asynclog import setup_logging
+from StatusMessage import FPGAStatusRecord, MULTICAST_TTL, encode_binary, encode_json, is_multicast, \
+    status_from_dict
 
-MainFPGA_to_FSMachine_state = {
-    '0': 'default',     # Default
-    '1': 'start',       # Start
-    '2': 'configure',   # Configuring
-    '3': 'idle',        # Idle
-    '4': 'error',       # Aborted
-    '5': 'action',      # Running Action
-    '6': 'shutdown',    # Shutdown
-}
-
-ActionFPGA_to_FSMachine_state = {
-    '0': 'default',     # Default
-    '1': 'experiment',  # Executing Experiment
-    '2': 'prepare',     # Transferring Digitals
-    '3': 'prepare',     # Transferring Analogues
-    '4': 'prepare',     # Writing Indexes
-    '5': 'prepare',     # Writing Digitals
-    '6': 'prepare',     # Writing Analogue
-    '7': 'snap',        # Taking Snap
-    '8': 'prepare',     # Flushing FIFOs
-    '9': 'prepare',     # Updating Repetitions
-    '10': 'mosaic',     # Running Slow Mosaic
-    '11': 'mosaic',     # Running Fast Mosaic
-}
+logger = logging.getLogger(__name__)
+
+## The states the load generator moves through: (main state, action state)
+LOAD_STATES = [(3, 0),  # Idle
+               (5, 2),  # Transferring Digitals
+               (5, 1),  # Executing Experiment
+               (5, 7),  # Taking Snap
+               (5, 11),  # Running Fast Mosaic
+               (4, 0),  # Aborted
+               ]
 
 
 class Sender:
-    def __init__(self, ipAdress, port):
+    def __init__(self, ipAdress, port, binary=False, verbose=True, ttl=MULTICAST_TTL, interface=None):
+        """
+        :str ipAdress: where to send the status. A multicast group reaches all its consumers, this host included
+        :int ttl: hops a multicast status goes through. 1 keeps it on the LAN, 0 on this host
+        :str interface: the address of the local interface to send multicast status on. Picked from the routes if None
+        """
+        self.binary = binary  # Send the compact binary status instead of JSON
+        self.verbose = verbose  # Log every datagram sent
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.settimeout(1)
+        if is_multicast(ipAdress):
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+            if interface is not None:
+                self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
         self.addr = (ipAdress, port)
         self.msg = {'FPGA Main State': '0',
                     'Action State': '0',
@@ -42,18 +48,29 @@ class Sender:
                     'Other Status Elements': 'WhatEver'}
 
     def send_msg(self):
+        if self.binary:
+            self.send_binary_msg()
+            return
+
         data = json.dumps(self.msg)
         length = len(data)
         length = str(length).rjust(4)
         try:
             self.sock.sendto(length.encode(), self.addr)
-            print('Sent:')
-            print(length)
+            if self.verbose:
+                logger.debug('Sent: %s', length)
         except:
-            print('Could not send length')
+            logger.error('Could not send length')
         self.sock.sendto(data.encode(), self.addr)
-        print('Sent:')
-        print(data)
+        if self.verbose:
+            logger.debug('Sent: %s', data)
+
+    def send_binary_msg(self):
+        # A binary status has a fixed size so it goes without a length datagram
+        data = encode_binary(status_from_dict(self.msg))
+        self.sock.sendto(data, self.addr)
+        if self.verbose:
+            logger.debug('Sent: %s', self.msg)
 
     def run_experiment(self, duration):
 
@@ -118,13 +135,146 @@ class Sender:
         self.send_msg()
 
 
-if __name__ == '__main__':
-
-    t = Sender(ipAdress='127.0.0.1', port=6666)
-    print('Tester created')
+class LoadGenerator(Sender):
+    """
+    Sends status as fast as the FPGA would never do, to find where the receiver and the FSM fall behind.
+    The status go through LOAD_STATES with the timer ticking in between and can be
+    jittered, duplicated, reordered, dropped or malformed on purpose.
+    """
+    def __init__(self, ipAdress, port, binary=False, rate=1000.0, burst=1, jitter=0.0, stateChange=0.01,
+                 duplicate=0.0, reorder=0.0, drop=0.0, malformed=0.0, seed=None, ttl=MULTICAST_TTL, interface=None):
+        """
+        :float rate: status per second
+        :int burst: status sent back to back every burst / rate seconds
+        :float jitter: random shift of every burst as a fraction of the period between bursts
+        :float stateChange: probability of a status moving to the next state
+        :float duplicate: probability of a status being sent twice
+        :float reorder: probability of a status being held back and sent after the next one
+        :float drop: probability of a status not being sent
+        :float malformed: probability of sending garbage instead of a status
+        :int seed: seed of the random generator, to replay the same traffic
+        ttl and interface are the ones of Sender
+        """
+        Sender.__init__(self, ipAdress, port, binary=binary, verbose=False, ttl=ttl, interface=interface)
+        self.rate = rate
+        self.burst = burst
+        self.jitter = jitter
+        self.stateChange = stateChange
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.drop = drop
+        self.malformed = malformed
+        self.random = random.Random(seed)
+        self.sent = Counter()
+
+    def encode(self, record):
+        """
+        Returns the datagrams of a status
+        """
+        if self.binary:
+            return [encode_binary(record)]
+        data = encode_json(record)
+        return [str(len(data)).rjust(4).encode(), data]
+
+    def garbage(self):
+        """
+        Returns a malformed datagram: random bytes, a truncated JSON status or a binary status of another version
+        """
+        kind = self.random.randrange(3)
+        if kind == 0:
+            return bytes(self.random.getrandbits(8) for _ in range(self.random.randrange(1, 64)))
+        if kind == 1:
+            data = encode_json(FPGAStatusRecord(3, 0, 0.0, 'WhatEver'))
+            return data[:self.random.randrange(1, len(data))]
+        return b'\xff' + encode_binary(FPGAStatusRecord(3, 0, 0.0, None))[1:]
+
+    def send(self, datagrams):
+        for datagram in datagrams:
+            try:
+                self.sock.sendto(datagram, self.addr)
+                self.sent['datagrams'] += 1
+            except socket.error:
+                self.sent['send errors'] += 1
+
+    def statuses(self):
+        """
+        Generates the status to send, ticking the timer and moving through LOAD_STATES
+        """
+        state = 0
+        tick = 0
+        while True:
+            if self.random.random() < self.stateChange:
+                state = (state + 1) % len(LOAD_STATES)
+                tick = 0
+                self.sent['state changes'] += 1
+            mainState, actionState = LOAD_STATES[state]
+            yield FPGAStatusRecord(mainState, actionState, round(tick / 1000 % 1, 3), 'WhatEver')
+            tick += 1
+
+    def run(self, duration):
+        """
+        Sends status for duration seconds.
+        Returns a Counter with what was sent
+        """
+        self.sent = Counter()
+        period = self.burst / self.rate
+        statuses = self.statuses()
+        heldBack = None
+
+        start = perf_counter()
+        nextBurst = start
+        while nextBurst - start < duration:
+            # Sleep most of the wait and spin the rest, sleep is too coarse for the higher rates
+            remaining = nextBurst - perf_counter()
+            if remaining > 0.002:
+                sleep(remaining - 0.001)
+            while perf_counter() < nextBurst:
+                pass
+
+            for _ in range(self.burst):
+                self.sent['status'] += 1
+                datagrams = self.encode(next(statuses))
+
+                if self.random.random() < self.malformed:
+                    datagrams = [self.garbage()]
+                    self.sent['malformed'] += 1
+                if self.random.random() < self.drop:
+                    self.sent['dropped'] += 1
+                    continue
+                if self.random.random() < self.duplicate:
+                    datagrams = datagrams * 2
+                    self.sent['duplicated'] += 1
+                if heldBack is None and self.random.random() < self.reorder:
+                    heldBack = datagrams
+                    self.sent['reordered'] += 1
+                    continue
+
+                self.send(datagrams)
+                if heldBack is not None:
+                    self.send(heldBack)
+                    heldBack = None
+
+            nextBurst += period * (1 + self.jitter * self.random.uniform(-1, 1))
+
+        if heldBack is not None:
+            self.send(heldBack)
+        self.sent['seconds'] = perf_counter() - start
+        return self.sent
+
+    def report(self):
+        elapsed = self.sent['seconds']
+        print(f'Sent {self.sent["status"]} status in {elapsed:.2f} s: {self.sent["status"] / elapsed:.0f} status/s, '
+              f'{self.sent["datagrams"]} datagrams')
+        for key in ('state changes', 'dropped', 'duplicated', 'reordered', 'malformed', 'send errors'):
+            print(f'  {key}: {self.sent[key]}')
+
+
+def run_scenario(ipAdress, port, binary, ttl=MULTICAST_TTL, interface=None):
+    t = Sender(ipAdress=ipAdress, port=port, binary=binary, ttl=ttl, interface=interface)
+    logger.info('Tester created')
 
     t.run_start()
-    print('Starting...')
+    logger.info('Starting...')
 
     sleep(4)
 
@@ -138,3 +288,47 @@ if __name__ == '__main__':
 
     sleep(3)
 
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Emulates the status broadcast of the FPGA. '
+                                                 'Plays a short scenario unless a --rate is given')
+    parser.add_argument('--host', default='127.0.0.1', help='where to send the status. Can be a multicast group')
+    parser.add_argument('--port', type=int, default=6666)
+    parser.add_argument('--binary', action='store_true', help='send binary status instead of JSON')
+    parser.add_argument('--rate', type=float, help='status per second of the load generator')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of load. Defaults to %(default)s')
+    parser.add_argument('--burst', type=int, default=1, help='status sent back to back')
+    parser.add_argument('--jitter', type=float, default=0.0, help='jitter as a fraction of the burst period')
+    parser.add_argument('--state-change', type=float, default=0.01, help='probability of a state change')
+    parser.add_argument('--duplicate', type=float, default=0.0, help='probability of a duplicated status')
+    parser.add_argument('--reorder', type=float, default=0.0, help='probability of a reordered status')
+    parser.add_argument('--drop', type=float, default=0.0, help='probability of a dropped status')
+    parser.add_argument('--malformed', type=float, default=0.0, help='probability of a malformed datagram')
+    parser.add_argument('--seed', type=int, help='seed of the random generator')
+    parser.add_argument('--ttl', type=int, default=MULTICAST_TTL,
+                        help='hops of the multicast status. Defaults to %(default)s, the LAN')
+    parser.add_argument('--interface', help='address of the local interface to send the multicast status on')
+    args = parser.parse_args()
+
+    logListener = setup_logging(logging.DEBUG)
+    if args.rate is None:
+        run_scenario(args.host, args.port, args.binary, args.ttl, args.interface)
+    else:
+        generator = LoadGenerator(args.host, args.port,
+                                  binary=args.binary,
+                                  rate=args.rate,
+                                  burst=args.burst,
+                                  jitter=args.jitter,
+                                  stateChange=args.state_change,
+                                  duplicate=args.duplicate,
+                                  reorder=args.reorder,
+                                  drop=args.drop,
+                                  malformed=args.malformed,
+                                  seed=args.seed,
+                                  ttl=args.ttl,
+                                  interface=args.interface,
+                                  )
+        generator.run(args.duration)
+        generator.report()
+    logListener.stop()
+
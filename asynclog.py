@@ -0,0 +1,77 @@
+"""Logging that never blocks the status and LED loops on a slow console.
+
+The loops only put the records on a queue. A background thread of the main process writes them out,
+so a slow serial console or journald pipe delays the log, not the status. The LED process is forked
+with the same handler and its records go through the same queue.
+Every message is rate limited on its own, before it is queued: a flood of the same warning, e.g. for
+every bad datagram, is cut down to a few records per period and a count of the ones dropped.
+
+    from asynclog import setup_logging
+    listener = setup_logging()
+    ...
+    listener.stop()  # Writes out what is left in the queue
+"""
+from logging.handlers import QueueHandler, QueueListener
+from multiprocessing import Queue
+from time import monotonic
+import logging
+import threading
+
+LOG_FORMAT = '%(asctime)s %(processName)s %(levelname)s %(name)s: %(message)s'
+RATE_LIMIT_PERIOD = 10.0  # Seconds over which a message is limited
+RATE_LIMIT_BURST = 5  # Records of a message let through in every period
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most burst records of every message per period. A message is a logger and a format string,
+    whatever its arguments. The first record let through after some were dropped tells how many
+    """
+    def __init__(self, period=RATE_LIMIT_PERIOD, burst=RATE_LIMIT_BURST):
+        super().__init__()
+        self.period = period
+        self.burst = burst
+        self._messages = {}  # (logger, format string) -> [start of the period, records let through, dropped]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        now = monotonic()
+        with self._lock:
+            state = self._messages.get(key)
+            if state is None or now - state[0] >= self.period:
+                dropped = state[2] if state is not None else 0
+                state = self._messages[key] = [now, 0, 0]
+                if dropped:
+                    record.msg = f'{record.msg} ({dropped} similar messages dropped)'
+            if state[1] >= self.burst:
+                state[2] += 1
+                return False
+            state[1] += 1
+        return True
+
+
+def setup_logging(level=logging.INFO, period=RATE_LIMIT_PERIOD, burst=RATE_LIMIT_BURST, handler=None):
+    """
+    Sends the records of every logger through a queue to handler, written out by a background thread.
+    Has to be called before the LED process is started so it logs the same way.
+    :int level: the lowest level logged
+    :logging.Handler handler: where the records are written. The standard error if None
+    :return: the QueueListener. Stop it to write out the records left before exiting
+    """
+    if handler is None:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    queue = Queue()
+    queueHandler = QueueHandler(queue)
+    queueHandler.addFilter(RateLimitFilter(period, burst))
+
+    root = logging.getLogger()
+    for previous in [h for h in root.handlers if isinstance(h, QueueHandler)]:
+        root.removeHandler(previous)
+    root.addHandler(queueHandler)
+    root.setLevel(level)
+
+    listener = QueueListener(queue, handler, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -0,0 +1,277 @@
+"""Microbenchmarks of the status lights, to run on the Pi before and after a change.
+
+    python benchmarks.py --output results.json
+    python benchmarks.py --baseline results.json
+
+Covers the evaluation of a single signal of every wave type, a full frame of every StatusLED effect,
+the OPC encoding of 64, 512 and 4096 pixels, the decoding and processing of a status and the
+cold start and transitions of both state machine backends.
+The results are written as JSON and compared against a baseline written the same way.
+"""
+from itertools import cycle
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import timeit
+
+import waves
+import opc
+from LEDs import StatusLED, FrameClock
+from sharedstate import CommandQueue, LatestValue
+from StatusMessage import FPGAStatusRecord, encode_binary, encode_json, decode_status
+
+RING_START = (512 - 64)
+RING_LEDS = (1, 6, 16, 24)
+TOTAL_LEDS = sum(RING_LEDS)
+CABINET_START = 0
+CABINET_LEDS = 30
+
+REGRESSION_THRESHOLD = 0.10  # Slowdown against the baseline we report as a regression
+
+## Imports a state machine backend and builds the machine of StatusRunner in a fresh interpreter.
+## Prints the seconds it took. StatusRunner itself is imported before the clock starts
+STARTUP_CODE = """
+import time
+from StatusRunner import STATES, TRANSITIONS, FSMachine
+start = time.perf_counter()
+{setup}
+Machine(model=FSMachine.__new__(FSMachine), states=STATES, transitions=TRANSITIONS, initial='start',
+        auto_transitions=False)
+print(time.perf_counter() - start)
+"""
+FSM_BACKENDS = {
+    'builtin': 'from statemachine import TableMachine as Machine',
+    'transitions': 'from transitions.extensions import HierarchicalMachine as Machine',
+}
+
+
+def bench(function, repeat=5, number=None):
+    """
+    Times a function. The number of calls per run is picked automatically unless given.
+    Returns a dictionary with the best and the mean time of a call in microseconds
+    """
+    timer = timeit.Timer(function)
+    if number is None:
+        number, _ = timer.autorange()
+    times = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+    return {'best_us': 1e6 * min(times),
+            'mean_us': 1e6 * sum(times) / len(times),
+            'calls': number * repeat,
+            }
+
+
+def bench_cold_start(code, repeat=5):
+    """
+    Times code printing its own duration in a fresh interpreter every time, so nothing is imported yet.
+    Returns the same dictionary as bench
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    times = [float(subprocess.run([sys.executable, '-c', code], cwd=here, check=True,
+                                  capture_output=True, text=True).stdout.split()[-1])
+             for _ in range(repeat)]
+    return {'best_us': 1e6 * min(times),
+            'mean_us': 1e6 * sum(times) / len(times),
+            'calls': repeat,
+            }
+
+
+def wave_benchmarks():
+    clock = FrameClock()
+    clock.update()
+    yield 'wave_sine', waves.SineWave(time=clock, frequency=1.0, phase=0.5)
+    yield 'wave_square', waves.SquareWave(time=clock, frequency=1.0, phase=0.5, duty=0.3)
+    yield 'wave_decay', waves.DecayWave(time=clock, frequency=1.0, phase=0.5, decay=8.0)
+    yield 'wave_transformed_discrete', waves.TransformedSignal(waves.SineWave(time=clock), y0=20, y1=200,
+                                                               discrete=True)
+
+
+def effect_benchmarks(LEDs):
+    yield 'frame_chase', LEDs.chaseLEDsRenderer([128, 0, 0], decay=8.0)
+    yield 'frame_chase_timer', LEDs.chaseLEDsTimerRenderer([128, 0, 0], [0, 128, 0], decay=8.0, speed=2)
+    yield 'frame_sine', LEDs.sineBeatRenderer([50, 50, 50], glow=[20, 20, 20])
+    yield 'frame_square', LEDs.squareBeatRenderer([150, 0, 0], glow=[50, 0, 0], frequency=2, duty=.3)
+    # A pulse long enough to outlast the benchmark
+    yield 'frame_pulse', LEDs.multiplePulseRenderer(pattern=[[[0, 0, 255], 1e6]])
+
+
+def sink():
+    """
+    A local TCP server discarding whatever it gets, standing in for the OPC server.
+    Returns its port
+    """
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen()
+
+    def discard(connection):
+        while connection.recv(1 << 16):
+            pass
+
+    def accept():
+        while True:
+            connection, _ = server.accept()
+            threading.Thread(target=discard, args=(connection,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return server.getsockname()[1]
+
+
+def opc_benchmarks(port):
+    client = opc.Client(f'127.0.0.1:{port}')
+    for n in (64, 512, 4096):
+        pixels = [(i % 256, (2 * i) % 256, 255 - i % 256) for i in range(n)]
+        yield f'opc_put_pixels_{n}', lambda pixels=pixels: client.put_pixels(pixels)
+
+
+def status_benchmarks():
+    idle = FPGAStatusRecord(mainState=3, actionState=0, timer=0.0, other='WhatEver')
+    yield 'decode_json', lambda datagram=encode_json(idle): decode_status(datagram)
+    yield 'decode_binary', lambda datagram=encode_binary(idle): decode_status(datagram)
+
+
+def fsm_benchmarks():
+    """
+    A transition of each state machine backend, on a model with no-op callbacks
+    """
+    from StatusRunner import STATES, TRANSITIONS
+    from statemachine import TableMachine
+    from transitions.extensions import HierarchicalMachine
+
+    callbacks = {f'on_{kind}_{state}': lambda self: None
+                 for kind in ('enter', 'exit')
+                 for state in ('idle', 'error', 'action', 'action_experiment')}
+    for backend, Machine in (('builtin', TableMachine), ('transitions', HierarchicalMachine)):
+        model = type('Model', (), callbacks)()
+        Machine(model=model, states=STATES, transitions=TRANSITIONS, initial='idle', auto_transitions=False)
+        triggers = cycle([model.on_action_experiment, model.on_idle, model.on_error, model.on_idle])
+        yield f'fsm_transition_{backend}', lambda triggers=triggers: next(triggers)()
+
+
+def trigger_event_benchmarks(status):
+    """
+    trigger_event on a timer update, the common case, and on a state change.
+    Every state change posts a command to the LED process, so they get a fixed number of calls
+    """
+    ticks = [FPGAStatusRecord(5, 1, t / 100, 'WhatEver') for t in range(100)]
+    states = [FPGAStatusRecord(3, 0, 0.0, 'WhatEver'), FPGAStatusRecord(4, 0, 0.0, 'WhatEver')]
+
+    def trigger(statuses):
+        statuses = cycle(statuses)
+
+        def run():
+            status.currentFPGAStatus = status.trigger_event(next(statuses))
+        return run
+
+    status.currentFPGAStatus = ticks[-1]
+    yield 'trigger_event_timer', trigger(ticks), None
+    status.currentFPGAStatus = states[-1]
+    yield 'trigger_event_transition', trigger(states), 200
+
+
+def run_benchmarks(selected=None):
+    results = {}
+
+    def record(name, function):
+        if selected and not any(s in name for s in selected):
+            return
+        results[name] = bench(function)
+        print(f'{name:30s} {results[name]["best_us"]:10.2f} us')
+
+    for name, signal in wave_benchmarks():
+        record(name, signal)
+
+    LEDs = StatusLED(effectQueue=CommandQueue(),
+                     timerSlot=LatestValue(0.5),
+                     totalLEDs=TOTAL_LEDS,
+                     ringStart=RING_START,
+                     ringsLEDs=RING_LEDS,
+                     cabinetStart=CABINET_START,
+                     cabinetLEDs=CABINET_LEDS,
+                     )
+    for name, renderFrame in effect_benchmarks(LEDs):
+        record(name, renderFrame)
+    LEDs.close()
+
+    for name, function in opc_benchmarks(sink()):
+        record(name, function)
+
+    for name, function in status_benchmarks():
+        record(name, function)
+
+    for name, function in fsm_benchmarks():
+        record(name, function)
+
+    for backend, setup in FSM_BACKENDS.items():
+        name = f'fsm_cold_start_{backend}'
+        if not selected or any(s in name for s in selected):
+            results[name] = bench_cold_start(STARTUP_CODE.format(setup=setup))
+            print(f'{name:30s} {results[name]["best_us"]:10.2f} us')
+
+    triggerEventNames = ('trigger_event_timer', 'trigger_event_transition')
+    if not selected or any(s in name for s in selected for name in triggerEventNames):
+        # Imported here as it brings up the whole service
+        from StatusRunner import FPGAStatus
+        status = FPGAStatus(host='127.0.0.1', port=0, metricsPort=None, frameBufferName=None, historyDir=None,
+                            querySocket=None)
+        try:
+            for name, function, number in trigger_event_benchmarks(status):
+                if not selected or any(s in name for s in selected):
+                    results[name] = bench(function, number=number)
+        finally:
+            status.close()
+        for name in triggerEventNames:
+            if name in results:
+                print(f'{name:30s} {results[name]["best_us"]:10.2f} us')
+
+    return results
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """
+    Prints the change of every benchmark against the baseline.
+    Returns the names of the ones that got slower than the threshold
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        change = result['best_us'] / baseline[name]['best_us'] - 1
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f'{name:30s} {baseline[name]["best_us"]:10.2f} -> {result["best_us"]:10.2f} us {100 * change:+6.1f}%{flag}')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare against the results in this JSON file')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help='slowdown reported as a regression. Defaults to %(default)s')
+    parser.add_argument('benchmarks', nargs='*', help='only run the benchmarks containing these names')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.benchmarks)
+    report = {'python': platform.python_version(),
+              'machine': platform.machine(),
+              'platform': platform.platform(),
+              'results': results,
+              }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        print()
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
@@ -0,0 +1,298 @@
+"""Configuration of the status lights, read from a JSON file.
+
+The file overrides the defaults of StatusRunner and every setting is optional:
+
+    {
+        "frameRate": 60,
+        "minFrameRate": 5,
+        "coalesce": true,
+        "rigs": [{"name": "deepsim", "host": "localhost", "port": 6666,
+                  "opcHost": "127.0.0.1", "opcPort": 7890,
+                  "ringStart": 448, "ringLEDs": [1, 6, 16, 24],
+                  "cabinetStart": 0, "cabinetLEDs": 30}],
+        "effects": {"on_enter_idle": {"effect": "sineBeat",
+                                      "parameters": {"color": [50, 50, 50], "glow": [20, 20, 20]}},
+                    "on_enter_action_snap": null}
+    }
+
+A rig missing some fields takes them from the default rig of the same name, or from the first default rig.
+The host of a rig can be a multicast group, e.g. "239.255.66.66", that other consumers of the status join too.
+It is joined on the local interface with the IPv4 address "interface", by default the one of the default route.
+The effects listed replace the default effect of those commands. An effect of null leaves the LEDs
+on their static buffer for that command.
+
+The file is read, validated and compiled into a Config away from the event loop, and the Config is swapped
+in as a whole. A file that fails validation changes nothing.
+"""
+from collections import Counter, namedtuple
+from time import monotonic
+import inspect
+import json
+import logging
+import os
+import socket
+import threading
+
+from LEDs import PARAMETER_RANGES, StatusLED
+
+logger = logging.getLogger(__name__)
+
+## A compiled configuration. rigs is a tuple of RigConfig and effects maps every command to (effect, parameters)
+Config = namedtuple('Config', ['rigs', 'effects', 'frameRate', 'minFrameRate', 'coalesce'])
+
+## The effects of StatusLED that can be configured, the ones with a renderer
+EFFECTS = tuple(name[:-len('Renderer')] for name in dir(StatusLED)
+                if name.endswith('Renderer') and hasattr(StatusLED, name[:-len('Renderer')]))
+COLOR_PARAMETERS = ('color', 'glow', 'chaseColor', 'timerColor')
+RING_PARAMETERS = ('ring', 'chaseRing', 'timerRing')
+
+CONFIG_POLL_PERIOD = 1.0  # How often the configuration file is checked for changes
+
+
+def load_config(path, defaults, commands, totalPixels):
+    """
+    Reads and compiles a configuration file.
+    Raises ValueError if the file cannot be read or is not valid
+    """
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        raise ValueError(f'Cannot read {path}: {e}') from e
+    return compile_config(data, defaults, commands, totalPixels)
+
+
+def compile_config(data, defaults, commands, totalPixels):
+    """
+    Validates the settings of a configuration file and compiles them into a Config.
+    :dict data: the settings as read from the file
+    :Config defaults: the configuration the settings override
+    :commands: the commands the machine posts, the only ones that can have an effect
+    :int totalPixels: number of pixels of the frame the rigs are laid out on
+    Raises ValueError if the settings are not valid
+    """
+    if not isinstance(data, dict):
+        raise ValueError('The configuration must be a JSON object')
+    unknown = set(data) - set(Config._fields)
+    if unknown:
+        raise ValueError(f'Unknown settings {sorted(unknown)}')
+
+    frameRate = data.get('frameRate', defaults.frameRate)
+    if not _isNumber(frameRate) or not 1 <= frameRate <= 1000:
+        raise ValueError(f'frameRate must be a number of frames per second between 1 and 1000, not {frameRate}')
+    minFrameRate = data.get('minFrameRate', defaults.minFrameRate)
+    if not _isNumber(minFrameRate) or not 1 <= minFrameRate <= frameRate:
+        raise ValueError(f'minFrameRate must be a number of frames per second between 1 and frameRate, '
+                         f'not {minFrameRate}')
+    coalesce = data.get('coalesce', defaults.coalesce)
+    if not isinstance(coalesce, bool):
+        raise ValueError(f'coalesce must be true or false, not {coalesce}')
+
+    rigs = compile_rigs(data['rigs'], defaults.rigs, totalPixels) if 'rigs' in data else tuple(defaults.rigs)
+    effects = compile_effects(data.get('effects', {}), defaults.effects, commands, rigs)
+    return Config(rigs=rigs, effects=effects, frameRate=float(frameRate), minFrameRate=float(minFrameRate),
+                  coalesce=coalesce)
+
+
+def compile_rigs(entries, defaults, totalPixels):
+    """
+    Returns a tuple with the RigConfig of every rig entry
+    """
+    if not isinstance(entries, list) or not entries:
+        raise ValueError('rigs must be a non empty list')
+    defaultRigs = {rig.name: rig for rig in defaults}
+
+    rigs = []
+    for entry in entries:
+        if not isinstance(entry, dict) or not isinstance(entry.get('name'), str) or not entry['name']:
+            raise ValueError(f'Every rig needs a name: {entry}')
+        base = defaultRigs.get(entry['name'], defaults[0])
+        unknown = set(entry) - set(base._fields)
+        if unknown:
+            raise ValueError(f'Unknown settings {sorted(unknown)} for rig {entry["name"]}')
+        rigs.append(validate_rig(base._replace(**entry), totalPixels))
+
+    for name, count in Counter(rig.name for rig in rigs).items():
+        if count > 1:
+            raise ValueError(f'Rig {name} is defined {count} times')
+    for (host, port), count in Counter((rig.host, rig.port) for rig in rigs).items():
+        if count > 1 and port:
+            raise ValueError(f'{count} rigs listen on {host}:{port}')
+    return tuple(rigs)
+
+
+def validate_rig(rig, totalPixels):
+    """
+    Returns the rig with its values normalised.
+    Raises ValueError if a value is not valid or the LEDs do not fit in the frame
+    """
+    for field in ('host', 'opcHost', 'interface'):
+        if not isinstance(getattr(rig, field), str):
+            raise ValueError(f'{field} of rig {rig.name} must be a string')
+    try:
+        socket.inet_aton(rig.interface)
+    except OSError:
+        raise ValueError(f'interface of rig {rig.name} must be an IPv4 address, not {rig.interface}') from None
+    if not _isInteger(rig.port) or not 0 <= rig.port <= 65535:
+        raise ValueError(f'port of rig {rig.name} must be a port number, not {rig.port}')
+    if not str(rig.opcPort).isdigit() or not 0 < int(rig.opcPort) <= 65535:
+        raise ValueError(f'opcPort of rig {rig.name} must be a port number, not {rig.opcPort}')
+    if (not isinstance(rig.ringLEDs, (list, tuple)) or not rig.ringLEDs or
+            not all(_isInteger(leds) and leds > 0 for leds in rig.ringLEDs)):
+        raise ValueError(f'ringLEDs of rig {rig.name} must be a list with the number of LEDs of every ring')
+    for field in ('ringStart', 'cabinetStart', 'cabinetLEDs'):
+        if not _isInteger(getattr(rig, field)) or getattr(rig, field) < 0:
+            raise ValueError(f'{field} of rig {rig.name} must be a positive integer')
+
+    ring = (rig.ringStart, rig.ringStart + sum(rig.ringLEDs))
+    cabinet = (rig.cabinetStart, rig.cabinetStart + rig.cabinetLEDs)
+    for region, (start, stop) in (('ring', ring), ('cabinet', cabinet)):
+        if stop > totalPixels:
+            raise ValueError(f'The {region} of rig {rig.name} ends at pixel {stop}, past the {totalPixels} of the frame')
+    if rig.cabinetLEDs and ring[0] < cabinet[1] and cabinet[0] < ring[1]:
+        raise ValueError(f'The rings and the cabinet of rig {rig.name} overlap')
+
+    return rig._replace(opcPort=str(int(rig.opcPort)), ringLEDs=tuple(rig.ringLEDs))
+
+
+def compile_effects(entries, defaults, commands, rigs):
+    """
+    Returns the dispatch table of the effects: command -> (effect, parameters)
+    """
+    if not isinstance(entries, dict):
+        raise ValueError('effects must map commands to effects')
+    effects = dict(defaults)
+    for command, entry in entries.items():
+        if command not in commands:
+            raise ValueError(f'Unknown command {command}. The machine posts {sorted(commands)}')
+        if entry is None:
+            effects.pop(command, None)
+            continue
+        if not isinstance(entry, dict) or 'effect' not in entry or set(entry) - {'effect', 'parameters'}:
+            raise ValueError(f'The effect of {command} must be an object with an effect and its parameters')
+        parameters = entry.get('parameters', {})
+        if not isinstance(parameters, dict):
+            raise ValueError(f'The parameters of the effect of {command} must be an object')
+        effects[command] = (entry['effect'], dict(parameters))
+
+    for command, (effect, parameters) in effects.items():
+        validate_effect(command, effect, parameters, rigs)
+    return effects
+
+
+def validate_effect(command, effect, parameters, rigs):
+    """
+    Raises ValueError unless the effect can be set up with the parameters on every rig
+    """
+    if effect not in EFFECTS:
+        raise ValueError(f'Unknown effect {effect} for {command}. The effects are {sorted(EFFECTS)}')
+    try:
+        inspect.signature(getattr(StatusLED, effect + 'Renderer')).bind(None, **parameters)
+    except TypeError as e:
+        raise ValueError(f'Invalid parameters for the {effect} of {command}: {e}') from e
+
+    for name, value in parameters.items():
+        if name in COLOR_PARAMETERS:
+            _validateColor(value, f'{name} of {command}')
+        elif name in RING_PARAMETERS:
+            for rig in rigs:
+                if not _isInteger(value) or not -len(rig.ringLEDs) <= value < len(rig.ringLEDs):
+                    raise ValueError(f'{name} of {command} is not a ring of rig {rig.name}: {value}')
+        elif name == 'pattern':
+            if value is None:
+                continue
+            if not isinstance(value, list) or not value:
+                raise ValueError(f'pattern of {command} must be a list of [color, duration] pulses')
+            for pulse in value:
+                if not isinstance(pulse, list) or len(pulse) != 2 or not _isNumber(pulse[1]) or pulse[1] <= 0:
+                    raise ValueError(f'Every pulse of the pattern of {command} must be [color, duration]: {pulse}')
+                _validateColor(pulse[0], f'pattern of {command}')
+        elif not _isNumber(value):
+            raise ValueError(f'{name} of {command} must be a number, not {value}')
+        elif name in PARAMETER_RANGES:
+            _validateRange(value, *PARAMETER_RANGES[name], f'{name} of {command}')
+
+
+def _validateColor(color, name):
+    if (not isinstance(color, (list, tuple)) or len(color) != 3 or
+            not all(_isInteger(v) and 0 <= v <= 255 for v in color)):
+        raise ValueError(f'{name} must be a color of three integers between 0 and 255, not {color}')
+
+
+def _validateRange(value, lowest, highest, lowestIncluded, name):
+    if value < lowest or (value == lowest and not lowestIncluded) or (highest is not None and value > highest):
+        bounds = f'{">=" if lowestIncluded else ">"} {lowest}' + (f' and <= {highest}' if highest is not None else '')
+        raise ValueError(f'{name} must be {bounds}, not {value}')
+
+
+def _isNumber(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _isInteger(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+class ConfigWatcher:
+    """
+    Watches a configuration file and swaps in the new configuration when the file changes.
+
+    check() is called from the event loop. The file is compiled in a background thread and only
+    a compiled configuration reaches apply, which runs in the event loop between two status.
+    A file that cannot be compiled is reported and the running configuration is kept
+    """
+    def __init__(self, path, compile, apply, period=CONFIG_POLL_PERIOD):
+        """
+        :str path: the configuration file
+        :compile: a callable compiling the file into a configuration. Raises ValueError if it is not valid
+        :apply: a callable swapping in a compiled configuration
+        :float period: seconds between two checks of the file
+        """
+        self.path = path
+        self.compile = compile
+        self.apply = apply
+        self.period = period
+        self.fileVersion = self._fileVersion()
+        self.nextCheck = monotonic() + period
+        self._compiler = None
+        self._result = None
+
+    def _fileVersion(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _compile(self):
+        try:
+            self._result = (self.compile(self.path), None)
+        except ValueError as e:
+            self._result = (None, e)
+
+    def check(self):
+        """
+        Applies a newly compiled configuration and starts compiling the file if it changed.
+        Returns the time in seconds until it should be called again
+        """
+        if self._compiler is not None and not self._compiler.is_alive():
+            self._compiler = None
+            config, error = self._result
+            if error is not None:
+                logger.error('Configuration %s rejected. Keeping the running one. %s', self.path, error)
+            else:
+                logger.info('Configuration %s applied', self.path)
+                self.apply(config)
+
+        now = monotonic()
+        if now >= self.nextCheck:
+            self.nextCheck = now + self.period
+            fileVersion = self._fileVersion()
+            if fileVersion != self.fileVersion and fileVersion is not None and self._compiler is None:
+                self.fileVersion = fileVersion
+                self._compiler = threading.Thread(target=self._compile, name='ConfigCompiler', daemon=True)
+                self._compiler.start()
+
+        if self._compiler is not None:
+            return .05  # Pick up the result soon
+        return max(0.0, self.nextCheck - now)
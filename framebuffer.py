@@ -0,0 +1,159 @@
+"""A frame of LED pixels in shared memory that several processes can draw into.
+
+The frame is split in named regions, e.g. the status rings and the cabinet lighting.
+Each region is claimed by the one process that writes it, so producers write their pixels
+directly and at their own rate, with no pickling. A single output process sends the
+composed frame to the OPC server.
+
+Layout of the shared memory:
+- for every region, the pid of its owner and the number of times it was written (int64)
+- the pid of the process that created the block (int64)
+- the RGB bytes of all the pixels
+"""
+from multiprocessing import shared_memory, resource_tracker
+import os
+
+
+class SharedFrameBuffer:
+    def __init__(self, totalPixels, regions, name=None, create=True):
+        """
+        :int totalPixels: number of pixels of the whole frame
+        :dict regions: region name -> (first pixel, number of pixels)
+        :str name: name of the shared memory block. A random one is used if None
+        :bool create: create the block, or attach to an existing one created by another process.
+                      A block of the same name left behind by processes that are all gone is replaced.
+                      Raises FileExistsError if its creator or the owner of a region is still running
+        """
+        self.totalPixels = totalPixels
+        self.regions = dict(regions)
+        self._regionIndex = {region: i for i, region in enumerate(self.regions)}
+        headerSize = 16 * len(self.regions) + 8
+
+        if create:
+            try:
+                self._shm = shared_memory.SharedMemory(name=name, create=True, size=headerSize + 3 * totalPixels)
+            except FileExistsError:
+                self._removeStale(name, headerSize)
+                self._shm = shared_memory.SharedMemory(name=name, create=True, size=headerSize + 3 * totalPixels)
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+            # The creator is in charge of removing the block, not the resource tracker of this process
+            resource_tracker.unregister(self._shm._name, 'shared_memory')
+        self._created = create
+
+        self._header = self._shm.buf[:headerSize].cast('q')
+        self.pixels = self._shm.buf[headerSize:headerSize + 3 * totalPixels]
+        if create:
+            self._header[2 * len(self.regions)] = os.getpid()
+
+    def _removeStale(self, name, headerSize):
+        """
+        Removes a block left behind by processes that did not shut down cleanly.
+        Raises FileExistsError if one of the processes in its header is still running
+        """
+        existing = shared_memory.SharedMemory(name=name)
+        header = existing.buf[:min(existing.size, headerSize) // 8 * 8].cast('q')
+        regionCount = len(self.regions)
+        pids = [header[i] for i in list(range(0, 2 * regionCount, 2)) + [2 * regionCount] if i < len(header)]
+        header.release()
+        existing.close()
+        alive = sorted({pid for pid in pids if pid and _isAlive(pid)})
+        if alive:
+            # The block is not ours to remove at exit either
+            resource_tracker.unregister(existing._name, 'shared_memory')
+            raise FileExistsError(f'Frame buffer {name} is in use by processes {alive}')
+        existing.unlink()
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    def claim(self, region):
+        """
+        Makes the current process the owner of a region.
+        Claims are not atomic, so they are meant to be done when the producers start.
+        Returns a FrameRegion to write the pixels of the region
+        """
+        i = self._regionIndex[region]
+        owner = self._header[2 * i]
+        if owner not in (0, os.getpid()) and _isAlive(owner):
+            raise ValueError(f'Region {region} is owned by process {owner}')
+        self._header[2 * i] = os.getpid()
+        start, length = self.regions[region]
+        return FrameRegion(self, i, start, length)
+
+    def release(self, region):
+        i = self._regionIndex[region]
+        if self._header[2 * i] == os.getpid():
+            self._header[2 * i] = 0
+
+    def setRegion(self, region, start, length):
+        """
+        Moves or resizes a region, e.g. after the LED layout changed.
+        Only changes the layout seen by this process. The owner has to claim the region again
+        """
+        if region not in self._regionIndex:
+            raise ValueError(f'Unknown region {region}')
+        if start < 0 or start + length > self.totalPixels:
+            raise ValueError(f'Region {region} does not fit in the {self.totalPixels} pixels of the frame')
+        self.regions[region] = (start, length)
+
+    def owner(self, region):
+        return self._header[2 * self._regionIndex[region]]
+
+    def version(self):
+        """
+        Returns a number that changes whenever any region is written
+        """
+        return sum(self._header[1::2])
+
+    def frame(self):
+        """
+        Returns the composed frame as RGB bytes
+        """
+        return bytes(self.pixels)
+
+    def close(self):
+        self._header.release()
+        self.pixels.release()
+        self._shm.close()
+        if self._created:
+            self._shm.unlink()
+
+
+class FrameRegion:
+    """
+    The part of a SharedFrameBuffer a producer owns
+    """
+    def __init__(self, frameBuffer, index, start, length):
+        self.frameBuffer = frameBuffer
+        self.index = index
+        self.start = start
+        self.stop = start + length
+        self.length = length
+
+    def write(self, pixels):
+        """
+        Writes the pixels of the region.
+        :param pixels: a sequence of length 3-tuples with the colors. Values are clamped to 0-255
+        """
+        if len(pixels) != self.length:
+            raise ValueError(f'Expected {self.length} pixels, got {len(pixels)}')
+        self.writeBytes(bytes(min(255, max(0, int(v))) for pixel in pixels for v in pixel))
+
+    def writeBytes(self, data):
+        """
+        Writes the pixels of the region as RGB bytes
+        """
+        self.frameBuffer.pixels[3 * self.start:3 * self.stop] = data
+        self.frameBuffer._header[2 * self.index + 1] += 1
+
+
+def _isAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
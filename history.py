@@ -0,0 +1,128 @@
+"""A fixed size history of the status received, to look back at what led to an error.
+
+The status are kept in a ring buffer, a structured NumPy array allocated once, so appending is O(1)
+and the memory used does not depend on the uptime. The history can be queried by receive time and
+dumped to a .npy file, which FPGAStatus does whenever its machine enters the error state:
+
+    records = numpy.load('deepsim-error-20261019-101500.npy')
+    records[records['mainState'] == 5]['timer']
+
+In memory the receive times are on the monotonic clock, like the rest of the status traces.
+In the dumps they are on the wall clock, in seconds since the epoch.
+
+The history lives in shared memory, so the processes forked after it is created, e.g. the query server,
+read it as it grows. It is appended to by the event loop only, which never waits on the readers:
+like LatestValue, a sequence counter is odd while a status is being appended and a reader that
+overlaps an append copies the records again.
+"""
+from multiprocessing import RawArray, RawValue
+from time import monotonic, sleep, time
+import glob
+import os
+
+import numpy
+
+HISTORY_SIZE = 10000  # Status kept. About 16 minutes at the 10 status per second of the FPGA
+HISTORY_DUMPS = 20  # Dumps kept in a directory. The oldest ones are removed
+HISTORY_DTYPE = numpy.dtype([('received', 'f8'),
+                             ('mainState', 'i2'),
+                             ('actionState', 'i2'),
+                             ('timer', 'f8'),
+                             ])
+
+
+class StatusHistory:
+    def __init__(self, size=HISTORY_SIZE):
+        """
+        :int size: number of status kept. The oldest ones are overwritten
+        """
+        self._records = numpy.frombuffer(RawArray('b', size * HISTORY_DTYPE.itemsize), dtype=HISTORY_DTYPE)
+        ## Twice the number of status appended, plus one while a status is being appended
+        self._sequence = RawValue('Q', 0)
+
+    def __len__(self):
+        return min(self._sequence.value // 2, len(self._records))
+
+    @property
+    def size(self):
+        return len(self._records)
+
+    def append(self, received, status):
+        """
+        Records a FPGAStatusRecord received at a time point of the monotonic clock
+        """
+        sequence = self._sequence.value
+        self._sequence.value = sequence + 1
+        self._records[sequence // 2 % len(self._records)] = (received, status.mainState, status.actionState,
+                                                              status.timer)
+        self._sequence.value = sequence + 2
+
+    def records(self):
+        """
+        Returns a copy of the status kept, oldest first
+        """
+        return self.since(0)[0]
+
+    def last(self, count=1):
+        """
+        Returns a copy of the last count status appended, oldest first
+        """
+        return self.since(self._sequence.value // 2 - count)[0][-count:]
+
+    def since(self, appended):
+        """
+        Returns a copy of the status appended after the first appended ones that are still kept,
+        oldest first, and the number of status appended so far to ask for the next ones
+        """
+        while True:
+            sequence = self._sequence.value
+            if sequence % 2:
+                sleep(0)  # An append is under way. Let it finish
+                continue
+            total = sequence // 2
+            first = max(appended, total - len(self._records), 0)
+            start, stop = first % len(self._records), total % len(self._records)
+            if first >= total:
+                records = self._records[:0].copy()
+            elif start < stop:
+                records = self._records[start:stop].copy()
+            else:
+                records = numpy.concatenate((self._records[start:], self._records[:stop]))
+            if self._sequence.value == sequence:
+                return records, total
+
+    def between(self, start=None, stop=None):
+        """
+        Returns the status received from start included to stop excluded, oldest first.
+        Either bound can be None to leave that side open
+        """
+        records = self.records()
+        keep = numpy.ones(len(records), dtype=bool)
+        if start is not None:
+            keep &= records['received'] >= start
+        if stop is not None:
+            keep &= records['received'] < stop
+        return records[keep]
+
+    def dump(self, path, records=None):
+        """
+        Writes the status kept, or records taken from records() earlier, to a .npy file
+        with the receive times on the wall clock
+        """
+        if records is None:
+            records = self.records()
+        records['received'] += time() - monotonic()
+        numpy.save(path, records)
+
+
+def prune_dumps(directory, pattern='*.npy', keep=HISTORY_DUMPS):
+    """
+    Removes the oldest dumps matching pattern in directory so that keep of them are left.
+    The names of the dumps end with their time, so they sort from the oldest
+    """
+    dumps = sorted(glob.glob(os.path.join(directory, pattern)))
+    for path in dumps[:-keep] if keep else dumps:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # Pruned by the writer of another dump
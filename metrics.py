@@ -0,0 +1,249 @@
+"""Runtime metrics of the status light service: counters, gauges and latency histograms.
+
+The values live in shared memory, so the LED process updates them with plain memory writes
+and the exporter in the main process reads them. This means:
+- metrics have to be created before the processes using them are started
+- every metric must be updated from a single process
+
+Metrics can carry labels, e.g. the rig they belong to when one service drives several rigs.
+The metrics are exported in the Prometheus text format by a small HTTP server:
+
+    curl http://127.0.0.1:9750/metrics
+"""
+from bisect import bisect_left
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import RawArray, RawValue
+import threading
+
+## Upper bounds in seconds of the buckets of the latency histograms
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5)
+## The same, starting at a microsecond, for the stages of a status change that take microseconds
+STAGE_LATENCY_BUCKETS = (.000001, .0000025, .000005, .00001, .000025, .00005, .0001, .00025) + LATENCY_BUCKETS
+
+
+def format_labels(labels):
+    """
+    Returns labels in the Prometheus format, e.g. {rig="deepsim"}, or an empty string if there are none
+    """
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=None):
+        self.name = name
+        self.help = help
+        self.labels = dict(labels or {})
+        self._value = RawValue('d', 0)
+
+    def inc(self, amount=1):
+        self._value.value += amount
+
+    @property
+    def value(self):
+        return self._value.value
+
+    def samples(self):
+        yield self.name, format_labels(self.labels), self.value
+
+
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=None):
+        self.name = name
+        self.help = help
+        self.labels = dict(labels or {})
+        self._value = RawValue('d', 0)
+
+    def set(self, value):
+        self._value.value = value
+
+    @property
+    def value(self):
+        return self._value.value
+
+    def samples(self):
+        yield self.name, format_labels(self.labels), self.value
+
+
+class FunctionGauge:
+    """
+    A gauge whose value is computed by a function when the metrics are exported.
+    The function runs in the exporting process
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help, function, labels=None):
+        self.name = name
+        self.help = help
+        self.labels = dict(labels or {})
+        self.function = function
+
+    @property
+    def value(self):
+        return self.function()
+
+    def samples(self):
+        yield self.name, format_labels(self.labels), self.value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, quantiles=(), labels=None):
+        """
+        :tuple quantiles: quantiles to estimate and export along with the buckets, e.g. (.5, .99)
+        """
+        self.name = name
+        self.help = help
+        self.labels = dict(labels or {})
+        self.buckets = tuple(buckets)
+        self.quantiles = tuple(quantiles)
+        self._counts = RawArray('Q', len(self.buckets) + 1)  # The last one is +Inf
+        self._sum = RawValue('d', 0)
+
+    def observe(self, value):
+        self._counts[bisect_left(self.buckets, value)] += 1
+        self._sum.value += value
+
+    @property
+    def count(self):
+        return sum(self._counts)
+
+    @property
+    def sum(self):
+        return self._sum.value
+
+    def quantile(self, q):
+        """
+        Estimates the q quantile by interpolating inside the bucket it falls in.
+        Returns None if nothing was observed
+        """
+        counts = self._counts[:]
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        cumulative = 0
+        for i, count in enumerate(counts):
+            if count and cumulative + count >= rank:
+                lower = self.buckets[i - 1] if i else 0.0
+                if i == len(self.buckets):
+                    return lower  # Beyond the last bucket all we know is the lower bound
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self._counts[:]):
+            cumulative += count
+            yield self.name + '_bucket', format_labels({**self.labels, 'le': f'{bound:g}'.replace('inf', '+Inf')}), \
+                cumulative
+        yield self.name + '_sum', format_labels(self.labels), self.sum
+        yield self.name + '_count', format_labels(self.labels), cumulative
+
+
+class Registry:
+    """
+    Holds the metrics of the service
+    """
+    def __init__(self, labels=None, metrics=None):
+        """
+        :dict labels: labels added to every metric registered through this registry
+        :dict metrics: the metrics of the registry this one is a view of
+        """
+        self.labels = dict(labels or {})
+        self.metrics = {} if metrics is None else metrics
+
+    def labelled(self, **labels):
+        """
+        Returns a view of the registry adding labels to the metrics registered through it.
+        The metrics are exposed by the registry it comes from
+        """
+        return Registry({**self.labels, **labels}, self.metrics)
+
+    def _register(self, metric):
+        key = (metric.name, format_labels(metric.labels))
+        if key in self.metrics:
+            raise ValueError(f'Metric {metric.name}{key[1]} already exists')
+        self.metrics[key] = metric
+        return metric
+
+    def counter(self, name, help):
+        return self._register(Counter(name, help, self.labels))
+
+    def gauge(self, name, help):
+        return self._register(Gauge(name, help, self.labels))
+
+    def functionGauge(self, name, help, function):
+        return self._register(FunctionGauge(name, help, function, self.labels))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, quantiles=()):
+        return self._register(Histogram(name, help, buckets, quantiles, self.labels))
+
+    def expose(self):
+        """
+        Returns the metrics in the Prometheus text exposition format
+        """
+        # The samples of a metric family must be together, whatever the order the labels were registered in
+        families = defaultdict(list)
+        for metric in list(self.metrics.values()):
+            families[metric.name].append(metric)
+
+        lines = []
+        for name, metrics in families.items():
+            lines.append(f'# HELP {name} {metrics[0].help}')
+            lines.append(f'# TYPE {name} {metrics[0].kind}')
+            for metric in metrics:
+                for sample, labels, value in metric.samples():
+                    lines.append(f'{sample}{labels} {value:g}')
+            if getattr(metrics[0], 'quantiles', None):
+                # Estimated from the buckets. A family of its own, histograms cannot hold quantiles
+                lines.append(f'# HELP {name}_quantile {metrics[0].help}. Estimated quantiles')
+                lines.append(f'# TYPE {name}_quantile gauge')
+                for metric in metrics:
+                    for q in metric.quantiles:
+                        value = metric.quantile(q)
+                        labels = format_labels({**metric.labels, 'quantile': f'{q:g}'})
+                        lines.append(f'{name}_quantile{labels} {float("nan") if value is None else value:g}')
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    """
+    Serves the metrics of a registry over HTTP from a background thread
+    """
+    def __init__(self, registry, host='127.0.0.1', port=9750):
+        self.registry = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path not in ('/', '/metrics'):
+                    handler.send_error(404)
+                    return
+                body = registry.expose().encode()
+                handler.send_response(200)
+                handler.send_header('Content-Type', 'text/plain; version=0.0.4')
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                pass  # Do not print every scrape
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name='MetricsServer', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -138,6 +138,26 @@ class Client(object):
         with the first LED.  It's not possible to send a color just to one
         LED at a time (unless it's the first one).
 
+        """
+        pieces = [ struct.pack( "BBB",
+                     min(255, max(0, int(r))),
+                     min(255, max(0, int(g))),
+                     min(255, max(0, int(b)))) for r, g, b in pixels ]
+
+        if sys.version_info[0] == 3:
+            # bytes!
+            return self.put_pixel_bytes(b''.join(pieces), channel)
+        else:
+            # strings!
+            return self.put_pixel_bytes(''.join(pieces), channel)
+
+    def put_pixel_bytes(self, pixel_bytes, channel=0):
+        """Send pixel colors already packed as RGB bytes to the OPC server on the given channel.
+
+        pixel_bytes: 3 bytes per pixel, e.g. the frame of a shared frame buffer.
+
+        Returns True on success and False on failure, like put_pixels.
+
         """
         self._debug('put_pixels: connecting')
         is_connected = self._ensure_connected()
@@ -146,23 +166,12 @@ class Client(object):
             return False
 
         # build OPC message
-        len_hi_byte = int(len(pixels)*3 / 256)
-        len_lo_byte = (len(pixels)*3) % 256
+        len_hi_byte = int(len(pixel_bytes) / 256)
+        len_lo_byte = len(pixel_bytes) % 256
         command = 0  # set pixel colors from openpixelcontrol.org
 
         header = struct.pack("BBBB", channel, command, len_hi_byte, len_lo_byte)
-
-        pieces = [ struct.pack( "BBB",
-                     min(255, max(0, int(r))),
-                     min(255, max(0, int(g))),
-                     min(255, max(0, int(b)))) for r, g, b in pixels ]
-
-        if sys.version_info[0] == 3:
-            # bytes!
-            message = header + b''.join(pieces)
-        else:
-            # strings!
-            message = header + ''.join(pieces)
+        message = header + pixel_bytes
 
         self._debug('put_pixels: sending pixels to server')
         try:
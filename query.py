@@ -0,0 +1,401 @@
+"""Queries of the status by other tools on the Pi, over a Unix domain socket.
+
+Every request is a line, a JSON object or just the name of a query, and gets a JSON line back:
+
+    echo status | nc -U /tmp/statusled.sock
+    echo '{"query": "history", "rig": "deepsim", "seconds": 60}' | nc -U /tmp/statusled.sock
+
+The queries are:
+- status: the last status received, the state of the machine and whether the FPGA is still sending
+- state: the state of the machine only
+- history: the status kept in the history, only the ones of the last "seconds" if given, as one list per field
+- rigs: the names of the rigs followed
+- subscribe: a line for every change of the status from then on. "fields" limits it to the changes of
+  some fields of the status, e.g. ["mainState", "actionState"]
+
+A query takes the name of its rig in "rig" unless a single rig is followed. Without one, subscribe
+follows every rig. Receive times are on the wall clock, in seconds since the epoch.
+
+The server is a process of its own, so the clients never compete with the event loop for the
+interpreter. It reads the status from the history and the state of the machine from a slot, both
+in shared memory. The loop only sets the slot on a change and, while someone is subscribed, wakes
+the server up through a pipe. A client too slow to read its replies is dropped once
+QUERY_BUFFER_LIMIT of them are waiting, so it never holds up the others.
+"""
+from functools import partial
+from multiprocessing import Process, RawValue
+from time import monotonic, time
+import json
+import logging
+import os
+import selectors
+import socket
+import stat
+import tempfile
+
+from sharedstate import LatestValue
+
+logger = logging.getLogger(__name__)
+
+QUERY_SOCKET = os.path.join(tempfile.gettempdir(), 'statusled.sock')
+QUERY_LINE_LIMIT = 4096  # Longest request
+QUERY_BUFFER_LIMIT = 4 << 20  # Bytes of replies waiting for a client before it is dropped
+QUERY_STOP_TIMEOUT = 1.0  # Seconds given to the server to exit before it is terminated
+QUERIES = ('status', 'state', 'history', 'rigs', 'subscribe')
+FIELDS = ('mainState', 'actionState', 'timer')  # The fields of the status kept in the history
+
+
+def encode(message):
+    """
+    Returns a message as a JSON line
+    """
+    return json.dumps(message).encode() + b'\n'
+
+
+def record_to_dict(record, offset):
+    """
+    Returns a record of the history as a status, its receive time moved by offset to the wall clock
+    """
+    return {'mainState': int(record['mainState']),
+            'actionState': int(record['actionState']),
+            'timer': float(record['timer']),
+            'received': float(record['received']) + offset,
+            }
+
+
+class QueryClient:
+    """
+    A connection to the query server: what it sent that is not handled yet, what is left to send it
+    and the status changes it subscribed to
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.received = bytearray()
+        self.pending = bytearray()
+        self.writing = False  # Waiting for the connection to take the rest of pending
+        ## (rig, fields) once subscribed. A rig of None follows every rig
+        self.subscription = None
+
+
+class QueryServer(Process):
+    """
+    Serves the status of some FPGAStatus over a Unix domain socket from a process of its own.
+    It has to be created before the processes started after it, so it is not inherited by them
+    """
+    def __init__(self, statuses, states, linkTimeout, path=QUERY_SOCKET):
+        """
+        :dict statuses: the FPGAStatus to serve by the name of their rig
+        :states: the names of all the states of their machines
+        :float linkTimeout: silence after which the link to the FPGA is reported lost
+        :str path: the socket. A socket left over by a server that is gone is replaced
+        """
+        Process.__init__(self, name='QueryServer', daemon=True)
+        self.histories = {rig: status.history for rig, status in statuses.items()}
+        self.states = tuple(states)
+        self.linkTimeout = linkTimeout
+        self.path = path
+
+        ## The state of every machine, as an index in states, set by the loop on every change
+        self.stateIndex = {state: index for index, state in enumerate(self.states)}
+        self.machines = {rig: status.machine for rig, status in statuses.items()}
+        self.stateSlots = {rig: LatestValue(self.stateIndex[machine.state], typecode='i')
+                           for rig, machine in self.machines.items()}
+        ## Clients subscribed, counted by the server. The loop only wakes it up when there are some
+        self.subscribers = RawValue('i', 0)
+        self.shouldRun = RawValue('b', 1)
+        ## The socket first: if it cannot be bound there is nothing else to release
+        self.server = self.createServerSocket(path)
+        self._wakeupReceiver, self._wakeupSender = os.pipe()
+        os.set_blocking(self._wakeupReceiver, False)
+        os.set_blocking(self._wakeupSender, False)
+
+        ## The callback of every rig, to unsubscribe them
+        self.statuses = statuses
+        self.callbacks = {rig: partial(self.on_change, rig) for rig in statuses}
+        for rig, status in statuses.items():
+            for field in FIELDS:
+                status.subscribe(field, self.callbacks[rig])
+
+        ## What the server saw of every history: the number of status appended and the last one
+        self.appended = {}
+        self.previous = {}
+        self.clients = {}
+        self.selector = None
+
+    @staticmethod
+    def createServerSocket(path):
+        """
+        Returns a listening socket bound to path.
+        Raises OSError if another server is listening there or path is not a socket
+        """
+        try:
+            if not stat.S_ISSOCK(os.stat(path).st_mode):
+                raise OSError(f'{path} exists and is not a socket')
+        except FileNotFoundError:
+            pass
+        else:
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.unlink(path)  # Left over by a server that is gone
+            else:
+                raise OSError(f'A server is already listening on {path}')
+            finally:
+                probe.close()
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            server.bind(path)
+            server.listen()
+        except OSError:
+            server.close()
+            raise
+        server.setblocking(False)
+        return server
+
+    def start(self):
+        """
+        Starts the server. The socket and the end of the pipe it reads are its own from then on
+        """
+        Process.start(self)
+        self.server.close()
+        os.close(self._wakeupReceiver)
+
+    def stop(self):
+        """
+        Stops the server, which disconnects every client, and removes the socket
+        """
+        for rig, status in self.statuses.items():
+            for field in FIELDS:
+                status.unsubscribe(field, self.callbacks[rig])
+        self.shouldRun.value = 0
+        self.wakeup()
+        self.join(QUERY_STOP_TIMEOUT)
+        if self.is_alive():
+            logger.warning('Query server did not stop in %.1f s. Terminating it', QUERY_STOP_TIMEOUT)
+            self.terminate()
+            self.join()
+        os.close(self._wakeupSender)
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def on_change(self, rig, oldStatus, newStatus):
+        """
+        Called by the event loop when the status of a rig changes, once it is in the history.
+        Publishes the state the machine went to and wakes the server up if someone is subscribed
+        """
+        self.stateSlots[rig].set(self.stateIndex[self.machines[rig].state])
+        if self.subscribers.value:
+            self.wakeup()
+
+    def wakeup(self):
+        try:
+            os.write(self._wakeupSender, b'\0')
+        except BlockingIOError:
+            pass  # The server has yet to read the previous ones
+
+    def run(self):
+        os.close(self._wakeupSender)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.server, selectors.EVENT_READ, self.handle_accept)
+        self.selector.register(self._wakeupReceiver, selectors.EVENT_READ, self.handle_wakeup)
+        try:
+            while self.shouldRun.value:
+                for key, events in self.selector.select():
+                    key.data(key.fileobj, events)
+        except Exception:
+            logger.exception('Query server on %s failed', self.path)
+        finally:
+            for client in list(self.clients.values()):
+                self.disconnect(client)
+            self.selector.close()
+            self.server.close()
+            os.close(self._wakeupReceiver)
+
+    def handle_accept(self, server, events):
+        try:
+            connection, _ = server.accept()
+        except OSError as e:
+            logger.warning('Failed to accept a query client. Error message: %s', e)
+            return
+        connection.setblocking(False)
+        self.clients[connection] = QueryClient(connection)
+        self.selector.register(connection, selectors.EVENT_READ, self.handle_client)
+
+    def handle_wakeup(self, receiver, events):
+        """
+        Sends the changes of the status since the last wake up to the subscribers, every subscriber in one go
+        """
+        try:
+            if not os.read(receiver, 4096):
+                self.shouldRun.value = 0  # Our parent is gone
+                return
+            while os.read(receiver, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        offset = time() - monotonic()
+        notified = {}
+        for rig in self.histories:
+            for fields, record in self.changes(rig):
+                message = None
+                for client in list(self.clients.values()):
+                    if client.subscription is None:
+                        continue
+                    subscribedRig, subscribedFields = client.subscription
+                    if subscribedRig is not None and subscribedRig != rig:
+                        continue
+                    if subscribedFields is not None and not subscribedFields.intersection(fields):
+                        continue
+                    if message is None:
+                        # Encoded once for all the subscribers
+                        message = encode({'rig': rig, 'changed': fields, 'status': record_to_dict(record, offset),
+                                          'state': self.state(rig)})
+                    self.send(client, message, flush=False)
+                    notified[client.connection] = client
+        for client in notified.values():
+            if client.connection in self.clients:
+                self.flush(client)
+
+    def changes(self, rig):
+        """
+        Returns the changes of the status of a rig appended to its history since the last call
+        as a list of (the fields that changed, the new status)
+        """
+        records, self.appended[rig] = self.histories[rig].since(self.appended.get(rig, 0))
+        changes = []
+        previous = self.previous.get(rig)
+        for record in records:
+            if previous is not None:
+                fields = [field for field in FIELDS if record[field] != previous[field]]
+                if fields:
+                    changes.append((fields, record))
+            previous = record
+        self.previous[rig] = previous
+        return changes
+
+    def state(self, rig):
+        return self.states[self.stateSlots[rig].get()]
+
+    def handle_client(self, connection, events):
+        client = self.clients[connection]
+        if events & selectors.EVENT_WRITE:
+            self.flush(client)
+        if events & selectors.EVENT_READ and connection in self.clients:
+            try:
+                data = connection.recv(QUERY_LINE_LIMIT)
+            except BlockingIOError:
+                return
+            except OSError:
+                data = b''
+            if not data:
+                self.disconnect(client)
+                return
+            client.received += data
+            while connection in self.clients:
+                line, newline, rest = client.received.partition(b'\n')
+                if not newline:
+                    break
+                client.received = rest
+                if line.strip():
+                    self.send(client, encode(self.answer(client, line)))
+            if len(client.received) > QUERY_LINE_LIMIT and connection in self.clients:
+                logger.warning('Query client sent a request of more than %d bytes. Disconnecting it', QUERY_LINE_LIMIT)
+                self.disconnect(client)
+
+    def answer(self, client, line):
+        """
+        Returns the reply to a request line
+        """
+        try:
+            line = line.decode().strip()
+            request = json.loads(line) if line.startswith('{') else {'query': line}
+        except ValueError as e:
+            return {'error': f'Invalid request: {e}'}
+        query = request.get('query')
+        if query not in QUERIES:
+            return {'error': f'Unknown query {query}. The queries are {list(QUERIES)}'}
+        if query == 'rigs':
+            return {'rigs': list(self.histories)}
+
+        rig = None
+        if 'rig' in request or len(self.histories) == 1:
+            rig = request.get('rig', next(iter(self.histories)))
+            if rig not in self.histories:
+                return {'error': f'Unknown rig {rig}. The rigs are {list(self.histories)}'}
+
+        if query == 'subscribe':
+            fields = request.get('fields')
+            if fields is not None:
+                if not isinstance(fields, list) or set(fields) - set(FIELDS):
+                    return {'error': f'fields must be a list of {list(FIELDS)}'}
+                fields = frozenset(fields)
+            if client.subscription is None:
+                if not self.subscribers.value:
+                    # The loop did not wake us up while nobody was subscribed. Skip what we missed
+                    for subscribedRig in self.histories:
+                        self.changes(subscribedRig)
+                self.subscribers.value += 1
+            client.subscription = (rig, fields)
+            return {'subscribed': rig, 'fields': sorted(fields) if fields is not None else None}
+
+        if rig not in self.histories:
+            return {'error': f'{query} needs a rig. The rigs are {list(self.histories)}'}
+        if query == 'state':
+            return {'rig': rig, 'state': self.state(rig)}
+
+        offset = time() - monotonic()
+        if query == 'status':
+            last = self.histories[rig].last()
+            return {'rig': rig,
+                    'status': record_to_dict(last[0], offset) if len(last) else None,
+                    'state': self.state(rig),
+                    'linkAlive': bool(len(last)) and monotonic() - float(last[0]['received']) < self.linkTimeout,
+                    }
+
+        seconds = request.get('seconds')
+        if seconds is not None and (not isinstance(seconds, (int, float)) or isinstance(seconds, bool)):
+            return {'error': f'seconds must be a number, not {seconds}'}
+        records = self.histories[rig].between(None if seconds is None else monotonic() - seconds)
+        records['received'] += offset
+        return {'rig': rig, 'history': {field: records[field].tolist() for field in records.dtype.names}}
+
+    def send(self, client, message, flush=True):
+        """
+        Queues an encoded message for a client and, unless flush is False, sends what it can without blocking
+        """
+        if client.connection not in self.clients:
+            return
+        client.pending += message
+        if len(client.pending) > QUERY_BUFFER_LIMIT:
+            logger.warning('Query client is %d bytes behind. Disconnecting it', len(client.pending))
+            self.disconnect(client)
+            return
+        if flush:
+            self.flush(client)
+
+    def flush(self, client):
+        try:
+            sent = client.connection.send(client.pending)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self.disconnect(client)
+            return
+        del client.pending[:sent]
+        if bool(client.pending) != client.writing:
+            client.writing = bool(client.pending)
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if client.writing else 0)
+            self.selector.modify(client.connection, events, self.handle_client)
+
+    def disconnect(self, client):
+        if self.clients.pop(client.connection, None) is None:
+            return
+        if client.subscription is not None:
+            self.subscribers.value -= 1
+        self.selector.unregister(client.connection)
+        client.connection.close()
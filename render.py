@@ -0,0 +1,224 @@
+"""Renders the status light effects headless, on a virtual clock and as fast as the CPU allows.
+
+An effect, or a scenario of FPGA status going through the state machine, is run for a number of seconds
+of simulated time and sampled at a fixed frame rate. The frames are the whole frames the OPC server
+would get, returned as a NumPy array of shape (frames, pixels, 3) or written to a .npy capture file:
+
+    python render.py effect sineBeat '{"color": [50, 50, 50], "frequency": 2}' --seconds 10 --output idle.npy
+    python render.py scenario scenario.json --seconds 30 --fps 120
+
+A scenario file lists the status as [time, mainState, actionState, timer], the state codes of the FPGA.
+The same inputs always render the same frames, so captures can be compared across changes.
+"""
+from collections import namedtuple
+from time import perf_counter
+import argparse
+import json
+import logging
+
+import numpy
+from numpy.lib.format import open_memmap
+
+from LEDs import StatusLED, VirtualClock
+from metrics import Registry
+from sharedstate import CommandQueue, LatestValue
+from StatusMessage import FPGAStatusRecord
+from StatusRunner import (STATES, TRANSITIONS, COMMAND_EFFECTS, FRAME_PIXELS, RIGS, FRAME_RATE, MIN_FRAME_RATE,
+                          COALESCE_STATUS, FSMachine, StatusDispatcher)
+
+logger = logging.getLogger(__name__)
+
+RENDER_FPS = 60.0
+RENDER_COMMAND = 'render'  # The command showing the effect rendered by render_effect
+
+## A status of a scenario and the simulated time in seconds it arrives at
+TimedStatus = namedtuple('TimedStatus', ['time', 'status'])
+
+
+class FrameRecorder:
+    """
+    Stands in for the OPC client of a StatusLED and keeps the last frame sent
+    """
+    def __init__(self, pixels=FRAME_PIXELS):
+        self.frame = bytes(3 * pixels)
+        self.framesSent = 0
+
+    def put_pixel_bytes(self, pixel_bytes, channel=0):
+        self.frame = pixel_bytes
+        self.framesSent += 1
+        return True
+
+    def disconnect(self):
+        pass
+
+
+class HeadlessLEDs:
+    """
+    A StatusLED on a virtual clock whose frames are recorded instead of sent, and the commands it runs.
+    The effects are stepped one frame at a time by sample()
+    """
+    def __init__(self, effects=COMMAND_EFFECTS, rig=RIGS[0], frameRate=FRAME_RATE, minFrameRate=MIN_FRAME_RATE):
+        self.clock = VirtualClock()
+        self.recorder = FrameRecorder()
+        self.effectQueue = CommandQueue()
+        self.timerSlot = LatestValue()
+        self.metrics = Registry()
+        self.LEDs = StatusLED(effectQueue=self.effectQueue,
+                              timerSlot=self.timerSlot,
+                              totalLEDs=sum(rig.ringLEDs),
+                              ringStart=rig.ringStart,
+                              ringsLEDs=rig.ringLEDs,
+                              cabinetStart=rig.cabinetStart,
+                              cabinetLEDs=rig.cabinetLEDs,
+                              frameRate=frameRate,
+                              minFrameRate=minFrameRate,
+                              metrics=self.metrics,
+                              effects=effects,
+                              timeSource=self.clock,
+                              client=self.recorder,
+                              )
+        self.renderFrame = None
+        self.LEDs.setLEDs(None)
+
+    def runCommand(self, command, trace=None):
+        """
+        Replaces the running effect with the one of a command, like the LED process does
+        """
+        if self.renderFrame is not None:
+            self.LEDs.stopEffect()
+            self.LEDs.endCommand()
+            self.renderFrame = None
+        self.LEDs.startCommand(command, trace)
+        self.renderFrame = self.LEDs.effectRenderer(command)
+        if self.renderFrame is None:
+            self.LEDs.endCommand()
+
+    def runPostedCommands(self):
+        while self.effectQueue.pending():
+            command, args, trace = self.effectQueue.get()
+            self.runCommand(command, trace)
+
+    def sample(self, t):
+        """
+        Moves the clock to t seconds and returns the frame the LEDs show then as RGB bytes
+        """
+        self.clock.advance(t - self.clock.now())
+        self.runPostedCommands()
+        if self.renderFrame is not None and not self.LEDs.stepEffect(self.renderFrame):
+            self.LEDs.stopEffect()
+            self.LEDs.endCommand()
+            self.renderFrame = None
+        return self.recorder.frame
+
+    def close(self):
+        self.LEDs.close()
+
+
+def _frames(count, output):
+    """
+    Returns an array for count frames, mapped to the .npy file output unless it is None
+    """
+    shape = (count, FRAME_PIXELS, 3)
+    if output is None:
+        return numpy.empty(shape, dtype=numpy.uint8)
+    return open_memmap(output, mode='w+', dtype=numpy.uint8, shape=shape)
+
+
+def _render(leds, seconds, fps, output, before=lambda t: None):
+    """
+    Samples the LEDs every 1/fps seconds of simulated time. before(t) runs ahead of every frame
+    """
+    frames = _frames(int(round(seconds * fps)), output)
+    try:
+        for i in range(len(frames)):
+            t = i / fps
+            before(t)
+            frames[i] = numpy.frombuffer(leds.sample(t), dtype=numpy.uint8).reshape(FRAME_PIXELS, 3)
+    finally:
+        leds.close()
+    if output is not None:
+        frames.flush()
+    return frames
+
+
+def render_effect(effect, parameters, seconds, fps=RENDER_FPS, output=None, rig=RIGS[0]):
+    """
+    Renders an effect of StatusLED, e.g. render_effect('sineBeat', {'color': [50, 50, 50]}, 10)
+    :str effect: the name of the effect
+    :dict parameters: the parameters of its renderer
+    :float seconds: simulated time to render
+    :float fps: frames per second of simulated time
+    :str output: a .npy file to write the frames to as they are rendered. They are kept in memory if None
+    :RigConfig rig: the layout of the LEDs
+    :return: the frames as an array of shape (frames, pixels, 3) of uint8
+    """
+    leds = HeadlessLEDs(effects={RENDER_COMMAND: (effect, dict(parameters))}, rig=rig, frameRate=fps)
+    leds.runCommand(RENDER_COMMAND)
+    return _render(leds, seconds, fps, output)
+
+
+def render_scenario(statuses, seconds, fps=RENDER_FPS, output=None, effects=COMMAND_EFFECTS, rig=RIGS[0],
+                    coalesce=COALESCE_STATUS):
+    """
+    Renders the effects of a scenario of FPGA status going through the state machine of StatusRunner.
+    :list statuses: TimedStatus or (time, FPGAStatusRecord) in the order they arrive
+    :dict effects: the effect shown on every command of the machine
+    :bool coalesce: only act on the newest status arriving within a frame, keeping the state changes
+    The other parameters are the ones of render_effect
+    """
+    leds = HeadlessLEDs(effects=effects, rig=rig, frameRate=fps)
+    machine = FSMachine(states=STATES,
+                        transitions=TRANSITIONS,
+                        timerSlot=leds.timerSlot,
+                        effectQueue=leds.effectQueue,
+                        frameBuffer=None,
+                        metrics=leds.metrics,
+                        startLEDs=False,
+                        backend='builtin',
+                        )
+    ## The status go through the same dispatch as the ones of the FPGA, a frame worth of them at a time
+    dispatcher = StatusDispatcher(machine, leds.timerSlot, leds.metrics, coalesce=coalesce, historyDir=None)
+    pending = [TimedStatus(*status) for status in statuses]
+
+    def arrive(t):
+        burst = []
+        while pending and pending[0].time <= t:
+            burst.append((pending.pop(0).status, None))
+        if burst:
+            dispatcher.receive_statuses(burst)
+
+    return _render(leds, seconds, fps, output, arrive)
+
+
+def load_scenario(path):
+    """
+    Reads a scenario file: a JSON list of [time, mainState, actionState, timer]
+    """
+    with open(path) as f:
+        entries = json.load(f)
+    return [TimedStatus(time, FPGAStatusRecord(mainState, actionState, timer, 'WhatEver'))
+            for time, mainState, actionState, timer in entries]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='kind', required=True)
+    effectParser = subparsers.add_parser('effect', help='render an effect of StatusLED')
+    effectParser.add_argument('effect', help='the effect, e.g. sineBeat')
+    effectParser.add_argument('parameters', nargs='?', default='{}', help='its parameters as a JSON object')
+    scenarioParser = subparsers.add_parser('scenario', help='render a scenario of FPGA status')
+    scenarioParser.add_argument('scenario', help='a JSON file of [time, mainState, actionState, timer]')
+    for subparser in (effectParser, scenarioParser):
+        subparser.add_argument('--seconds', type=float, default=10.0, help='simulated time. Defaults to %(default)s')
+        subparser.add_argument('--fps', type=float, default=RENDER_FPS, help='frames per second. Defaults to %(default)s')
+        subparser.add_argument('--output', help='write the frames to this .npy file')
+    args = parser.parse_args()
+
+    start = perf_counter()
+    if args.kind == 'effect':
+        frames = render_effect(args.effect, json.loads(args.parameters), args.seconds, args.fps, args.output)
+    else:
+        frames = render_scenario(load_scenario(args.scenario), args.seconds, args.fps, args.output)
+    elapsed = perf_counter() - start
+    print(f'{len(frames)} frames of {args.seconds:g} s in {elapsed:.3f} s: {len(frames) / elapsed:.0f} frames per second, '
+          f'{args.seconds / elapsed:.1f} times real time')
@@ -0,0 +1,74 @@
+"""Values shared between the status process and the LED process through shared memory.
+
+They are read with plain memory reads, so they are cheap enough for the frame loops.
+They live in shared memory, so they have to be created before the processes using them are started.
+"""
+from multiprocessing import Queue, RawValue
+
+
+class LatestValue:
+    """
+    Holds the latest value of a continuously updated scalar, like the experiment timer.
+
+    There must be a single writer. Readers never block and always get the newest value in O(1),
+    so there is nothing to drain. The sequence counter is odd while a write is in progress,
+    which lets the readers detect a torn read and retry.
+    """
+    def __init__(self, value=0.0, typecode='d'):
+        self._sequence = RawValue('Q', 0)
+        self._value = RawValue(typecode, value)
+
+    def set(self, value):
+        self._sequence.value += 1
+        self._value.value = value
+        self._sequence.value += 1
+
+    def get(self):
+        return self.read()[0]
+
+    def read(self):
+        """
+        Returns the value and the number of times it has been set
+        """
+        while True:
+            sequence = self._sequence.value
+            value = self._value.value
+            if not sequence % 2 and sequence == self._sequence.value:
+                return value, sequence // 2
+
+
+class CommandQueue:
+    """
+    A queue of commands for the LED process that also tells a running effect when it has to stop.
+
+    The commands go through a multiprocessing Queue as before. On top of it the number of posted
+    commands is kept in shared memory and the consumer counts the ones it took, so pending() is
+    a plain memory read that a frame loop can afford, unlike Queue.empty().
+    There must be a single producer process and a single consumer process.
+    """
+    def __init__(self):
+        self._queue = Queue()
+        self._posted = RawValue('Q', 0)
+        self._taken = 0
+
+    def put(self, command):
+        # Count first so a running effect stops even before the command reaches the queue
+        self._posted.value += 1
+        self._queue.put(command)
+
+    def get(self, block=True, timeout=None):
+        command = self._queue.get(block, timeout)
+        self._taken += 1
+        return command
+
+    def qsize(self):
+        """
+        Returns the approximate number of commands in the queue
+        """
+        return self._queue.qsize()
+
+    def pending(self):
+        """
+        Returns True if a command was posted that the consumer did not take yet
+        """
+        return self._posted.value > self._taken
@@ -0,0 +1,121 @@
+"""A small table-driven state machine, a lightweight alternative to the HierarchicalMachine of transitions.
+
+It takes the same states and transitions tables and behaves the same way on them:
+- nested states are named parent_child
+- a source of '*' matches every state, and a parent state matches its children
+- a trigger method returning True is added to the model for every transition
+- a transition calls on_exit_<state> on the states it leaves, innermost first, then on_enter_<state>
+  on the states it enters, outermost first, if the model defines them. A transition to the current
+  state leaves it and enters it again
+- a trigger that does not apply to the current state raises MachineError
+Everything is resolved when the machine is created, so a transition is a dictionary lookup and the
+calls to the callbacks it needs.
+Only [trigger, source, dest] transitions are supported: no conditions nor before or after callbacks.
+"""
+from functools import partial
+
+
+class MachineError(Exception):
+    def __init__(self, value):
+        super().__init__(value)
+        self.value = value
+
+
+class TableMachine:
+    separator = '_'
+
+    def __init__(self, model, states, transitions, initial, auto_transitions=False):
+        """
+        :model: the object holding the state, the trigger methods and the callbacks
+        :list states: the states. Either a name or a dict with a name and its children
+        :list transitions: the transitions as [trigger, source, dest]. source can be a list of states
+        :str initial: the state to start in. Its on_enter callback is not called
+        """
+        if auto_transitions:
+            raise ValueError('Auto transitions are not supported')
+        self.model = model
+        self.parents = {}  # Every state and its parent
+        self._addStates(states, None)
+        if initial not in self.parents:
+            raise ValueError(f'Unknown initial state {initial}')
+
+        ## (trigger, state) -> (destination, exit callbacks, enter callbacks)
+        self.table = {}
+        for transition in transitions:
+            if isinstance(transition, dict):
+                if set(transition) != {'trigger', 'source', 'dest'}:
+                    raise ValueError(f'Only trigger, source and dest are supported: {transition}')
+                trigger, source, dest = transition['trigger'], transition['source'], transition['dest']
+            elif len(transition) == 3:
+                trigger, source, dest = transition
+            else:
+                raise ValueError(f'Only [trigger, source, dest] transitions are supported: {transition}')
+            if dest not in self.parents:
+                raise ValueError(f'Unknown destination {dest} of {trigger}')
+            sources = source if isinstance(source, (list, tuple)) else [source]
+
+            for state in self.parents:
+                if '*' in sources or any(s in self.lineage(state) for s in sources):
+                    # Like transitions, the first transition of a trigger matching the state wins
+                    self.table.setdefault((trigger, state), (dest,) + self._callbacks(state, dest))
+            if not hasattr(model, trigger):
+                setattr(model, trigger, partial(self.trigger, trigger))
+
+        model.state = initial
+
+    def _addStates(self, states, parent):
+        for state in states:
+            children = []
+            if isinstance(state, dict):
+                if set(state) - {'name', 'children'}:
+                    raise ValueError(f'Only the name and children of a state are supported: {state}')
+                children = state.get('children', [])
+                state = state['name']
+            name = parent + self.separator + state if parent else state
+            self.parents[name] = parent
+            self._addStates(children, name)
+
+    def lineage(self, state):
+        """
+        Returns the state and its ancestors, outermost first
+        """
+        lineage = []
+        while state is not None:
+            lineage.insert(0, state)
+            state = self.parents[state]
+        return lineage
+
+    def _callbacks(self, source, dest):
+        """
+        Returns the exit and enter callbacks of the model to call going from source to dest
+        """
+        sourceLineage = self.lineage(source)
+        destLineage = self.lineage(dest)
+        common = 0
+        while (common < min(len(sourceLineage), len(destLineage)) and
+               sourceLineage[common] == destLineage[common]):
+            common += 1
+        if source == dest:
+            common -= 1  # Leave and enter the state again
+
+        exits = [getattr(self.model, 'on_exit_' + state) for state in reversed(sourceLineage[common:])
+                 if hasattr(self.model, 'on_exit_' + state)]
+        enters = [getattr(self.model, 'on_enter_' + state) for state in destLineage[common:]
+                  if hasattr(self.model, 'on_enter_' + state)]
+        return exits, enters
+
+    @property
+    def state(self):
+        return self.model.state
+
+    def trigger(self, trigger):
+        try:
+            dest, exits, enters = self.table[(trigger, self.model.state)]
+        except KeyError:
+            raise MachineError(f"Can't trigger event '{trigger}' from state {self.model.state}!") from None
+        for callback in exits:
+            callback()
+        self.model.state = dest
+        for callback in enters:
+            callback()
+        return True
@@ -0,0 +1,113 @@
+"""Tests of the status LED effects, run headless on a virtual clock
+"""
+import pytest
+
+from LEDs import FrameClock, MonotonicClock, VirtualClock
+from render import HeadlessLEDs
+
+
+@pytest.fixture
+def leds():
+    leds = HeadlessLEDs()
+    yield leds
+    leds.close()
+
+
+## Transition latency
+
+def test_the_static_buffer_is_not_the_first_frame_of_a_command(leds):
+    LEDs = leds.LEDs
+    LEDs.startCommand('on_enter_idle', {'enqueued': 0.0})
+    LEDs.setLEDs(None)  # The static buffer, sent while the effect is set up
+    LEDs.refreshFrame()
+    assert not LEDs.transitionLatencies
+
+    renderFrame = LEDs.effectRenderer('on_enter_idle')
+    assert LEDs.stepEffect(renderFrame)
+    assert [command for command, _ in LEDs.transitionLatencies] == ['on_enter_idle']
+    assert LEDs.stepEffect(renderFrame)
+    assert len(LEDs.transitionLatencies) == 1
+
+
+def test_back_to_back_commands_are_measured_from_their_own_frame(leds):
+    leds.runCommand('on_enter_idle', {'enqueued': 0.0})
+    leds.runCommand('on_enter_error', {'enqueued': 0.0})  # Sends the static buffer as it stops the idle effect
+    assert not leds.LEDs.transitionLatencies
+    leds.sample(0.0)
+    assert [command for command, _ in leds.LEDs.transitionLatencies] == ['on_enter_error']
+
+
+## Live parameters
+
+def test_live_parameters_out_of_range_are_ignored(leds):
+    leds.runCommand('on_enter_idle')
+    leds.sample(0.0)
+    LEDs = leds.LEDs
+    assert LEDs.setParameters('on_enter_idle', {'frequency': 0, 'duty': 2, 'color': [0, 0, 200]}) is None
+    assert LEDs.frequency() == 1.0
+    assert LEDs.liveParameters == {'color': [0, 0, 200]}
+    frames = [leds.sample(t / 60) for t in range(1, 60)]
+    assert max(max(frame[2::3]) for frame in frames) > 100
+    assert max(max(frame[0::3]) for frame in frames) <= 20  # Red is only the glow
+
+
+def test_live_frequency_keeps_the_waves_where_they_are(leds):
+    leds.runCommand('on_enter_idle')
+    leds.sample(0.0)
+    leds.sample(0.3)
+    LEDs = leds.LEDs
+    phase = LEDs.clock() * LEDs.frequency()
+    LEDs.setParameters('on_enter_idle', {'frequency': 4.0})
+    assert LEDs.clock() * LEDs.frequency() == pytest.approx(phase)
+
+
+def test_parameters_of_another_command_are_dropped(leds):
+    leds.runCommand('on_enter_idle')
+    leds.LEDs.setParameters('on_enter_error', {'frequency': 4.0})
+    assert leds.LEDs.frequency() == 1.0
+
+
+
+## Clocks
+
+def test_virtual_clock_moves_when_told_to():
+    clock = VirtualClock(10.0)
+    assert clock.now() == 10.0
+    clock.sleep(.5)
+    clock.advance(.25)
+    assert clock.now() == 10.75
+
+
+def test_monotonic_clock_never_goes_back():
+    clock = MonotonicClock()
+    times = [clock.now() for _ in range(1000)]
+    assert times == sorted(times)
+
+
+def test_frame_clock_follows_its_source_at_the_speed_of_the_effect():
+    source = VirtualClock()
+    clock = FrameClock(source)
+    source.advance(1.0)
+    clock.update()
+    assert clock() == 1.0
+    source.advance(1.0)
+    clock.update(speed=2.0)  # A change of speed only changes the pace from then on
+    assert clock() == 3.0
+    clock.scale(.5)
+    assert clock() == 1.5
+    clock.reset()
+    source.advance(.25)
+    clock.update()
+    assert clock() == .25
+
+
+def test_effects_render_the_same_frames_on_the_virtual_clock():
+    def frames():
+        leds = HeadlessLEDs()
+        leds.runCommand('on_enter_action_experiment')
+        leds.timerSlot.set(.5)
+        try:
+            return [leds.sample(t / 30) for t in range(60)]
+        finally:
+            leds.close()
+    assert frames() == frames()
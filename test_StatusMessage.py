@@ -0,0 +1,44 @@
+"""Tests of the status encodings
+"""
+import pytest
+
+from StatusMessage import BINARY_STATUS, FPGAStatusRecord, decode_status, encode_binary, encode_json, is_multicast
+
+
+def test_binary_round_trip():
+    record = FPGAStatusRecord(5, 7, 12.5, None)
+    datagram = encode_binary(record)
+    assert len(datagram) == BINARY_STATUS.size
+    assert decode_status(datagram) == record
+
+
+def test_json_round_trip():
+    record = FPGAStatusRecord(3, 0, 1.25, {'Laser': 'on'})
+    assert decode_status(encode_json(record)) == record
+    assert decode_status(encode_json(record._replace(other=None))) == record._replace(other=None)
+
+
+def test_json_as_the_rt_host_sends_it():
+    datagram = b'{"FPGA Main State": "4", "Action State": "0", "Timer": "0.5", "Other Status Elements": "x"}'
+    assert decode_status(datagram) == FPGAStatusRecord(4, 0, 0.5, 'x')
+
+
+@pytest.mark.parametrize('datagram', [
+    b'',
+    b'not a status',
+    b'\xff\xfe',
+    b'[1, 2, 3]',
+    b'{"FPGA Main State": "4"}',
+    b'{"FPGA Main State": "four", "Action State": "0", "Timer": "0"}',
+    bytes([2]) + encode_binary(FPGAStatusRecord(1, 1, 1.0, None))[1:],  # A version we do not know
+])
+def test_decode_rejects(datagram):
+    with pytest.raises(ValueError):
+        decode_status(datagram)
+
+
+
+@pytest.mark.parametrize('host, multicast', [('239.255.66.67', True), ('224.0.0.1', True), ('127.0.0.1', False),
+                                             ('localhost', False), ('ff02::1', False)])
+def test_is_multicast(host, multicast):
+    assert is_multicast(host) == multicast
@@ -0,0 +1,142 @@
+"""Tests of the status handling of StatusRunner. They run without an FPGA nor an OPC server:
+
+    python -m pytest -q
+"""
+from multiprocessing import active_children
+from types import SimpleNamespace
+import os
+import socket
+import uuid
+
+import pytest
+
+from metrics import Registry
+from sharedstate import CommandQueue, LatestValue
+from StatusMessage import FPGAStatusRecord
+from StatusRunner import STATES, TRANSITIONS, DEFAULT_CONFIG, FPGAStatus, FSMachine, StatusDispatcher
+
+
+def status(mainState, actionState=0, timer=0.0):
+    return FPGAStatusRecord(mainState, actionState, timer, None)
+
+
+def machine(initialState='start'):
+    """
+    Returns a machine with the builtin backend and without LED process
+    """
+    return FSMachine(states=STATES, transitions=TRANSITIONS, timerSlot=LatestValue(), effectQueue=CommandQueue(),
+                     frameBuffer=None, metrics=Registry(), initialState=initialState, startLEDs=False,
+                     backend='builtin')
+
+
+def coalesce(current, statuses):
+    return FPGAStatus.coalesce_statuses(SimpleNamespace(currentFPGAStatus=current), statuses)
+
+
+## Coalescing
+
+def test_coalesce_keeps_the_state_changes_and_the_newest():
+    burst = [(status(3, 0, 1.0), 'a'), (status(5, 1, 2.0), 'b'), (status(5, 1, 3.0), 'c'),
+             (status(3, 0, 4.0), 'd'), (status(3, 0, 5.0), 'e')]
+    assert coalesce(status(3), burst) == [burst[1], burst[3], burst[4]]
+    assert coalesce(status(3), burst[:1]) == burst[:1]
+    assert coalesce(status(3), []) == []
+
+
+def test_coalesce_keeps_a_newest_state_change_once():
+    burst = [(status(4), 'a')]
+    assert coalesce(status(3), burst) == burst
+    burst = [(status(3, 0, 1.0), 'a'), (status(4), 'b')]
+    assert coalesce(status(3), burst) == burst[1:]
+
+
+def test_coalesce_keeps_the_first_status_ever_received():
+    burst = [(status(3), 'idle'), (status(4), 'error')]
+    assert coalesce(None, burst) == burst
+    burst = [(status(3, 0, 1.0), 'a'), (status(3, 0, 2.0), 'b'), (status(3, 0, 3.0), 'c')]
+    assert coalesce(None, burst) == [burst[0], burst[2]]
+
+
+def test_coalesced_status_still_go_to_the_history():
+    dispatcher = StatusDispatcher(machine(), LatestValue(), Registry(), coalesce=True, historyDir=None)
+    burst = [(status(3, 0, float(i)), {'received': float(i)}) for i in range(5)]
+    dispatcher.receive_statuses(burst)
+    assert dispatcher.currentFPGAStatus == status(3, 0, 4.0)
+    assert list(dispatcher.history.records()['timer']) == [0.0, 1.0, 2.0, 3.0, 4.0]
+    assert list(dispatcher.history.records()['received']) == [0.0, 1.0, 2.0, 3.0, 4.0]
+
+
+def test_the_first_status_changes_every_field():
+    assert FPGAStatus.changed_fields(None, None, status(3)) == list(FPGAStatusRecord._fields)
+    assert FPGAStatus.changed_fields(None, status(3), status(3, 0, 1.0)) == ['timer']
+
+
+## Transition table
+
+@pytest.mark.parametrize('codes, state', [
+    ((3, 0), 'idle'),
+    ((3, 12), 'idle'),  # The action state code does not matter outside of the action state
+    ((4, 99), 'error'),
+    ((5, 1), 'action_experiment'),
+    ((5, 7), 'action_snap'),
+    ((5, 11), 'action_mosaic'),
+])
+def test_transition_table(codes, state):
+    fsm = machine(initialState='idle' if codes[0] == 5 else 'start')
+    table = FPGAStatus.compile_transition_table(fsm)
+    FPGAStatus.find_transition(table, codes)()
+    assert fsm.state == state
+
+
+@pytest.mark.parametrize('codes', [(9, 0), (5, 12), (5, 99)])
+def test_transition_table_leaves_out_unknown_codes(codes):
+    assert FPGAStatus.find_transition(FPGAStatus.compile_transition_table(machine()), codes) is None
+
+
+## Live parameters
+
+def test_set_effect_parameters_rejects_what_cannot_be_rendered():
+    posted = []
+    receiver = SimpleNamespace(machine=SimpleNamespace(state='idle'), config=DEFAULT_CONFIG,
+                               post_control=lambda *message: posted.append(message))
+    for parameters in ({'frequency': 0}, {'color': [0, 0, 256]}, {'duty': .5}):
+        with pytest.raises(ValueError):
+            FPGAStatus.set_effect_parameters(receiver, **parameters)
+    assert not posted
+    FPGAStatus.set_effect_parameters(receiver, frequency=2.0)
+    assert posted == [('setParameters', 'on_enter_idle', {'frequency': 2.0})]
+    receiver.machine.state = 'start'
+    with pytest.raises(ValueError):
+        FPGAStatus.set_effect_parameters(receiver, frequency=2.0)  # No effect to change
+
+
+## Start up
+
+def test_a_port_taken_stops_the_led_process():
+    taken = socket.socket()
+    taken.bind(('127.0.0.1', 0))
+    taken.listen()
+    try:
+        with pytest.raises(OSError):
+            FPGAStatus('127.0.0.1', 0, metricsPort=taken.getsockname()[1], querySocket=None, historyDir=None,
+                       frameBufferName='test_status_' + uuid.uuid4().hex[:12])
+    finally:
+        taken.close()
+    assert not active_children()
+    assert not [name for name in os.listdir('/dev/shm') if name.startswith('test_status_')]
+
+
+def test_two_controllers_run_side_by_side(tmp_path):
+    # A second consumer of the same status, with its own metrics port, query socket and frame buffer
+    names = ['test_status_' + uuid.uuid4().hex[:12] for _ in range(2)]
+    controllers = []
+    try:
+        for name in names:
+            controllers.append(FPGAStatus('127.0.0.1', 0, metricsPort=0, querySocket=str(tmp_path / name),
+                                          historyDir=None, frameBufferName=name))
+        assert len({controller.metricsServer.server.server_address for controller in controllers}) == 2
+        assert sorted(os.listdir(tmp_path)) == sorted(names)
+    finally:
+        for controller in controllers:
+            controller.close()
+    assert not [name for name in os.listdir('/dev/shm') if name in names]
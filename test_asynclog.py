@@ -0,0 +1,35 @@
+"""Tests of the rate limited logging
+"""
+import logging
+
+import asynclog
+from asynclog import RateLimitFilter
+
+
+def record(msg, *args, name='StatusRunner'):
+    return logging.LogRecord(name, logging.WARNING, __file__, 0, msg, args, None)
+
+
+def test_rate_limit_cuts_a_flood_and_counts_the_dropped(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(asynclog, 'monotonic', lambda: now[0])
+    limit = RateLimitFilter(period=10.0, burst=3)
+    passed = [limit.filter(record('Bad datagram from %s', i)) for i in range(10)]
+    assert passed == [True] * 3 + [False] * 7
+
+    now[0] = 10.0
+    first = record('Bad datagram from %s', 10)
+    assert limit.filter(first)
+    assert first.getMessage() == 'Bad datagram from 10 (7 similar messages dropped)'
+    second = record('Bad datagram from %s', 11)
+    assert limit.filter(second)
+    assert second.getMessage() == 'Bad datagram from 11'
+
+
+def test_rate_limit_keeps_messages_apart(monkeypatch):
+    monkeypatch.setattr(asynclog, 'monotonic', lambda: 0.0)
+    limit = RateLimitFilter(period=10.0, burst=1)
+    assert limit.filter(record('Bad datagram from %s', 1))
+    assert not limit.filter(record('Bad datagram from %s', 2))
+    assert limit.filter(record('Link lost'))
+    assert limit.filter(record('Bad datagram from %s', 3, name='LEDs'))
@@ -0,0 +1,53 @@
+"""Tests of the configuration file
+"""
+import pytest
+
+from config import compile_config
+from StatusRunner import DEFAULT_CONFIG, MACHINE_COMMANDS, FRAME_PIXELS
+
+
+def compile(data):
+    return compile_config(data, DEFAULT_CONFIG, MACHINE_COMMANDS, FRAME_PIXELS)
+
+
+def effect(command, **parameters):
+    """
+    Returns the effects setting of a command with its default effect and some of its parameters replaced
+    """
+    name, defaults = DEFAULT_CONFIG.effects[command]
+    return {command: {'effect': name, 'parameters': dict(defaults, **parameters)}}
+
+
+def test_compile_config_overrides_the_defaults():
+    config = compile({'frameRate': 30, 'effects': {'on_enter_action_snap': None}})
+    assert config.frameRate == 30.0
+    assert config.rigs == DEFAULT_CONFIG.rigs
+    assert 'on_enter_action_snap' not in config.effects
+    assert config.effects['on_enter_idle'] == DEFAULT_CONFIG.effects['on_enter_idle']
+    assert compile({'effects': effect('on_enter_idle', frequency=.5)}).effects['on_enter_idle'][1]['frequency'] == .5
+
+
+@pytest.mark.parametrize('data', [
+    [],
+    {'colour': True},
+    {'frameRate': 0},
+    {'frameRate': 30, 'minFrameRate': 60},
+    {'coalesce': 1},
+    {'rigs': []},
+    {'rigs': [{'host': 'localhost'}]},
+    {'rigs': [{'name': 'deepsim', 'ringLEDs': [1, 6, 16, 24], 'ringStart': FRAME_PIXELS - 10}]},
+    {'rigs': [{'name': 'a', 'port': 7000}, {'name': 'b', 'port': 7000}]},
+    {'rigs': [{'name': 'deepsim'}, {'name': 'deepsim', 'port': 7000}]},
+    {'effects': {'on_enter_idle': {'effect': 'rainbow', 'parameters': {}}}},
+    {'effects': effect('on_enter_idle', colour=[1, 2, 3])},
+    {'effects': effect('on_enter_idle', color=[1, 2, 300])},
+    {'effects': effect('on_enter_idle', frequency=0)},
+    {'effects': effect('on_enter_error', duty=1.5)},
+    {'effects': effect('on_enter_action_experiment', decay=-1)},
+    {'effects': effect('on_enter_action_experiment', speed=-2)},
+    {'effects': effect('on_enter_action_experiment', chaseRing=4)},
+    {'effects': {'on_enter_action_snap': {'effect': 'multiplePulse', 'parameters': {'pattern': [[[0, 0, 255], 0]]}}}},
+])
+def test_compile_config_rejects(data):
+    with pytest.raises(ValueError):
+        compile(data)
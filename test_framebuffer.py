@@ -0,0 +1,85 @@
+"""Tests of the shared-memory frame buffer
+"""
+from multiprocessing import Process, resource_tracker, shared_memory
+import os
+import struct
+import uuid
+
+import pytest
+
+from framebuffer import SharedFrameBuffer
+
+REGIONS = {'ring': (10, 4), 'cabinet': (0, 2)}
+HEADER_SIZE = 16 * len(REGIONS) + 8
+
+
+@pytest.fixture
+def name():
+    return 'test_frame_' + uuid.uuid4().hex[:12]
+
+
+def dead_pid():
+    process = Process(target=lambda: None)
+    process.start()
+    process.join()
+    return process.pid
+
+
+def leave_block(name, pids):
+    """
+    Leaves a block behind like processes that were killed: pids are the owners of the regions and the creator
+    """
+    block = shared_memory.SharedMemory(name=name, create=True, size=HEADER_SIZE + 3 * 16)
+    header = struct.pack('q' * (2 * len(REGIONS) + 1), pids[0], 1, pids[1], 1, pids[2])
+    block.buf[:len(header)] = header
+    block.buf[HEADER_SIZE:HEADER_SIZE + 3] = b'\xff\xff\xff'
+    resource_tracker.unregister(block._name, 'shared_memory')
+    block.close()
+
+
+def test_regions_are_shared(name):
+    frameBuffer = SharedFrameBuffer(16, REGIONS, name=name)
+    try:
+        other = SharedFrameBuffer(16, REGIONS, name=name, create=False)
+        region = other.claim('ring')
+        region.write([(1, 2, 3)] * 4)
+        assert frameBuffer.frame()[30:42] == bytes([1, 2, 3] * 4)
+        assert frameBuffer.version() == 1
+        other.close()
+    finally:
+        frameBuffer.close()
+
+
+def test_replaces_a_block_of_dead_processes(name):
+    pid = dead_pid()
+    leave_block(name, [pid, 0, pid])
+    frameBuffer = SharedFrameBuffer(16, REGIONS, name=name)
+    try:
+        assert frameBuffer.frame() == bytes(3 * 16)
+        assert frameBuffer.owner('ring') == 0
+    finally:
+        frameBuffer.close()
+
+
+def test_keeps_a_block_in_use(name):
+    frameBuffer = SharedFrameBuffer(16, REGIONS, name=name)
+    try:
+        region = frameBuffer.claim('cabinet')
+        region.write([(9, 9, 9)] * 2)
+        with pytest.raises(FileExistsError):
+            SharedFrameBuffer(16, REGIONS, name=name)
+        assert frameBuffer.frame()[:6] == bytes([9] * 6)
+    finally:
+        frameBuffer.close()
+
+
+def test_keeps_a_block_with_a_live_region_owner(name):
+    pid = dead_pid()
+    leave_block(name, [pid, os.getpid(), pid])
+    try:
+        with pytest.raises(FileExistsError):
+            SharedFrameBuffer(16, REGIONS, name=name)
+    finally:
+        block = shared_memory.SharedMemory(name=name)
+        block.close()
+        block.unlink()
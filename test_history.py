@@ -0,0 +1,68 @@
+"""Tests of the history of the status
+"""
+from multiprocessing import Process
+import threading
+import time
+
+import numpy
+
+from history import StatusHistory
+from StatusMessage import FPGAStatusRecord
+
+
+def status(mainState, actionState=0, timer=0.0):
+    return FPGAStatusRecord(mainState, actionState, timer, None)
+
+
+def test_history_wraps_around():
+    history = StatusHistory(size=4)
+    assert len(history) == 0 and len(history.records()) == 0
+    for i in range(10):
+        history.append(float(i), status(3, 0, float(i)))
+    assert len(history) == 4
+    assert list(history.records()['timer']) == [6.0, 7.0, 8.0, 9.0]
+    assert list(history.last(2)['timer']) == [8.0, 9.0]
+    assert list(history.between(7.0, 9.0)['received']) == [7.0, 8.0]
+    assert list(history.between(start=8.0)['received']) == [8.0, 9.0]
+
+    records, appended = history.since(8)
+    assert appended == 10 and list(records['timer']) == [8.0, 9.0]
+    records, appended = history.since(2)  # The ones overwritten are gone
+    assert list(records['timer']) == [6.0, 7.0, 8.0, 9.0]
+    history.append(10.0, status(3, 0, 10.0))
+    records, appended = history.since(appended)
+    assert appended == 11 and list(records['timer']) == [10.0]
+
+
+def test_history_waits_for_the_append():
+    history = StatusHistory(size=4)
+    history.append(1.0, status(3, 0, 1.0))
+    history._sequence.value += 1  # An append is under way
+    result = []
+    thread = threading.Thread(target=lambda: result.append(history.records()), daemon=True)
+    thread.start()
+    thread.join(.05)
+    assert not result
+    history._sequence.value -= 1
+    thread.join(1)
+    assert list(result[0]['timer']) == [1.0]
+
+
+def append_statuses(history, count):
+    for i in range(count):
+        history.append(float(i), status(3, 0, float(i)))
+
+
+def test_history_readers_never_see_a_torn_record():
+    history = StatusHistory(size=64)
+    writer = Process(target=append_statuses, args=(history, 20000))
+    writer.start()
+    try:
+        deadline = time.monotonic() + 10
+        while writer.is_alive() and time.monotonic() < deadline:
+            records = history.records()
+            assert numpy.array_equal(records['received'], records['timer'])
+            assert numpy.all(numpy.diff(records['received']) == 1)
+    finally:
+        writer.join()
+    assert list(history.last(1)['timer']) == [19999.0]
@@ -0,0 +1,37 @@
+"""Tests of the runtime metrics
+"""
+import random
+
+import pytest
+
+from metrics import STAGE_LATENCY_BUCKETS, Histogram, Registry
+
+
+def test_histogram_quantiles_follow_microsecond_samples():
+    rng = random.Random(1)
+    samples = sorted(rng.uniform(2e-6, 40e-6) for _ in range(1000))
+    histogram = Histogram('stage', 'A stage', buckets=STAGE_LATENCY_BUCKETS, quantiles=(.5, .9, .99))
+    for sample in samples:
+        histogram.observe(sample)
+    for q in histogram.quantiles:
+        exact = samples[int(q * len(samples)) - 1]
+        assert histogram.quantile(q) == pytest.approx(exact, rel=.5)
+    assert histogram.quantile(.5) < histogram.quantile(.99) < 50e-6
+
+
+def test_histogram_quantile_beyond_the_last_bucket():
+    histogram = Histogram('slow', 'Slow', buckets=(.1, 1.0))
+    assert histogram.quantile(.5) is None
+    histogram.observe(5.0)
+    assert histogram.quantile(.5) == 1.0
+
+
+def test_registry_exposes_labelled_metrics():
+    registry = Registry()
+    registry.labelled(rig='deepsim').counter('statusled_frames_total', 'Frames').inc(3)
+    registry.gauge('statusled_link_alive', 'Link').set(1)
+    exposed = registry.expose()
+    assert 'statusled_frames_total{rig="deepsim"} 3' in exposed
+    assert 'statusled_link_alive 1' in exposed
+    with pytest.raises(ValueError):
+        registry.gauge('statusled_link_alive', 'Link')
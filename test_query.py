@@ -0,0 +1,87 @@
+"""Tests of the status queries over the Unix domain socket
+"""
+import json
+import os
+import socket
+import uuid
+
+import pytest
+
+from query import QueryServer
+from StatusMessage import FPGAStatusRecord
+from StatusRunner import FPGAStatus
+
+
+def status(mainState, actionState=0, timer=0.0):
+    return FPGAStatusRecord(mainState, actionState, timer, None)
+
+
+@pytest.fixture
+def receiver(tmp_path):
+    # A single rig without a name, as the default configuration runs it
+    receiver = FPGAStatus('127.0.0.1', 0, metricsPort=None, querySocket=str(tmp_path / 'query.sock'),
+                          historyDir=None, frameBufferName='test_query_' + uuid.uuid4().hex[:12])
+    yield receiver
+    receiver.close()
+
+
+class Client:
+    def __init__(self, path):
+        self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.connection.settimeout(5)
+        self.connection.connect(path)
+        self.lines = self.connection.makefile('rb')
+
+    def read(self):
+        return json.loads(self.lines.readline())
+
+    def ask(self, request):
+        self.connection.sendall((request if isinstance(request, str) else json.dumps(request)).encode() + b'\n')
+        return self.read()
+
+    def close(self):
+        self.lines.close()
+        self.connection.close()
+
+
+def test_queries_round_trip(receiver):
+    client = Client(receiver.queryServer.path)
+    try:
+        assert client.ask('rigs') == {'rigs': ['deepsim']}
+        assert client.ask('status') == {'rig': 'deepsim', 'status': None, 'state': 'start', 'linkAlive': False}
+
+        receiver.receive_statuses([(status(3, 0, 1.5), None)])
+        reply = client.ask('status')
+        assert reply['rig'] == 'deepsim' and reply['state'] == 'idle' and reply['linkAlive']
+        assert {field: reply['status'][field] for field in ('mainState', 'actionState', 'timer')} == \
+            {'mainState': 3, 'actionState': 0, 'timer': 1.5}
+        assert client.ask({'query': 'state', 'rig': 'deepsim'}) == {'rig': 'deepsim', 'state': 'idle'}
+        assert client.ask({'query': 'history', 'seconds': 60})['history']['mainState'] == [3]
+        assert 'error' in client.ask({'query': 'state', 'rig': 'elsewhere'})
+        assert 'error' in client.ask('everything')
+    finally:
+        client.close()
+
+
+def test_subscription_follows_the_changes(receiver):
+    receiver.receive_statuses([(status(3), None)])
+    client = Client(receiver.queryServer.path)
+    try:
+        assert client.ask({'query': 'subscribe', 'fields': ['mainState']}) == \
+            {'subscribed': 'deepsim', 'fields': ['mainState']}
+        receiver.receive_statuses([(status(3, 0, 1.0), None)])  # Only the timer changed
+        receiver.receive_statuses([(status(4, 0, 1.0), None)])
+        change = client.read()
+        assert change['rig'] == 'deepsim' and change['changed'] == ['mainState'] and change['state'] == 'error'
+        assert change['status']['mainState'] == 4
+    finally:
+        client.close()
+
+
+def test_a_path_taken_leaks_nothing(tmp_path):
+    path = tmp_path / 'taken'
+    path.write_text('not a socket')
+    descriptors = os.listdir('/proc/self/fd')
+    with pytest.raises(OSError):
+        QueryServer({}, ['start'], 1.0, str(path))
+    assert os.listdir('/proc/self/fd') == descriptors
@@ -0,0 +1,51 @@
+"""Tests of the headless renderer
+"""
+import numpy
+
+from render import render_effect, render_scenario
+from StatusMessage import FPGAStatusRecord
+from StatusRunner import FRAME_PIXELS, RIGS
+
+IDLE, ERROR = FPGAStatusRecord(3, 0, 0.0, None), FPGAStatusRecord(4, 0, 0.0, None)
+
+
+def is_white(frames):
+    return frames.any() and numpy.array_equal(frames[..., 0], frames[..., 2])
+
+
+def is_red(frames):
+    return frames[..., 0].any() and not frames[..., 1:].any()
+
+
+def test_render_effect_is_deterministic():
+    parameters = {'color': [50, 50, 50], 'glow': [20, 20, 20], 'frequency': 2.0}
+    frames = render_effect('sineBeat', parameters, seconds=2)
+    assert frames.shape == (120, FRAME_PIXELS, 3)
+    assert numpy.array_equal(frames, render_effect('sineBeat', parameters, seconds=2))
+    assert len(numpy.unique(frames.reshape(len(frames), -1), axis=0)) > 1  # It beats
+
+
+def test_render_effect_keeps_to_the_rig():
+    frames = render_effect('squareBeat', {'color': [150, 0, 0], 'frequency': 2, 'duty': .3}, seconds=1)
+    rig = RIGS[0]
+    lit = numpy.flatnonzero(frames.any(axis=(0, 2)))
+    assert lit.size
+    assert lit.min() >= min(rig.ringStart, rig.cabinetStart)
+    assert lit.max() < max(rig.ringStart + sum(rig.ringLEDs), rig.cabinetStart + rig.cabinetLEDs)
+
+
+def test_render_scenario_follows_the_machine():
+    scenario = [(0.0, IDLE), (1.0, ERROR), (2.0, IDLE)]
+    frames = render_scenario(scenario, seconds=3, fps=30)
+    assert numpy.array_equal(frames, render_scenario(scenario, seconds=3, fps=30))
+    assert is_white(frames[:30])  # The first status takes the machine to its state
+    assert is_red(frames[30:60])
+    assert is_white(frames[60:])
+
+
+def test_render_scenario_dispatches_like_the_service():
+    # The action state code is ignored outside of the action state, and unknown main codes change nothing
+    scenario = [(0.0, IDLE), (1.0, ERROR._replace(actionState=99)), (2.0, FPGAStatusRecord(9, 0, 0.0, None))]
+    frames = render_scenario(scenario, seconds=3, fps=30)
+    assert is_red(frames[30:60]) and is_red(frames[60:])
+
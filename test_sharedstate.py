@@ -0,0 +1,53 @@
+"""Tests of the values shared between the processes
+"""
+from multiprocessing import Process
+import threading
+import time
+
+from sharedstate import LatestValue
+
+
+def wait_blocked(read):
+    """
+    Runs read() in a thread and returns the thread and the list its result goes to
+    """
+    result = []
+    thread = threading.Thread(target=lambda: result.append(read()), daemon=True)
+    thread.start()
+    thread.join(.05)
+    return thread, result
+
+
+def test_latest_value_waits_for_the_write():
+    slot = LatestValue()
+    slot.set(1.5)
+    assert slot.read() == (1.5, 1)
+
+    slot._sequence.value += 1  # A write is under way
+    slot._value.value = 2.5
+    thread, result = wait_blocked(slot.read)
+    assert not result
+    slot._sequence.value += 1
+    thread.join(1)
+    assert result == [(2.5, 2)]
+
+
+def set_values(slot, count):
+    for i in range(1, count + 1):
+        slot.set(float(i))
+
+
+def test_latest_value_readers_follow_the_writer():
+    slot = LatestValue()
+    writer = Process(target=set_values, args=(slot, 50000))
+    writer.start()
+    try:
+        deadline = time.monotonic() + 10
+        last = 0
+        while writer.is_alive() and time.monotonic() < deadline:
+            value, count = slot.read()
+            assert value == count >= last
+            last = count
+    finally:
+        writer.join()
+    assert slot.read() == (50000.0, 50000)
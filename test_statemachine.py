@@ -0,0 +1,60 @@
+"""Tests of the built-in state machine against the HierarchicalMachine of transitions
+"""
+import random
+
+import pytest
+
+from statemachine import MachineError, TableMachine
+from StatusRunner import STATES, TRANSITIONS, state_names
+
+
+class Recorder:
+    """
+    A model recording the callbacks of every state
+    """
+    def __init__(self):
+        self.calls = []
+
+
+for _name in state_names(STATES):
+    setattr(Recorder, 'on_enter_' + _name, lambda self, name=_name: self.calls.append('enter ' + name))
+    setattr(Recorder, 'on_exit_' + _name, lambda self, name=_name: self.calls.append('exit ' + name))
+
+
+def run_triggers(Machine, Error, triggers):
+    """
+    Returns the state, the callbacks and whether it was rejected after every trigger
+    """
+    model = Recorder()
+    Machine(model=model, states=STATES, transitions=TRANSITIONS, initial='start', auto_transitions=False)
+    steps = []
+    for trigger in triggers:
+        model.calls = []
+        try:
+            getattr(model, trigger)()
+            rejected = False
+        except Error:
+            rejected = True
+        steps.append((model.state, model.calls, rejected))
+    return steps
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_table_machine_matches_transitions(seed):
+    transitions = pytest.importorskip('transitions')
+    from transitions.extensions import HierarchicalMachine
+    rng = random.Random(seed)
+    triggers = [rng.choice(TRANSITIONS)[0] for _ in range(200)]
+    assert (run_triggers(TableMachine, MachineError, triggers) ==
+            run_triggers(HierarchicalMachine, transitions.MachineError, triggers))
+
+
+def test_table_machine_rejects_what_it_cannot_do():
+    with pytest.raises(ValueError):
+        TableMachine(Recorder(), STATES, TRANSITIONS, initial='nowhere')
+    with pytest.raises(ValueError):
+        TableMachine(Recorder(), STATES, [['on_go', '*', 'nowhere']], initial='start')
+    with pytest.raises(ValueError):
+        TableMachine(Recorder(), STATES, [['on_go', '*', 'idle', 'isReady']], initial='start')
+    with pytest.raises(ValueError):
+        TableMachine(Recorder(), STATES, TRANSITIONS, initial='start', auto_transitions=True)